@@ -0,0 +1,296 @@
+"""
+This script is meant to be executable.
+
+It generates synthetic DBpedia files and measures how
+fast they can be parsed, turned into records, and
+(optionally) inserted into a database.
+
+Results are appended to a JSON file so runs can be compared.
+Each benchmark runs in its own child process, so the memory
+use reported for it is its own.
+"""
+
+import os
+import json
+import time
+import Queue
+import shutil
+import tempfile
+import traceback
+import multiprocessing
+import resource as rusage
+
+from dbpedia import synthetic, resource
+from dbpedia.datasets import BatchIterator, iterator_mapping
+from dbpedia.ntparser import NTripleParser, CHUNK_LINES
+from dbpedia.instrument import PipelineStats
+import common
+
+import logging
+
+BENCHMARKS = ['parse', 'records', 'insert', 'load']
+DEFAULT_RESULTS_FILE = 'benchmarks.json'
+# the version name that synthetic data is inserted under
+SYNTHETIC_VERSION = 'synthetic'
+
+class SyntheticCollection(object):
+    """Records from a synthetic file, for catdb.insert.insert_dataset"""
+
+    def __init__(self, filename, iteratorClass, stats=None, compact=False):
+        self.filename = filename
+        self.iteratorClass = iteratorClass
+        self.fields = iteratorClass.fields
+        self.stats = stats
+        self.compact = compact
+
+    def batches(self, size=CHUNK_LINES):
+        parser = NTripleParser(open(self.filename, 'rb'), predicates=self.iteratorClass.predicates,
+                               stats=self.stats)
+        return BatchIterator(parser.iter_batches(size), self.iteratorClass,
+                             stats=self.stats, compact=self.compact)
+
+def max_rss_kb():
+    """The peak memory use of this process so far"""
+    return rusage.getrusage(rusage.RUSAGE_SELF).ru_maxrss
+
+def bench_parse(filename, dataset, stats, compact):
+    parser = NTripleParser(open(filename, 'rb'), stats=stats)
+    return sum(len(batch) for batch in parser.iter_batches())
+
+def bench_records(filename, dataset, stats, compact):
+    data = SyntheticCollection(filename, iterator_mapping[dataset], stats=stats, compact=compact)
+    return sum(len(batch) for batch in data.batches())
+
+def bench_insert(filename, dataset, stats, compact, writers=1, load_data=False):
+    from catdb import models, insert
+    version_instance = models.dataset_version(version=SYNTHETIC_VERSION, language='en',
+                                              date=time.strftime('%Y-%m-%d'))
+    data = SyntheticCollection(filename, iterator_mapping[dataset], stats=stats, compact=compact)
+    return insert.insert_dataset(data=data, dataset=dataset,
+                                 version_instance=version_instance, stats=stats, load_data=load_data,
+                                 writers=writers)
+
+def bench_load(filename, dataset, stats, compact, writers=1):
+    return bench_insert(filename, dataset, stats, compact, writers=writers, load_data=True)
+
+benchmark_functions = {
+    'parse': bench_parse,
+    'records': bench_records,
+    'insert': bench_insert,
+    'load': bench_load,
+}
+
+def _measure(results, benchmark, filename, dataset, compact, writers):
+    """
+    Runs a benchmark function in a child process,
+    putting what it measured (or the error) on the results queue.
+    """
+    try:
+        stats = PipelineStats(label="%s %s" % (benchmark, dataset))
+        rss_before = max_rss_kb()
+
+        before = time.time()
+        if writers is None:
+            items = benchmark_functions[benchmark](filename, dataset, stats, compact)
+        else:
+            items = benchmark_functions[benchmark](filename, dataset, stats, compact, writers=writers)
+        seconds = time.time() - before
+
+        results.put({
+            'items': items,
+            'seconds': seconds,
+            'max_rss_kb': max_rss_kb(),
+            'rss_growth_kb': max_rss_kb() - rss_before,
+            'stages': stats.summary()['stages'],
+        })
+    except Exception:
+        results.put({'error': traceback.format_exc()})
+
+def run(benchmark, filename, dataset, lines, size, settings, compact=False, writers=None):
+    """
+    Runs one benchmark on a synthetic file, returning a json-friendly result.
+    Database benchmarks are given the number of writers to use.
+    """
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure,
+                                      args=(results, benchmark, filename, dataset, compact, writers))
+    process.start()
+    try:
+        while True:
+            try:
+                measured = results.get(timeout=1)
+                break
+            except Queue.Empty:
+                if not process.is_alive():
+                    raise RuntimeError("The %s benchmark process died (exit code %s)"
+                                       % (benchmark, process.exitcode))
+    finally:
+        process.join()
+
+    if 'error' in measured:
+        raise RuntimeError("The %s benchmark failed:\n%s" % (benchmark, measured['error']))
+
+    items = measured['items']
+    seconds = measured['seconds']
+    result = {
+        'benchmark': benchmark,
+        'dataset': dataset,
+        'settings': settings,
+        'compact': compact,
+        'writers': writers,
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'lines': lines,
+        'bytes': size,
+        'items': items,
+        'seconds': seconds,
+        'lines_per_second': lines / seconds if seconds else 0.0,
+        'max_rss_kb': measured['max_rss_kb'],
+        'rss_growth_kb': measured['rss_growth_kb'],
+        'stages': measured['stages'],
+    }
+
+    print "%s %s%s: %d lines in %.2fs (%.0f lines/s), %d items, max rss %d KB" % (
+        benchmark, dataset, " (%d writers)" % writers if writers else "",
+        lines, seconds, result['lines_per_second'], items, result['max_rss_kb'])
+
+    return result
+
+def save_results(filename, results):
+    """Adds results to the list in a JSON file"""
+    previous = []
+    if os.path.exists(filename):
+        with open(filename) as f:
+            previous = json.load(f)
+
+    with open(filename, 'w') as f:
+        json.dump(previous + results, f, indent=2)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark parsing and importing synthetic dbpedia data.")
+    common.add_database_args(parser, required=False)
+    common.add_io_args(parser)
+
+    parser.add_argument("--benchmarks",
+                        required=False,
+                        nargs='+',
+                        choices=BENCHMARKS,
+                        default=['parse', 'records'],
+                        help="what to measure (insert and load need --database)")
+
+    parser.add_argument("--datasets",
+                        required=False,
+                        nargs='+',
+                        metavar='DBPEDIA_DATASET',
+                        choices=resource.dataset_names,
+                        default=resource.dataset_names,
+                        help="which dataset(s) to generate")
+
+    parser.add_argument("--lines",
+                        required=False,
+                        default=synthetic.DEFAULT_LINES,
+                        type=int,
+                        help="number of triples to generate for each dataset")
+
+    parser.add_argument("--escape-density",
+                        required=False,
+                        default=synthetic.DEFAULT_ESCAPE_DENSITY,
+                        type=float,
+                        help="fraction of names with escaped characters")
+
+    parser.add_argument("--unicode-share",
+                        required=False,
+                        default=synthetic.DEFAULT_UNICODE_SHARE,
+                        type=float,
+                        help="fraction of names with non-ASCII characters")
+
+    parser.add_argument("--fanout",
+                        required=False,
+                        default=synthetic.DEFAULT_FANOUT,
+                        type=int,
+                        help="average number of categories per article or category")
+
+    parser.add_argument("--seed",
+                        required=False,
+                        default=0,
+                        type=int,
+                        help="random seed for the generator")
+
+    parser.add_argument("--compact",
+                        required=False,
+                        default=False,
+                        action="store_true",
+                        help="use tuple records instead of dictionaries")
+
+    parser.add_argument("--writers",
+                        required=False,
+                        nargs='+',
+                        default=[1],
+                        type=int,
+                        metavar="N",
+                        help="run the insert and load benchmarks with each of these numbers of connections")
+
+    parser.add_argument("--results",
+                        required=False,
+                        default=DEFAULT_RESULTS_FILE,
+                        metavar="FILE",
+                        help="JSON file to add the results to")
+
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO)
+    else:
+        logging.basicConfig(level=logging.WARN)
+
+    if 'insert' in args.benchmarks or 'load' in args.benchmarks:
+        if not args.database:
+            parser.error("the insert and load benchmarks need --database")
+
+        from catdb import models
+        import catdb.mysql as mysql
+
+        if args.password:
+            password = common.get_database_password(args.user, args.hostname, args.port)
+        else:
+            password = mysql.DEFAULT_PASSWORD
+
+        db = mysql.connect(database=args.database,
+                           user=args.user, host=args.hostname,
+                           port=args.port, password=password,
+                           local_infile='load' in args.benchmarks)
+        if not db:
+            exit(1)
+
+        models.database_proxy.initialize(db)
+        models.create_tables(drop_if_exists=False, set_engine='InnoDB')
+
+    settings = {
+        'escape_density': args.escape_density,
+        'unicode_share': args.unicode_share,
+        'fanout': args.fanout,
+        'seed': args.seed,
+    }
+
+    results = []
+    tempdir = tempfile.mkdtemp(prefix='wikicat-benchmark-')
+    try:
+        for dataset in args.datasets:
+            filename = os.path.join(tempdir, '%s.nt' % dataset)
+            size = synthetic.write(filename, dataset, lines=args.lines, **settings)
+            print "Generated %d lines (%.1f MB) of %s" % (args.lines, size / 1024.0 ** 2, dataset)
+
+            for benchmark in args.benchmarks:
+                if benchmark in ('insert', 'load'):
+                    for writers in args.writers:
+                        results.append(run(benchmark, filename, dataset, args.lines, size, settings,
+                                           compact=args.compact, writers=writers))
+                else:
+                    results.append(run(benchmark, filename, dataset, args.lines, size, settings,
+                                       compact=args.compact))
+    finally:
+        shutil.rmtree(tempdir)
+
+    save_results(args.results, results)
+    print "Saved %d results to %s" % (len(results), args.results)
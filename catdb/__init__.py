@@ -1,4 +1,4 @@
-import models, mysql
+import models, mysql, insert
 
 if __name__ == "__main__":
     import sys
@@ -8,7 +8,7 @@ if __name__ == "__main__":
     log = logging.getLogger('catdb')
 
     # empty the cache before we begin
-    to_test = [models, mysql]
+    to_test = [models, mysql, insert]
 
     for module in to_test:
         try:
@@ -4,20 +4,168 @@ a large batch of data.
 """
 
 import sys
+import time
+import Queue
+import tempfile
+import threading
+import itertools
+from contextlib import contextmanager
 
 import models
+import mysql
 from models import Category, Article, model_mapping
 from peewee import ForeignKeyField
 
 INSERT_BATCH_SIZE = 10000
 
-# use 0 for no cache
-CACHE_LIMIT = 2000
-CACHE_CUT_FACTOR = 0.5
+# the most names (of articles, or of categories) to remember the ids of
+CACHE_LIMIT = 500000
+# names read at a time when preloading a whole table (see Cache.preload)
+PRELOAD_PAGE_SIZE = 100000
+# ways of replacing the rows of a version that was imported before (see insert_dataset)
+REPLACE_STRATEGIES = ['delete', 'swap']
+# the most resolved batches waiting to be inserted, when pipelined
+PIPELINE_QUEUE_BATCHES = 4
+# how often (in seconds) each side of the pipeline checks whether the other has failed
+PIPELINE_CHECK_INTERVAL = 0.1
+
+# if true, new names are only created while holding a server-wide lock,
+# so several processes can import at once without creating the same name twice
+name_locking = False
+# seconds to wait for the lock
+NAME_LOCK_TIMEOUT = 600
 
 import logging
 log = logging.getLogger('catdb.insert')
 
+def use_name_locks(enabled):
+    global name_locking
+    name_locking = enabled
+
+@contextmanager
+def _name_lock(db, table):
+    """Holds a MySQL user lock on the names in a table, for the whole database server"""
+    lock_name = '%s.%s' % (db.database, table)
+    cursor = db.execute_sql('SELECT GET_LOCK(%s, %s)', (lock_name, NAME_LOCK_TIMEOUT))
+    if cursor.fetchone()[0] != 1:
+        raise Exception("Could not lock %s" % lock_name)
+
+    try:
+        yield
+    finally:
+        db.execute_sql('SELECT RELEASE_LOCK(%s)', (lock_name,))
+
+# the parts of an LRUCache link
+_PREV, _NEXT, _KEY, _VALUE = 0, 1, 2, 3
+
+class LRUCache(object):
+    """
+    A dictionary of up to limit entries, which forgets the least
+    recently used entry to make room for a new one.
+    Getting and putting entries takes constant time.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        # [prev, next, key, value] links by key
+        self.links = {}
+        # a circular list of the links, from least to most recently used
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _unlink(self, link):
+        prev, next = link[_PREV], link[_NEXT]
+        prev[_NEXT] = next
+        next[_PREV] = prev
+
+    def _append(self, link):
+        root = self.root
+        last = root[_PREV]
+        link[_PREV] = last
+        link[_NEXT] = root
+        last[_NEXT] = root[_PREV] = link
+
+    def get(self, key):
+        """Gets the value for a key (making it the most recently used), or None"""
+        link = self.links.get(key)
+        if link is None:
+            self.misses += 1
+            return None
+
+        self._unlink(link)
+        self._append(link)
+        self.hits += 1
+        return link[_VALUE]
+
+    def put(self, key, value):
+        if not self.limit:
+            return
+
+        links = self.links
+        link = links.get(key)
+        if link is not None:
+            self._unlink(link)
+        elif len(links) >= self.limit:
+            oldest = self.root[_NEXT]
+            self._unlink(oldest)
+            del links[oldest[_KEY]]
+            self.evictions += 1
+
+        link = [None, None, key, value]
+        links[key] = link
+        self._append(link)
+
+    def keys(self):
+        """The keys, from least to most recently used"""
+        keys = []
+        link = self.root[_NEXT]
+        while link is not self.root:
+            keys.append(link[_KEY])
+            link = link[_NEXT]
+        return keys
+
+    def __len__(self):
+        return len(self.links)
+
+    def __contains__(self, key):
+        return key in self.links
+
+class NameMap(object):
+    """
+    Every name in a table, and its id: a plain dictionary,
+    with the same interface and counters as LRUCache.
+    Nothing is ever evicted, so a name missing from it is new.
+    """
+
+    limit = None
+    evictions = 0
+
+    def __init__(self):
+        self.ids = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        id = self.ids.get(key)
+        if id is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return id
+
+    def put(self, key, value):
+        self.ids[key] = value
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, key):
+        return key in self.ids
+
 class Cache(object):
 
     def __init__(self, name, relatedClass, modelClass, lengthLimit = None):
@@ -26,11 +174,13 @@ class Cache(object):
         self.relatedClass = relatedClass
         self.lengthLimit = lengthLimit
 
-        self.cache = {}
-        self.reductions = 0
+        # related model ids by name
+        self.cache = LRUCache(CACHE_LIMIT)
+        # true if the cache holds every name on the server (see preload)
+        self.complete = False
         self.relatives_created = 0
-        self.cache_hits = 0
-        self.cache_misses = 0
+        # related models found on the server
+        self.relatives_fetched = 0
 
         # a list of field objects relevant to this cache
         self.fields = []
@@ -40,31 +190,6 @@ class Cache(object):
 
         self.start_batch()
 
-    def reduce_cache(self):
-
-        desired_cache_size = round(CACHE_LIMIT * CACHE_CUT_FACTOR)
-        threshold = len(self.cache) - desired_cache_size
-
-        for k in self.cache.keys():
-            if self.cache[k][1] < threshold:
-                del self.cache[k]
-            else:
-                self.cache[k][1] -= threshold
-
-    def add_cache(self, key, value):
-        if CACHE_LIMIT:
-            self.cache[key] = [value, len(self.cache)]
-
-        return value
-
-    def get_cache(self, key):
-        if CACHE_LIMIT:
-            pair = self.cache.get(key)
-            if pair:
-                return pair[0]
-
-        return None
-
     def start_batch(self):
 
         # this list of new records in this batch
@@ -73,11 +198,64 @@ class Cache(object):
         # a pre-cache - names of needed related models are placed here before being retrieved
         self.to_lookup = set()
 
+        # the ids of the related models looked up for this batch, by name
+        # (kept here too, in case the cache is too small to hold them all)
+        self.found = {}
+
     def _translate(self, name):
         if self.lengthLimit is not None:
             return name[:self.lengthLimit]
         return name
 
+    def preload(self, page_size=PRELOAD_PAGE_SIZE):
+        """
+        Reads every name in the related table into the cache, a page at a time,
+        so no more lookups are needed: any name not in the cache is new.
+        :return: the number of names read
+        """
+        relatedClass = self.relatedClass
+        names = NameMap()
+        ids = names.ids
+
+        last_id = 0
+        while True:
+            page = relatedClass.select(relatedClass.id, relatedClass.name) \
+                .where(relatedClass.id > last_id) \
+                .order_by(relatedClass.id) \
+                .limit(page_size) \
+                .tuples()
+
+            count = 0
+            for id, name in page:
+                ids[name] = id
+                last_id = id
+                count += 1
+
+            if count < page_size:
+                break
+
+        self.cache = names
+        self.complete = True
+        return len(names)
+
+    def memory_size(self, sample=1000):
+        """Roughly how many bytes the cached names and ids take up, judging by a sample of them"""
+        if self.complete:
+            entries = self.cache.ids.iteritems()
+            size = sys.getsizeof(self.cache.ids)
+        else:
+            entries = ((link[_KEY], link[_VALUE]) for link in self.cache.links.itervalues())
+            size = sys.getsizeof(self.cache.links) + len(self.cache) * sys.getsizeof([None] * 4)
+
+        sizes = [sys.getsizeof(name) + sys.getsizeof(id) for name, id in itertools.islice(entries, sample)]
+        if sizes:
+            size += len(self.cache) * sum(sizes) / len(sizes)
+        return size
+
+    def _found(self, name, id):
+        self.found[name] = id
+        self.cache.put(name, id)
+
     def fill_fields(self, record):
         """Attaches related models from this Cache to the record"""
 
@@ -86,177 +264,714 @@ class Cache(object):
                 continue
 
             relatedName = self._translate(record[fname])
-            related = self.get_cache(relatedName)
+            related = self.cache.get(relatedName)
 
-            if not related:
+            if related is None:
                 # save them for later batch lookup
                 self.to_lookup.add(relatedName)
                 self.records.append((record, fname))
             else:
-                record[fname] = related['id']
-                self.cache_hits += 1
+                record[fname] = related
 
-    def process_batch(self):
+    def _select_missing(self):
+        """Caches the related models in to_lookup that are on the server already"""
+
+        # get all the items that weren't already in the cache
+        relatedModels = self.relatedClass.select() \
+            .where(self.relatedClass.name << list(self.to_lookup)) \
+            .dicts()
+
+        # cache them
+        for relatedDict in relatedModels:
+            name = relatedDict['name']
+
+            self._found(name, relatedDict['id'])
+            self.to_lookup.discard(name)
+
+            self.relatives_fetched += 1
+
+    def fetch_missing(self):
         """
-        Checks if any related models needed by the current batch are on the server.
-        If not, creates them.
-        Matches the models in the batch with their related models.
+        Checks if the related models in to_lookup are on the server.
+        If not, creates them. Either way, they end up in the cache.
         :return:
         """
 
         if len(self.to_lookup) != 0:
             db = self.relatedClass._meta.database
 
-            # get all the items that weren't already in the cache
-            relatedModels = self.relatedClass.select() \
-                .where(self.relatedClass.name << list(self.to_lookup)) \
-                .dicts()
+            # a preloaded cache already knows everything on the server
+            if not self.complete:
+                self._select_missing()
+
+            if len(self.to_lookup) > 0 and name_locking:
+                with _name_lock(db, self.relatedClass._meta.db_table):
+                    # another process may have just created some of them;
+                    # committing starts a new snapshot, so we can see them
+                    db.commit()
+                    self._select_missing()
+                    self._create_missing(db)
+            else:
+                self._create_missing(db)
 
-            # cache them
-            for relatedDict in relatedModels:
-                name = relatedDict['name']
+    def _create_missing(self, db):
+        """Creates the related models still in to_lookup, and caches them"""
 
-                self.add_cache(name, relatedDict)
-                self.to_lookup.remove(name)
+        # now, do we need to create any?
+        if len(self.to_lookup) > 0:
+            # make a list out of the map for reliability
+            to_lookup = list(self.to_lookup)
 
-                self.cache_misses += 1
+            newRelated = [{
+                              'name': name
+                          } for name in to_lookup]
 
-            # now, do we need to create any?
-            if len(self.to_lookup) > 0:
-                # make a list out of the map for reliability
-                to_lookup = list(self.to_lookup)
+            # batch insert these
+            sql, params = self.relatedClass.generate_batch_insert(newRelated)
+            cursor = db.execute_sql(sql, params)
+            idSequence = db.last_insert_id(cursor, self.relatedClass)
+            # the ids are sequential from this base
 
-                newRelated = [{
-                                  'name': name
-                              } for name in to_lookup]
+            # get/generate the id numbers (that's all we needed anyway)
+            for name in to_lookup:
+                self._found(name, idSequence)
+                idSequence += 1
+                self.relatives_created += 1
 
-                # batch insert these
-                sql, params = self.relatedClass.generate_batch_insert(newRelated)
-                cursor = db.execute_sql(sql, params)
-                idSequence = db.last_insert_id(cursor, self.relatedClass)
-                # the ids are sequential from this base
+            db.commit()
 
-                # get/generate the id numbers (that's all we needed anyway)
-                for name in self.to_lookup:
-                    self.add_cache(name, {
-                        'id': idSequence,
-                        'name': name
-                    })
-                    idSequence += 1
-                    self.relatives_created += 1
+    def process_batch(self):
+        """
+        Checks if any related models needed by the current batch are on the server.
+        If not, creates them.
+        Matches the models in the batch with their related models.
+        :return:
+        """
 
-                db.commit()
+        if len(self.to_lookup) != 0:
+            self.fetch_missing()
 
             # now assign them all to the batched records
             for record, fname in self.records:
 
                 relatedName = self._translate(record[fname])
-                related = self.get_cache(relatedName)
+                related = self.found.get(relatedName)
 
-                if not related:
+                if related is None:
                     raise Exception("What? You can't find %s?" % relatedName)
 
-                record[fname] = related['id']
+                record[fname] = related
+
+        self.start_batch()
+
+    def resolve_column(self, names):
+        """
+        Gets the ids of the related models for a list of names,
+        looking up or creating any that are not in the cache.
+        :param names:
+        :return: a list of ids
+        """
+        names = [self._translate(name) for name in names]
 
-        # now we shrink the cache if needed, since we're done with these for now
-        if len(self.cache) >= CACHE_LIMIT:
-            self.reduce_cache()
-            self.reductions += 1
+        get = self.cache.get
+        ids = [get(name) for name in names]
+
+        for name, id in zip(names, ids):
+            if id is None:
+                self.to_lookup.add(name)
+
+        if self.to_lookup:
+            self.fetch_missing()
+
+            found = self.found
+            for i, name in enumerate(names):
+                if ids[i] is None:
+                    ids[i] = found.get(name)
+                    if ids[i] is None:
+                        raise Exception("What? You can't find %s?" % name)
 
         self.start_batch()
 
+        return ids
+
     def print_stats(self):
-        log.info("%s cache \t hits: %d; misses: %d; new relatives: %d",
-                 self.name,
-                 self.cache_hits, self.cache_misses, self.relatives_created)
-        if self.cache_hits + self.cache_misses > 0:
-            percentHits = 100 * self.cache_hits / (self.cache_hits + self.cache_misses)
+        cache = self.cache
+        log.info("%s cache \t hits: %d; misses: %d; evictions: %d",
+                 self.name, cache.hits, cache.misses, cache.evictions)
+        if cache.hits + cache.misses > 0:
+            percentHits = 100.0 * cache.hits / (cache.hits + cache.misses)
         else:
             percentHits = 0
 
-        log.info("        \t hits: %.1f%%; cache limit: %d; reductions: %d",
-                 percentHits, CACHE_LIMIT, self.reductions)
+        log.info("        \t hits: %.1f%%; size: %d of %s; fetched: %d; new relatives: %d",
+                 percentHits, len(cache), cache.limit if cache.limit is not None else 'all',
+                 self.relatives_fetched, self.relatives_created)
+
+def _batches(data, size):
+    """
+    Groups the records in data into lists of up to size records.
+    Collections that can parse whole batches at once
+    (see dbpedia.datasets.TripleCollection.batches) are asked for them directly.
+    """
+    if size is None:
+        yield list(data)
+        return
+
+    if hasattr(data, 'batches'):
+        for batch in data.batches(size):
+            yield batch
+        return
+
+    records = data.__iter__()
+    while True:
+        batch = list(itertools.islice(records, size))
+        if not batch:
+            return
+        yield batch
+
+def _resolve_columns(batch, fields, caches, version_id=None):
+    """
+    Turns a list of compact records (tuples in fields order) into rows
+    ready for insertion, with the related names replaced by their ids.
+    Returns the rows and the list of their field names.
+    """
+    resolvers = {}
+    for cache in caches:
+        for fname, field in cache.fields:
+            resolvers[fname] = cache
+
+    columns = []
+    for fname, column in zip(fields, zip(*batch)):
+        cache = resolvers.get(fname)
+        if cache is not None:
+            column = cache.resolve_column(column)
+        columns.append(column)
+
+    fields = list(fields)
+    if version_id is not None:
+        columns.append([version_id] * len(batch))
+        fields.append('version')
+
+    return zip(*columns), fields
+
+def _load_rows(db, modelClass, rows, fields=None, table=None):
+    """
+    Inserts rows (as in generate_batch_insert) by writing them to a
+    temporary file and loading it with LOAD DATA LOCAL INFILE,
+    which saves the server from parsing a huge INSERT statement.
+    The connection must allow local files (see mysql.connect).
+    """
+    with tempfile.NamedTemporaryFile(prefix='wikicat-', suffix='.tsv') as f:
+        sql, params = modelClass.generate_load_data(rows, f, fields=fields, table=table)
+        if sql:
+            f.flush()
+            db.execute_sql(sql, params)
+
+def _insert_rows(db, modelClass, rows, fields=None, load_data=False, table=None):
+    """Inserts and commits a batch of rows (into table, if given, instead of the model's table)"""
+    if load_data:
+        _load_rows(db, modelClass, rows, fields=fields, table=table)
+        db.commit()
+    else:
+        # generate and run the sql and parameters for the batch insert
+        sql, params = modelClass.generate_batch_insert(rows, fields=fields, table=table)
+        if sql:
+            db.execute_sql(sql, params)
+            db.commit()
 
-def insert_dataset(data, dataset, version_instance, limit=None):
+def _inserter_for(db, modelClass, load_data=False, table=None):
+    """A function inserting batches of rows on a connection, for PipelinedInserter"""
+    def insert(rows, fields):
+        _insert_rows(db, modelClass, rows, fields=fields, load_data=load_data, table=table)
+    return insert
+
+# put on the queue after the last batch
+_END = object()
+
+class PipelinedInserter(object):
+    """
+    Inserts batches on a background thread, so the next batch
+    can be parsed and resolved while the last one is inserted.
+
+    insert is called with the rows and fields of each batch.
+    If it fails, the error is raised by the next put() or close().
+    """
+
+    # for adding to the stats from several inserters at once
+    stats_lock = threading.Lock()
+
+    def __init__(self, insert, stats=None, queue_batches=PIPELINE_QUEUE_BATCHES):
+        self.insert = insert
+        self.stats = stats
+        self.queue = Queue.Queue(maxsize=queue_batches)
+
+        self.cancelled = False
+        # the sys.exc_info() of a failed insert
+        self.error = None
+
+        # seconds spent inserting, and waiting for the inserts to catch up
+        self.busy = 0.0
+        self.waited = 0.0
+
+        self.thread = threading.Thread(target=self._work, name='pipelined-insert')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _work(self):
+        while not self.cancelled:
+            try:
+                item = self.queue.get(timeout=PIPELINE_CHECK_INTERVAL)
+            except Queue.Empty:
+                continue
+            if item is _END:
+                return
+
+            rows, fields, count = item
+            before = time.time()
+            try:
+                self.insert(rows, fields)
+            except Exception:
+                self.error = sys.exc_info()
+                return
+
+            seconds = time.time() - before
+            self.busy += seconds
+            if self.stats is not None:
+                with self.stats_lock:
+                    self.stats.add('insert', seconds, count)
+
+    def _raise_error(self):
+        if self.error is not None:
+            error_type, error, traceback = self.error
+            raise error_type, error, traceback
+
+    def put(self, rows, fields, count):
+        """Waits for room in the queue, then queues a batch for insertion"""
+        before = time.time()
+        try:
+            while True:
+                self._raise_error()
+                try:
+                    self.queue.put((rows, fields, count), timeout=PIPELINE_CHECK_INTERVAL)
+                    return
+                except Queue.Full:
+                    pass
+        finally:
+            self.waited += time.time() - before
+
+    def close(self):
+        """Waits for the queued batches to be inserted"""
+        before = time.time()
+        try:
+            while self.thread.is_alive():
+                try:
+                    self.queue.put(_END, timeout=PIPELINE_CHECK_INTERVAL)
+                    break
+                except Queue.Full:
+                    pass
+            self.thread.join()
+        finally:
+            self.waited += time.time() - before
+
+        self._raise_error()
+
+    def cancel(self):
+        """Stops inserting, dropping any queued batches"""
+        self.cancelled = True
+        self.thread.join()
+
+    def overlap(self):
+        """The seconds spent inserting while the next batches were being prepared"""
+        return max(0.0, self.busy - self.waited)
+
+class PartitionedInserter(object):
+    """
+    Splits each batch between several PipelinedInserters
+    by the value of one field (a related id), so each
+    inserts its share of the rows on its own connection.
+    Rows with the same value always go to the same inserter.
+    """
+
+    def __init__(self, inserters, field):
+        self.inserters = inserters
+        self.field = field
+
+    def put(self, rows, fields, count):
+        if fields is None:
+            key = self.field
+        else:
+            key = fields.index(self.field)
+
+        partitions = [[] for inserter in self.inserters]
+        n = len(partitions)
+        for row in rows:
+            partitions[row[key] % n].append(row)
+
+        for inserter, partition in zip(self.inserters, partitions):
+            if partition:
+                inserter.put(partition, fields, len(partition))
+
+    def close(self):
+        error = None
+        for inserter in self.inserters:
+            try:
+                inserter.close()
+            except Exception:
+                # let the others finish, then raise the first error
+                if error is None:
+                    error = sys.exc_info()
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+    def cancel(self):
+        for inserter in self.inserters:
+            inserter.cancel()
+
+    @property
+    def busy(self):
+        return sum(inserter.busy for inserter in self.inserters)
+
+    @property
+    def waited(self):
+        return sum(inserter.waited for inserter in self.inserters)
+
+    def overlap(self):
+        return max(0.0, self.busy - self.waited)
+
+def insert_dataset(data, dataset, version_instance, limit=None, stats=None, preload=(), load_data=False,
+                   pipeline=False, writers=1, bulk=False, replace='delete'):
+    """
+    Insert the records in data for a dataset.
+
+    The records may be dictionaries, or compact tuples in the
+    order given by data.fields (see dbpedia.datasets.TripleCollection).
+
+    If stats (a dbpedia.instrument.PipelineStats) is given,
+    the time spent looking up related names ('lookup') and
+    inserting rows ('insert') is added to it.
+
+    The names of the tables in preload ('categories', 'articles')
+    are read into memory first, instead of being looked up batch by batch.
+
+    With load_data, batches are sent as files for LOAD DATA LOCAL INFILE
+    instead of as INSERT statements.
+
+    With pipeline, batches are inserted on a second connection, by a
+    background thread (see PipelinedInserter), and the time spent
+    waiting for it is added to stats as 'wait'.
+
+    With more than one writer, batches are pipelined and split between
+    that many connections (see PartitionedInserter). Names are still
+    resolved on this connection only, so no name is created twice.
+
+    With bulk, the connections use the models.BULK_SESSION_SETTINGS.
+
+    Any rows the version already has are replaced in one of the
+    REPLACE_STRATEGIES: 'delete' deletes them first, and 'swap' loads
+    the version into a staging table and then swaps it in (see
+    models.swap_version), so readers never see a half-imported version.
+    """
     if dataset not in model_mapping:
         raise Exception("No model for %s" % dataset)
+    if replace not in REPLACE_STRATEGIES:
+        raise Exception("No replacement strategy %s" % replace)
     # if dataset == 'article_categories': limit = 20000
     modelClass = model_mapping[dataset]
 
+    # the table to insert into, if not the model's
+    staging = None
+
     # First thing we clear the instances associated with this version
     if hasattr(modelClass, 'version'):
-        modelClass.delete().where(modelClass.version == version_instance).execute()
+        if replace == 'swap':
+            models.partition_by_version(modelClass)
+            staging = models.create_staging_table(modelClass, version_instance)
+        else:
+            models.add_version_partition(modelClass, version_instance)
+            modelClass.delete().where(modelClass.version == version_instance).execute()
 
     db = modelClass._meta.database
 
-    # for actually counting number imported
-    imported = 0
-
-    batch_counter = 0 # this is for controlling printout width
-    batch = []
-
     # cache structures
     category_cache = Cache('categories', Category, modelClass, models.ARTICLE_MAX_LENGTH)
     article_cache = Cache('articles', Article, modelClass, models.CATEGORY_MAX_LENGTH)
 
+    for cache in (category_cache, article_cache):
+        if cache.name in preload and cache.fields:
+            before = time.time()
+            count = cache.preload()
+            seconds = time.time() - before
+
+            log.info("Preloaded %d %s in %.1fs, using about %.1f MB",
+                     count, cache.name, seconds, cache.memory_size() / 1024.0 ** 2)
+            if stats is not None:
+                stats.add('preload', seconds, count)
+
     # disable autocommit and foreign key checks
     db.execute_sql('SET autocommit=0')
     db.execute_sql('SET foreign_key_checks=0')
+    if bulk:
+        models.bulk_session(db)
+
+    versioned = hasattr(modelClass, 'version')
+
+    inserter = None
+    insert_dbs = []
+    if pipeline or writers > 1:
+        inserters = []
+        for i in range(max(writers, 1)):
+            insert_db = mysql.connect_again(db)
+            insert_dbs.append(insert_db)
+            insert_db.execute_sql('SET autocommit=0')
+            insert_db.execute_sql('SET foreign_key_checks=0')
+            if bulk:
+                models.bulk_session(insert_db)
+            inserters.append(PipelinedInserter(_inserter_for(insert_db, modelClass, load_data, staging),
+                                               stats=stats))
+
+        if len(inserters) == 1:
+            inserter = inserters[0]
+        else:
+            # split rows by the first related name (the article, for article_categories)
+            fname = (article_cache.fields + category_cache.fields)[0][0]
+            inserter = PartitionedInserter(inserters, fname)
+
+    finished = False
+    try:
+        imported = _insert_batches(data, modelClass, db, version_instance if versioned else None,
+                                   article_cache, category_cache, limit, stats, load_data, inserter, staging)
+        if inserter is not None:
+            inserter.close()
+
+        if staging is not None:
+            before = time.time()
+            models.swap_version(modelClass, version_instance, staging)
+            if stats is not None:
+                stats.add('swap', time.time() - before)
+        finished = True
+    finally:
+        if inserter is not None:
+            # in case the import failed, stop the inserts too
+            inserter.cancel()
+        for insert_db in insert_dbs:
+            insert_db.close()
+
+        if not finished:
+            # turning autocommit back on would commit the batch in progress
+            db.rollback()
+            if staging is not None:
+                # the version is left as it was
+                db.execute_sql('DROP TABLE IF EXISTS %s%s%s' % (db.quote_char, staging, db.quote_char))
+
+        # the connection goes back to the usual settings, even if the import failed
+        if bulk:
+            models.bulk_session(db, False)
+        db.execute_sql('SET autocommit=1')
+        db.execute_sql('SET foreign_key_checks=1')
+
+    print
 
-    for record in data:
+    if inserter is not None:
+        log.info("Inserting overlapped %.1fs of %.1fs; waited %.1fs for inserts",
+                 inserter.overlap(), inserter.busy, inserter.waited)
+        if stats is not None:
+            stats.add('wait', inserter.waited)
 
-        article_cache.fill_fields(record)
-        category_cache.fill_fields(record)
+    article_cache.print_stats()
+    category_cache.print_stats()
 
-        # add the version reference to this record if needed
-        if hasattr(modelClass, 'version'):
-            record['version'] = version_instance.id
+    return imported
 
-        # this record is now ready for insertion when the batch is full
-        batch.append(record)
+def _insert_batches(data, modelClass, db, version_instance, article_cache, category_cache,
+                    limit, stats, load_data, inserter, table=None):
+    """Resolves and inserts the records for insert_dataset, returning the number inserted"""
 
-        # is the batch full?
-        if INSERT_BATCH_SIZE is not None and len(batch) >= INSERT_BATCH_SIZE:
-            article_cache.process_batch()
-            category_cache.process_batch()
+    # for actually counting number imported
+    imported = 0
 
-            # generate and run the sql and parameters for the batch insert
-            sql, params = modelClass.generate_batch_insert(batch)
-            db.execute_sql(sql, params)
-            db.commit()
+    batch_counter = 0 # this is for controlling printout width
 
-            imported += len(batch)
-            batch_counter += 1
+    versioned = version_instance is not None
 
-            sys.stdout.write('.')
-            sys.stdout.flush()
-            if batch_counter % 60 == 0:
-                print
+    for batch in _batches(data, INSERT_BATCH_SIZE):
 
-            # reset the caches
-            batch = []
+        before = time.time()
 
-            if limit is not None and imported >= limit:
-                print
-                print "Reached limit of %d" % limit
-                break
+        if batch and isinstance(batch[0], tuple):
+            # compact records are resolved a column at a time
+            rows, fields = _resolve_columns(batch, data.fields, [article_cache, category_cache],
+                                            version_instance.id if versioned else None)
+        else:
+            rows, fields = batch, None
 
-    print
+            for record in batch:
+                article_cache.fill_fields(record)
+                category_cache.fill_fields(record)
 
-    # just checking if we need to finish up
-    if len(batch):
-        article_cache.process_batch()
-        category_cache.process_batch()
+                # add the version reference to this record if needed
+                if versioned:
+                    record['version'] = version_instance.id
+
+            # the batch is now ready for insertion
+            article_cache.process_batch()
+            category_cache.process_batch()
+
+        looked_up = time.time()
+        if stats is not None:
+            stats.add('lookup', looked_up - before, len(batch))
+
+        if inserter is not None:
+            inserter.put(rows, fields, len(batch))
+        else:
+            _insert_rows(db, modelClass, rows, fields=fields, load_data=load_data, table=table)
+            if stats is not None:
+                stats.add('insert', time.time() - looked_up, len(batch))
 
-        sql, params = modelClass.generate_batch_insert(batch)
-        db.execute_sql(sql, params)
-        db.commit()
         imported += len(batch)
+        batch_counter += 1
 
-    article_cache.print_stats()
-    category_cache.print_stats()
+        sys.stdout.write('.')
+        sys.stdout.flush()
+        if batch_counter % 60 == 0:
+            print
 
-    db.execute_sql('SET autocommit=1')
-    db.execute_sql('SET foreign_key_checks=1')
+        if limit is not None and imported >= limit:
+            print
+            print "Reached limit of %d" % limit
+            break
 
     return imported
+
+def _test():
+    import nose.tools as nt
+
+    cache = LRUCache(3)
+    for i, name in enumerate('abc'):
+        cache.put(name, i)
+    nt.eq_(3, len(cache))
+
+    # using a makes b the oldest
+    nt.eq_(0, cache.get('a'))
+    cache.put('d', 3)
+    nt.ok_('b' not in cache)
+    nt.eq_(['c', 'a', 'd'], cache.keys())
+    nt.eq_(None, cache.get('b'))
+
+    # putting an old name again doesn't evict anything
+    cache.put('c', 2)
+    nt.eq_(['a', 'd', 'c'], cache.keys())
+    nt.eq_((1, 1, 1), (cache.hits, cache.misses, cache.evictions))
+
+    # a limit of 0 caches nothing
+    cache = LRUCache(0)
+    cache.put('a', 0)
+    nt.eq_(0, len(cache))
+
+    # names in the cache are resolved without the database
+    categories = Cache('categories', Category, model_mapping['category_categories'], models.CATEGORY_MAX_LENGTH)
+    for i, name in enumerate(['x', 'y', 'z']):
+        categories.cache.put(name, i + 10)
+    nt.eq_([12, 10, 12, 11], categories.resolve_column(['z', 'x', 'z', 'y']))
+    nt.eq_(4, categories.cache.hits)
+
+    # preloading reads the whole table, a page at a time
+    import peewee
+    models.database_proxy.initialize(peewee.SqliteDatabase(':memory:'))
+    Category.create_table()
+    for i in range(25):
+        Category.create(name=u'Category %d' % i)
+
+    categories = Cache('categories', Category, model_mapping['category_categories'], models.CATEGORY_MAX_LENGTH)
+    nt.eq_(25, categories.preload(page_size=10))
+    nt.ok_(categories.complete)
+    nt.eq_([1, 25, 3], categories.resolve_column([u'Category 0', u'Category 24', u'Category 2']))
+    nt.ok_(categories.memory_size() > 0)
+
+    # rows are written for LOAD DATA one per line, with special characters escaped
+    modelClass = model_mapping['category_labels']
+    fields = ['category', 'label', 'version']
+    with tempfile.NamedTemporaryFile() as f:
+        sql, params = modelClass.generate_load_data([(3, u'a\tb\\c\n\u6771', 1), (4, None, 1)], f, fields=fields)
+        nt.eq_([f.name], params)
+        nt.ok_(sql.startswith('LOAD DATA LOCAL INFILE ?'))
+        nt.ok_(sql.endswith('("category_id","label","version_id")'), sql)
+
+        # rows of numbers too, even if only some of them are numbers
+        modelClass.generate_load_data([(5, 6, 1), (7, None, 1)], f, fields=fields)
+        modelClass.generate_load_data([(8, 9, 1), (10, u'x\ty', 1)], f, fields=fields)
+        f.flush()
+
+        with open(f.name, 'rb') as written:
+            nt.eq_(['3\ta\\tb\\\\c\\n\xe6\x9d\xb1\t1\n', '4\t\\N\t1\n',
+                    '5\t6\t1\n', '7\t\\N\t1\n',
+                    '8\t9\t1\n', '10\tx\\ty\t1\n'], written.readlines())
+
+    # pipelined batches are inserted in order, in the background
+    inserted = []
+    def insert(rows, fields):
+        time.sleep(0.01)
+        inserted.append(rows)
+
+    inserter = PipelinedInserter(insert, queue_batches=2)
+    for i in range(10):
+        inserter.put([(i,)], ['n'], 1)
+    inserter.close()
+    nt.eq_([[(i,)] for i in range(10)], inserted)
+    nt.ok_(0 < inserter.waited and 0.1 <= inserter.busy)
+
+    # an error inserting comes out of put() or close(), and stops the pipeline
+    def fail(rows, fields):
+        if rows == 'bad':
+            raise ValueError(rows)
+        inserted.append(rows)
+
+    del inserted[:]
+    inserter = PipelinedInserter(fail, queue_batches=1)
+    inserter.put('good', None, 1)
+    inserter.put('bad', None, 1)
+    with nt.assert_raises(ValueError):
+        for i in range(10):
+            inserter.put('more', None, 1)
+        inserter.close()
+    nt.eq_(['good'], inserted)
+    nt.ok_(not inserter.thread.is_alive())
+
+    # cancelling drops whatever is queued
+    inserter = PipelinedInserter(insert, queue_batches=5)
+    for i in range(5):
+        inserter.put([i], None, 1)
+    inserter.cancel()
+    nt.ok_(not inserter.thread.is_alive())
+
+    # partitioned rows always go to the same inserter
+    partitions = [[], [], []]
+    def insert_into(partition):
+        return lambda rows, fields: partition.extend(rows)
+
+    inserter = PartitionedInserter([PipelinedInserter(insert_into(p)) for p in partitions], 'article')
+    inserter.put([(i, i % 7, 1) for i in range(30)], ['article', 'category', 'version'], 30)
+    inserter.put([{'article': i, 'category': 0} for i in range(30, 40)], None, 10)
+    inserter.close()
+    nt.eq_(list(range(0, 30, 3)), [row[0] for row in partitions[0][:10]])
+    nt.eq_([0], list(set(row['article'] % 3 for row in partitions[0][10:])))
+    nt.eq_(40, sum(len(p) for p in partitions))
+
+    # and errors from any of them come out
+    def fail_always(rows, fields):
+        raise ValueError(rows)
+
+    inserter = PartitionedInserter([PipelinedInserter(insert), PipelinedInserter(fail_always)], 0)
+    inserter.put([(0,), (1,), (2,)], None, 3)
+    nt.assert_raises(ValueError, inserter.close)
+    nt.ok_(not any(i.thread.is_alive() for i in inserter.inserters))
+
+if __name__ == "__main__":
+    import logging
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        _test()
+        logging.info("Tests Passed")
+    except AssertionError as e:
+        logging.error("ERROR: TESTS FAILED")
+        logging.error(e)
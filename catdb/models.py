@@ -11,6 +11,7 @@ from peewee import Model, DoesNotExist
 from playhouse.proxy import Proxy
 from confirm import query_yes_no
 
+import time
 import logging
 
 log = logging.getLogger('catdb.models')
@@ -26,13 +27,29 @@ def use_confirmations(confirm):
     global confirm_replacements
     confirm_replacements = confirm
 
+# characters escaped in LOAD DATA files
+_load_data_escapes = {'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\0': '\\0'}
+
+def _load_data_value(value):
+    """Turns a value into a field of a LOAD DATA file (tab separated, backslash escaped)"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        return str(value)
+
+    if '\\' in value or '\t' in value or '\n' in value or '\0' in value:
+        return ''.join(_load_data_escapes.get(c, c) for c in value)
+    return value
+
 class BaseModel(Model):
     class Meta:
         database = database_proxy  # Use proxy for our DB.
 
     @classmethod
-    def batch_insert(cls, dictionaries, ignore=False):
-        sql, params = cls.generate_batch_insert(dictionaries, ignore=ignore)
+    def batch_insert(cls, dictionaries, ignore=False, fields=None):
+        sql, params = cls.generate_batch_insert(dictionaries, ignore=ignore, fields=fields)
         if sql:
             return cls._meta.database.execute_sql(sql, params)
         return None
@@ -43,10 +60,14 @@ class BaseModel(Model):
         pass
 
     @classmethod
-    def generate_batch_insert(cls, dictionaries, ignore=False):
+    def generate_batch_insert(cls, dictionaries, ignore=False, fields=None, table=None):
         """
         Generates a bulk insert statement a list of dictionaries
         representing model data.
+
+        If fields (a list of field names) is given, the rows
+        may be tuples of values in that order instead.
+        If table is given, the rows go there instead of the model's table.
         :param dictionaries:
         :return:
         """
@@ -54,20 +75,22 @@ class BaseModel(Model):
         if len(dictionaries) == 0:
             return None, None
 
-        # get an example dictionary
-        example = dictionaries[0]
+        if fields is None:
+            # every dictionary should have the same keys as the first
+            example = dictionaries[0]
+            fields = [fname for fname in cls._meta.fields if fname in example]
+            rows = ([d[fname] for fname in fields] for d in dictionaries)
+        else:
+            rows = dictionaries
 
         quote_char = cls._meta.database.quote_char
         interpolation = cls._meta.database.interpolation
 
         if ignore:
-            parts = ['INSERT IGNORE INTO %s%s%s' % (quote_char, cls._meta.db_table, quote_char)]
+            parts = ['INSERT IGNORE INTO %s%s%s' % (quote_char, table or cls._meta.db_table, quote_char)]
         else:
-            parts = ['INSERT INTO %s%s%s' % (quote_char, cls._meta.db_table, quote_char)]
-        columns = []
-        for fname, field in cls._meta.fields.iteritems():
-            if fname in example:
-                columns.append(field.db_column)
+            parts = ['INSERT INTO %s%s%s' % (quote_char, table or cls._meta.db_table, quote_char)]
+        columns = [cls._meta.fields[fname].db_column for fname in fields]
 
         parts.append("(")
         parts.append(",".join('%s%s%s' % (quote_char, f, quote_char) for f in columns))
@@ -76,23 +99,58 @@ class BaseModel(Model):
         parts.append("VALUES")
 
         params = []
+        for row in rows:
+            params.extend(row)
 
-        settings = []
-        for d in dictionaries:
-            values = []
+        placeholder = "(%s)" % ",".join(interpolation for f in fields)
+        parts.append(",".join(placeholder for d in dictionaries))
+        sql = " ".join(parts)
 
-            for fname in cls._meta.fields:
-                if fname in d:
-                    values.append(d[fname])
+        return sql, params
 
-            placeholder = ",".join(interpolation for v in values)
-            settings.append("(%s)" % placeholder)
-            params.extend(values)
+    @classmethod
+    def generate_load_data(cls, dictionaries, f, fields=None, table=None):
+        """
+        Writes a list of dictionaries representing model data
+        to an open file, one tab separated line per row, and generates
+        a LOAD DATA LOCAL INFILE statement for it.
+        The file must be flushed before the statement runs.
+
+        If fields (a list of field names) is given, the rows
+        may be tuples of values in that order instead.
+        If table is given, the rows go there instead of the model's table.
+        :param dictionaries:
+        :param f: a named file
+        :return:
+        """
 
-        parts.append(",".join(settings))
-        sql = " ".join(parts)
+        if len(dictionaries) == 0:
+            return None, None
 
-        return sql, params
+        if fields is None:
+            example = dictionaries[0]
+            fields = [fname for fname in cls._meta.fields if fname in example]
+            rows = ([d[fname] for fname in fields] for d in dictionaries)
+        else:
+            rows = dictionaries
+
+        rows = list(rows)
+        if all(type(value) in (int, long) for row in rows for value in row):
+            # rows of nothing but ids (most of them) need no escaping
+            line = '\t'.join(['%s'] * len(fields)) + '\n'
+            text = ''.join([line % tuple(row) for row in rows])
+        else:
+            text = ''.join(['\t'.join(map(_load_data_value, row)) + '\n' for row in rows])
+        f.write(text)
+
+        quote_char = cls._meta.database.quote_char
+        columns = [cls._meta.fields[fname].db_column for fname in fields]
+        sql = "LOAD DATA LOCAL INFILE %s INTO TABLE %s%s%s CHARACTER SET utf8 (%s)" % (
+            cls._meta.database.interpolation,
+            quote_char, table or cls._meta.db_table, quote_char,
+            ",".join('%s%s%s' % (quote_char, c, quote_char) for c in columns))
+
+        return sql, [f.name]
 
 class DataSetVersion(BaseModel):
     id = PrimaryKeyField()
@@ -255,7 +313,16 @@ model_mapping = {
     'category_labels': CategoryLabel
 }
 
-def create_tables(drop_if_exists=False, set_engine=None):
+# the session settings for bulk loading (see bulk_session)
+BULK_SESSION_SETTINGS = [('unique_checks', 0), ('foreign_key_checks', 0)]
+
+def create_tables(drop_if_exists=False, set_engine=None, defer_indexes=()):
+    """
+    Creates the tables that don't exist yet.
+    The secondary indexes and foreign key constraints of new tables
+    for the models in defer_indexes are left for build_indexes to add later
+    (until then, nothing stops rows with ids that don't exist).
+    """
 
     #foreign key dependencies
     modelClasses = [CategoryLabel, ArticleCategory, CategoryCategory, Article, Category, DataSetVersion]
@@ -289,7 +356,206 @@ def create_tables(drop_if_exists=False, set_engine=None):
                 db.execute_sql('SET default_storage_engine=%s', params=[set_engine])
 
             # create the table
-            modelClass.create_table()
+            _create(modelClass, modelClass in defer_indexes)
+
+def _create(modelClass, defer_indexes=False):
+    if defer_indexes:
+        modelClass._meta.database.create_table(modelClass)
+        log.info("Created table %s without indexes", modelClass._meta.db_table)
+    else:
+        modelClass.create_table()
+
+def secondary_indexes(modelClass):
+    """
+    Gets the indexes peewee makes for a model (besides the primary key),
+    as (name, columns, unique) tuples.
+    """
+    indexes = []
+    for fname, field in modelClass._meta.fields.items():
+        if field.primary_key:
+            continue
+        if isinstance(field, ForeignKeyField) or field.index or field.unique:
+            indexes.append(([field], field.unique))
+    indexes.extend(([modelClass._meta.fields[f] if isinstance(f, basestring) else f for f in fields], unique)
+                   for fields, unique in modelClass._meta.indexes)
+
+    table = modelClass._meta.db_table
+    return [('%s_%s' % (table, '_'.join(f.db_column for f in fields)), [f.db_column for f in fields], unique)
+            for fields, unique in indexes]
+
+def foreign_key_constraints(modelClass):
+    """
+    Gets the foreign key constraints peewee makes for a model, as
+    (name, column, referenced table, referenced column, cascade) tuples.
+    """
+    table = modelClass._meta.db_table
+    constraints = []
+    for fname, field in modelClass._meta.fields.items():
+        if isinstance(field, ForeignKeyField) and not field.primary_key:
+            rel_meta = field.rel_model._meta
+            constraints.append(('fk_%s_%s_%s' % (table, rel_meta.db_table, field.db_column), field.db_column,
+                                rel_meta.db_table, rel_meta.primary_key.db_column, field.cascade))
+    return constraints
+
+def build_indexes(modelClasses):
+    """
+    Adds the secondary indexes and foreign key constraints missing
+    from the tables of some models, with one ALTER TABLE for each table,
+    so each table is rebuilt only once.
+    Tables partitioned by version can't have foreign keys, so they only get indexes.
+    :return: the seconds spent on each table, by table name
+    """
+    times = {}
+    for modelClass in modelClasses:
+        db = modelClass._meta.database
+        table = modelClass._meta.db_table
+        quote = lambda name: '%s%s%s' % (db.quote_char, name, db.quote_char)
+
+        existing = set(row[2] for row in db.execute_sql('SHOW INDEX FROM %s' % quote(table)))
+        missing = [(name, columns, unique) for name, columns, unique in secondary_indexes(modelClass)
+                   if name not in existing]
+
+        missing_keys = []
+        if not _partitions(modelClass):
+            existing_keys = set(_foreign_keys(modelClass))
+            missing_keys = [constraint for constraint in foreign_key_constraints(modelClass)
+                            if constraint[0] not in existing_keys]
+
+        if not missing and not missing_keys:
+            continue
+
+        clauses = ['ADD %sINDEX %s (%s)' % ('UNIQUE ' if unique else '', quote(name), ', '.join(map(quote, columns)))
+                   for name, columns, unique in missing]
+        clauses.extend('ADD CONSTRAINT %s FOREIGN KEY (%s) REFERENCES %s (%s)%s' % (
+                           quote(name), quote(column), quote(rel_table), quote(rel_column),
+                           ' ON DELETE CASCADE' if cascade else '')
+                       for name, column, rel_table, rel_column, cascade in missing_keys)
+
+        before = time.time()
+        db.execute_sql('ALTER TABLE %s %s' % (quote(table), ', '.join(clauses)))
+        times[table] = time.time() - before
+        log.info("Built %d indexes and %d foreign keys on %s in %.1fs",
+                 len(missing), len(missing_keys), table, times[table])
+
+    return times
+
+def _partitions(modelClass):
+    """The names of the partitions of a model's table (an empty list if it isn't partitioned)"""
+    cursor = modelClass._meta.database.execute_sql(
+        'SELECT PARTITION_NAME FROM information_schema.PARTITIONS '
+        'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s', [modelClass._meta.db_table])
+    return [row[0] for row in cursor if row[0] is not None]
+
+def _foreign_keys(modelClass):
+    """The names of the foreign key constraints on a model's table"""
+    cursor = modelClass._meta.database.execute_sql(
+        'SELECT CONSTRAINT_NAME FROM information_schema.TABLE_CONSTRAINTS '
+        'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND CONSTRAINT_TYPE = %s',
+        [modelClass._meta.db_table, 'FOREIGN KEY'])
+    return sorted(row[0] for row in cursor)
+
+def _version_partition(version_id):
+    return 'v%d' % version_id
+
+def partition_by_version(modelClass):
+    """
+    Partitions the table of a versioned model by version, if it isn't already,
+    so a version can be swapped in or dropped as a whole (see swap_version).
+    The primary key becomes (id, version_id), since MySQL requires
+    the partitioning column to be part of it.
+    MySQL can't partition tables with foreign keys either, so the
+    foreign key constraints peewee made for the table are dropped
+    (the id columns keep their indexes).
+    This rewrites the table, so it is slow for large tables, but only happens once.
+    """
+    if _partitions(modelClass):
+        return
+
+    db = modelClass._meta.database
+    table = modelClass._meta.db_table
+    quote = lambda name: '%s%s%s' % (db.quote_char, name, db.quote_char)
+
+    foreign_keys = _foreign_keys(modelClass)
+    if foreign_keys:
+        log.warn("Dropping the foreign keys of %s, to partition it: %s", table, ", ".join(foreign_keys))
+        db.execute_sql('ALTER TABLE %s %s' % (
+            quote(table), ', '.join('DROP FOREIGN KEY %s' % quote(fk) for fk in foreign_keys)))
+    id_column = modelClass._meta.primary_key.db_column
+    version_column = modelClass.version.db_column
+
+    # a partition for each version, and one to start with if there are none
+    version_ids = [row[0] for row in db.execute_sql('SELECT DISTINCT %s FROM %s' % (quote(version_column), quote(table)))]
+    version_ids = sorted(set(version_ids) | set([0]))
+
+    log.info("Partitioning %s by version", table)
+    db.execute_sql('ALTER TABLE %s DROP PRIMARY KEY, ADD PRIMARY KEY (%s, %s)' % (
+        quote(table), quote(id_column), quote(version_column)))
+    db.execute_sql('ALTER TABLE %s PARTITION BY LIST (%s) (%s)' % (
+        quote(table), quote(version_column),
+        ', '.join('PARTITION %s VALUES IN (%d)' % (quote(_version_partition(v)), v) for v in version_ids)))
+
+def add_version_partition(modelClass, version_instance):
+    """
+    Adds a partition for a version to a model's table, if it is
+    partitioned by version and doesn't have one yet.
+    :return: the name of the partition, or None if the table isn't partitioned
+    """
+    partitions = _partitions(modelClass)
+    if not partitions:
+        return None
+
+    partition = _version_partition(version_instance.id)
+    if partition not in partitions:
+        db = modelClass._meta.database
+        db.execute_sql('ALTER TABLE %s%s%s ADD PARTITION (PARTITION %s%s%s VALUES IN (%d))' % (
+            db.quote_char, modelClass._meta.db_table, db.quote_char,
+            db.quote_char, partition, db.quote_char, version_instance.id))
+    return partition
+
+def create_staging_table(modelClass, version_instance):
+    """
+    Creates an empty, unpartitioned copy of a versioned model's table,
+    for loading a version into before it is swapped in with swap_version.
+    :return: the name of the staging table
+    """
+    db = modelClass._meta.database
+    quote = lambda name: '%s%s%s' % (db.quote_char, name, db.quote_char)
+    table = modelClass._meta.db_table
+    staging = '%s_staging_%d' % (table, version_instance.id)
+
+    # whatever is left of an earlier attempt is thrown away
+    db.execute_sql('DROP TABLE IF EXISTS %s' % quote(staging))
+    db.execute_sql('CREATE TABLE %s LIKE %s' % (quote(staging), quote(table)))
+    if _partitions(modelClass):
+        db.execute_sql('ALTER TABLE %s REMOVE PARTITIONING' % quote(staging))
+
+    return staging
+
+def swap_version(modelClass, version_instance, staging):
+    """
+    Replaces the rows of a version with the rows in a staging table,
+    in one step: readers see either the old rows or the new ones.
+    The old rows, left in the staging table, are dropped along with it.
+    The model's table must be partitioned (see partition_by_version).
+    """
+    db = modelClass._meta.database
+    quote = lambda name: '%s%s%s' % (db.quote_char, name, db.quote_char)
+    table = modelClass._meta.db_table
+
+    partition = add_version_partition(modelClass, version_instance)
+    if partition is None:
+        raise Exception("%s is not partitioned by version" % table)
+
+    before = time.time()
+    db.execute_sql('ALTER TABLE %s EXCHANGE PARTITION %s WITH TABLE %s' % (
+        quote(table), quote(partition), quote(staging)))
+    db.execute_sql('DROP TABLE %s' % quote(staging))
+    log.info("Swapped in version %d of %s in %.1fs", version_instance.id, table, time.time() - before)
+
+def bulk_session(db, enabled=True):
+    """Turns the BULK_SESSION_SETTINGS on (or back off) for a connection"""
+    for name, value in BULK_SESSION_SETTINGS:
+        db.execute_sql('SET %s=%d' % (name, value if enabled else 1 - value))
 
 def create_table(modelClass, drop_if_exists=False, set_engine=None):
     table_name = modelClass._meta.db_table
@@ -333,6 +599,12 @@ def _test():
     import mysql
     import insert
 
+    nt.assert_equal(set([('article_categories_version_id', ('version_id',), False),
+                         ('article_categories_article_id', ('article_id',), False),
+                         ('article_categories_category_id', ('category_id',), False)]),
+                    set((name, tuple(columns), unique) for name, columns, unique in secondary_indexes(ArticleCategory)))
+    nt.assert_equal([('categories_name', ['name'], False)], secondary_indexes(Category))
+
     db = mysql.connect(database="wikicat",
                        user="root", host="localhost")
 
@@ -345,6 +617,23 @@ def _test():
     # create the tables
     create_tables(drop_if_exists=True)
 
+    # indexes and foreign keys left for later are added all at once
+    index_names = lambda table: set(row[2] for row in db.execute_sql('SHOW INDEX FROM `%s`' % table))
+    fk_names = sorted(constraint[0] for constraint in foreign_key_constraints(CategoryLabel))
+    nt.assert_equal(['fk_category_labels_categories_category_id', 'fk_category_labels_dataset_versions_version_id'],
+                    fk_names)
+    nt.assert_equal(fk_names, _foreign_keys(CategoryLabel))
+    # (the tables that refer to categories go too)
+    for modelClass in [CategoryLabel, ArticleCategory, CategoryCategory, Category]:
+        modelClass.drop_table()
+    create_tables(defer_indexes=[Category, CategoryLabel])
+    nt.assert_equal(set(['PRIMARY']), index_names('categories'))
+    nt.assert_equal([], _foreign_keys(CategoryLabel))
+    nt.assert_equal(set(['categories', 'category_labels']), set(build_indexes([Category, CategoryLabel])))
+    nt.assert_equal(set(['PRIMARY', 'categories_name']), index_names('categories'))
+    nt.assert_equal(fk_names, _foreign_keys(CategoryLabel))
+    nt.assert_equal({}, build_indexes([Category, CategoryLabel]))
+
     # some example data
     dataset = [
         {'category': u'Category:Futurama', 'label': u'Futurama'},
@@ -361,11 +650,62 @@ def _test():
         {'category': u'Category:British_monarchs', 'label': u'British monarchs'},
     ]
 
+    # insert_dataset fills in the ids of the records, so keep copies
+    copies = [dict(d) for d in dataset]
+    swapped = [dict(d) for d in dataset[:5]]
+    pipelined = [dict(d) for d in dataset]
+
     datasetVersion = dataset_version(version='3.9', language='en', date='2013-04-03')
     imported = insert.insert_dataset(data=dataset, dataset='category_labels', version_instance=datasetVersion)
 
     nt.assert_equal(len(dataset), imported)
 
+    # the same again, through a LOAD DATA file
+    db = mysql.connect(database="wikicat",
+                       user="root", host="localhost", local_infile=True)
+    database_proxy.initialize(db)
+
+    dataset = copies
+    imported = insert.insert_dataset(data=dataset, dataset='category_labels', version_instance=datasetVersion,
+                                     load_data=True)
+
+    nt.assert_equal(len(dataset), imported)
+    nt.assert_equal(len(dataset), CategoryLabel.select().where(CategoryLabel.version == datasetVersion).count())
+
+    # a version can be replaced by swapping in a staging table
+    imported = insert.insert_dataset(data=swapped, dataset='category_labels', version_instance=datasetVersion,
+                                     replace='swap')
+    nt.assert_equal(5, imported)
+    nt.assert_equal(5, CategoryLabel.select().where(CategoryLabel.version == datasetVersion).count())
+    nt.assert_true(_version_partition(datasetVersion.id) in _partitions(CategoryLabel))
+    nt.assert_false(db.execute_sql("SHOW TABLES LIKE 'category_labels_staging_%'").fetchall())
+
+    # tables made by create_tables have foreign keys, which are dropped to partition them
+    nt.assert_equal(3, len(_foreign_keys(ArticleCategory)))
+    links = [{'article': u'Futurama', 'category': u'Category:Futurama'},
+             {'article': u'Algebra', 'category': u'Category:Algebra'}]
+    imported = insert.insert_dataset(data=links, dataset='article_categories', version_instance=datasetVersion,
+                                     replace='swap')
+    nt.assert_equal(2, imported)
+    nt.assert_equal(2, ArticleCategory.select().where(ArticleCategory.version == datasetVersion).count())
+    nt.assert_equal([], _foreign_keys(ArticleCategory))
+    nt.assert_true(_version_partition(datasetVersion.id) in _partitions(ArticleCategory))
+
+    # and with the inserts on another connection
+    imported = insert.insert_dataset(data=pipelined, dataset='category_labels', version_instance=datasetVersion,
+                                     pipeline=True)
+
+    nt.assert_equal(len(dataset), imported)
+    nt.assert_equal(len(dataset), CategoryLabel.select().where(CategoryLabel.version == datasetVersion).count())
+
+    # a failed import still puts the session settings back
+    def broken():
+        yield {'category': u'Category:Futurama', 'label': u'Futurama'}
+        raise ValueError("broken dataset")
+    nt.assert_raises(ValueError, insert.insert_dataset, data=broken(), dataset='category_labels',
+                     version_instance=datasetVersion, bulk=True)
+    nt.assert_equal((1, 1, 1), db.execute_sql('SELECT @@autocommit, @@foreign_key_checks, @@unique_checks').fetchone())
+
 if __name__ == "__main__":
     import logging
     logging.basicConfig(level=logging.INFO)
@@ -2,7 +2,7 @@
 This file can connect to a MySQL database.
 """
 
-__all__ = ['connect', 'trap_warnings']
+__all__ = ['connect', 'connect_again', 'trap_warnings']
 
 import peewee
 import logging
@@ -14,11 +14,16 @@ DEFAULT_HOST = 'localhost'
 DEFAULT_PASSWORD = ''
 DEFAULT_PORT = 3306
 
-def connect(database, user=DEFAULT_USER, host=DEFAULT_HOST, password=DEFAULT_PASSWORD, port=DEFAULT_PORT):
+def connect(database, user=DEFAULT_USER, host=DEFAULT_HOST, password=DEFAULT_PASSWORD, port=DEFAULT_PORT,
+            local_infile=False):
+    """
+    Connects to a MySQL database, returning False if that fails.
+    With local_infile, the connection may send local files with LOAD DATA LOCAL INFILE.
+    """
     log.info("Connecting to '%s' on %s@%s:%d", database, user, host, port)
     db = peewee.MySQLDatabase(database,
                               user=user, host=host, passwd=password, port=port,
-                              autocommit=False)
+                              autocommit=False, local_infile=1 if local_infile else 0)
     # autocommit set to false for performance in bulk insert statements
 
     try:
@@ -29,6 +34,16 @@ def connect(database, user=DEFAULT_USER, host=DEFAULT_HOST, password=DEFAULT_PAS
 
     return db
 
+def connect_again(db):
+    """
+    Opens another connection to the same database as db
+    (which may be a models.database_proxy), with the same settings.
+    """
+    db = getattr(db, 'obj', db)
+    again = db.__class__(db.database, autocommit=db.autocommit, **db.connect_kwargs)
+    again.connect()
+    return again
+
 def trap_warnings():
     """
     Turn MySQL warnings into errors.
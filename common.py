@@ -7,15 +7,16 @@ from catdb.mysql import DEFAULT_PORT, DEFAULT_HOST, DEFAULT_USER
 from dbpedia import DEFAULT_LANGUAGE, DEFAULT_VERSION
 from dbpedia import resource
 
-def add_database_args(parser):
+def add_database_args(parser, required=True):
     """
     Add arguments to the argparse parser for connecting to a database.
     :param parser:
+    :param required: whether the database name must be given
     :return:
     """
 
     parser.add_argument("--database", "-d",
-                        required=True,
+                        required=required,
                         help="database name")
 
     parser.add_argument("--hostname", "-H",
@@ -6,7 +6,7 @@ __all__ = ['DBpediaResource', 'NTripleParser',
 from resource import DBpediaResource
 from ntparser import NTripleParser
 
-import urls, download, resource, ntparser, datasets
+import urls, manifest, download, bz2blocks, recordcache, resource, errors, instrument, ntparser, parallel, datasets, synthetic, testserver, prefetch, streaming, delta
 
 from datasets import DEFAULT_LANGUAGE, DEFAULT_VERSION
 
@@ -17,10 +17,7 @@ if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
     log = logging.getLogger('dbpedia')
 
-    # empty the cache before we begin
-    download.clean_all()
-
-    to_test = [urls, download, resource, ntparser, datasets]
+    to_test = [urls, manifest, download, bz2blocks, recordcache, resource, errors, instrument, ntparser, parallel, datasets, synthetic, testserver, prefetch, streaming, delta]
 
     for module in to_test:
         try:
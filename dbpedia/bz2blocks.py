@@ -0,0 +1,462 @@
+"""
+This file can decompress a bz2 file on several processes at once.
+
+A bz2 stream is a series of independently compressed blocks,
+each starting with a 48-bit magic number. The blocks are not
+byte-aligned, so the file is scanned for the magic number at
+every bit offset. Each block is then cut out, wrapped up as a
+complete single-block bz2 stream, and decompressed by a worker
+process. The results are stitched back together, in order,
+behind a file-like object.
+
+Either magic number can also turn up by chance inside a block.
+End of stream markers are checked against what must follow them,
+and blocks cut short by a bogus block marker are glued back together.
+If a block still can't be decompressed, the rest of the file
+is decompressed sequentially instead.
+"""
+
+__all__ = ['ParallelBZ2File', 'has_stream_end']
+
+import os
+import bz2
+import bz2file
+import multiprocessing
+from binascii import hexlify, unhexlify
+from collections import deque
+
+import logging
+log = logging.getLogger('dbpedia.bz2blocks')
+
+# marks the start of every compressed block
+BLOCK_MAGIC = 0x314159265359
+# marks the end of a bz2 stream
+EOS_MAGIC = 0x177245385090
+
+# how much of the compressed file to scan for block boundaries at once
+SCAN_SIZE = 8 * 1024 * 1024
+
+# the number of blocks per process that may be waiting to be decompressed or read
+BLOCKS_PER_PROCESS = 3
+
+# the most blocks we'll glue together when a block boundary turns out to be bogus
+MAX_MERGED_BLOCKS = 8
+
+# how much to decompress at a time after falling back to sequential decompression
+SEQUENTIAL_READ_SIZE = 1024 * 1024
+
+# seconds to wait for each block still in flight when the pool is closed
+CLOSE_TIMEOUT = 60
+
+def _shifted_patterns(magic):
+    """
+    For each of the 8 possible bit offsets of a 48-bit magic number
+    within a byte, gets the 5 bytes that are fully covered by it.
+    Returns a list of (bit shift, pattern) tuples.
+    """
+    patterns = []
+    for shift in range(8):
+        window = unhexlify('%014x' % (magic << (8 - shift)))
+        patterns.append((shift, window[1:6]))
+    return patterns
+
+_block_patterns = _shifted_patterns(BLOCK_MAGIC)
+_eos_patterns = _shifted_patterns(EOS_MAGIC)
+
+def _find_magic(data, magic, patterns):
+    """
+    Finds the bit offsets at which the magic number appears in data.
+    Only matches lying within the first len(data) - 7 bytes are returned.
+    """
+    found = []
+    limit = len(data) - 7
+    for shift, pattern in patterns:
+        index = data.find(pattern)
+        while index >= 0:
+            start = index - 1
+            if 0 <= start <= limit:
+                window = int(hexlify(data[start:start + 7]), 16)
+                if (window >> (8 - shift)) & 0xFFFFFFFFFFFF == magic:
+                    found.append(start * 8 + shift)
+            index = data.find(pattern, index + 1)
+    return found
+
+def _is_stream_end(f, bit):
+    """
+    Check if an end of stream marker at a bit offset of a file is real:
+    it is followed by the 32-bit stream crc and padding to a whole byte,
+    and then by the end of the file or the header of another stream.
+    """
+    f.seek((bit + 48 + 32 + 7) // 8)
+    header = f.read(4)
+    return not header or (header[:3] == 'BZh' and '1' <= header[3:] <= '9')
+
+def has_stream_end(filename):
+    """
+    Check if a bz2 file ends with a complete end of stream marker:
+    the marker, the stream crc, and padding to a whole byte.
+    Files that were cut off almost never do.
+    """
+    with open(filename, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        # the marker and crc take 80 bits, plus up to 7 bits of padding
+        f.seek(max(0, size - 16))
+        tail = f.read()
+
+    return any((bit + 80 + 7) // 8 == len(tail) for bit in _find_magic(tail, EOS_MAGIC, _eos_patterns))
+
+def _block_boundaries(filename):
+    """
+    Generates (start bit, end bit) tuples for each
+    compressed block in the file, in order.
+    """
+    current = None
+    base = 0
+    with open(filename, 'rb') as f, open(filename, 'rb') as check:
+        data = f.read(SCAN_SIZE)
+        while len(data) > 6:
+            markers = [(bit, True) for bit in _find_magic(data, BLOCK_MAGIC, _block_patterns)]
+            markers.extend((bit, False) for bit in _find_magic(data, EOS_MAGIC, _eos_patterns))
+            markers.sort()
+
+            for bit, is_block in markers:
+                bit += base * 8
+                if not is_block and not _is_stream_end(check, bit):
+                    # just some data that happens to look like the marker
+                    continue
+                if current is not None:
+                    yield current, bit
+                current = bit if is_block else None
+
+            # overlap the next chunk with the bytes we couldn't check yet
+            more = f.read(SCAN_SIZE)
+            if not more:
+                break
+            base += len(data) - 6
+            data = data[-6:] + more
+
+    if current is not None:
+        raise IOError("Compressed file %s ends in the middle of a block" % filename)
+
+def _decompress_block(filename, start, end):
+    """
+    Runs in a worker process.
+    Decompresses the bits from start to end of the file,
+    which should hold one or more whole compressed blocks.
+
+    Returns a (success, result) tuple, where the result is either
+    the decompressed data or an error message.
+    """
+    try:
+        first = start // 8
+        last = (end + 7) // 8
+        with open(filename, 'rb') as f:
+            f.seek(first)
+            data = f.read(last - first)
+
+        # cut out exactly the bits we want
+        bits = end - start
+        value = int(hexlify(data), 16) >> (last * 8 - end)
+        value &= (1 << bits) - 1
+
+        # the block crc follows the block magic
+        # for a single-block stream it is also the stream crc
+        crc = (value >> (bits - 80)) & 0xFFFFFFFF
+
+        value = (value << 80) | (EOS_MAGIC << 32) | crc
+        bits += 80
+
+        # pad out to a whole byte
+        padding = -bits % 8
+        value <<= padding
+        bits += padding
+
+        stream = 'BZh9' + unhexlify('%0*x' % (bits // 4, value))
+        return True, bz2.decompress(stream)
+    except Exception as e:
+        return False, str(e)
+
+class ParallelBZ2File(object):
+    """
+    A read-only file-like object for a bz2 file,
+    decompressed by a pool of worker processes.
+    Can be used in place of the files returned by bz2file.open().
+    """
+
+    def __init__(self, filename, processes=None):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+
+        self.filename = filename
+        self.in_flight = processes * BLOCKS_PER_PROCESS
+        self.boundaries = _block_boundaries(filename)
+        self.exhausted = False
+
+        # (start, end, result) for each submitted block, in order
+        self.pending = deque()
+
+        # decompressed data not read yet
+        self.buffer = ''
+        self.position = 0
+
+        # the number of decompressed bytes handed out by _next_block
+        self.produced = 0
+        # the file, if we had to fall back to decompressing it sequentially
+        self.sequential = None
+
+        log.info("Decompressing %s with %d processes", filename, processes)
+        self.pool = multiprocessing.Pool(processes)
+
+    def _fill(self):
+        """Submits blocks to the pool until enough are in flight."""
+        while not self.exhausted and len(self.pending) < self.in_flight:
+            try:
+                start, end = self.boundaries.next()
+            except StopIteration:
+                self.exhausted = True
+                break
+
+            result = self.pool.apply_async(_decompress_block, (self.filename, start, end))
+            self.pending.append((start, end, result))
+
+    def _next_block(self):
+        """Gets the next decompressed block, or '' at the end of the file."""
+        if self.sequential is not None:
+            return self.sequential.read(SEQUENTIAL_READ_SIZE)
+
+        try:
+            data = self._next_parallel_block()
+        except IOError as e:
+            log.warn("%s; decompressing the rest of %s sequentially", e, self.filename)
+            self._close_pool()
+            self._fall_back()
+            return self.sequential.read(SEQUENTIAL_READ_SIZE)
+
+        self.produced += len(data)
+        return data
+
+    def _fall_back(self):
+        """Opens the file for sequential decompression, skipping what was already decompressed."""
+        self.sequential = bz2file.open(self.filename, 'rb')
+
+        skip = self.produced
+        while skip > 0:
+            chunk = self.sequential.read(min(skip, SEQUENTIAL_READ_SIZE))
+            if not chunk:
+                raise IOError("Compressed file %s is shorter than the blocks already read" % self.filename)
+            skip -= len(chunk)
+
+    def _next_parallel_block(self):
+        """Gets the next block decompressed by the pool, or '' at the end of the file."""
+        self._fill()
+        if not self.pending:
+            return ''
+
+        start, end, result = self.pending.popleft()
+        success, data = result.get()
+
+        # the magic number can turn up by chance inside a block,
+        # in which case the real block spans the following piece(s)
+        merged = 1
+        while not success and merged < MAX_MERGED_BLOCKS:
+            self._fill()
+            if not self.pending:
+                break
+
+            # the piece's own result is no use, but it has to arrive before the pool can be closed
+            _, end, piece = self.pending.popleft()
+            piece.wait()
+            merged += 1
+            success, data = _decompress_block(self.filename, start, end)
+
+        if not success:
+            raise IOError("Could not decompress the block at bit %d of %s: %s" % (start, self.filename, data))
+
+        return data
+
+    def read(self, size=-1):
+        chunks = [self.buffer[self.position:]]
+        available = len(chunks[0])
+
+        while size < 0 or available < size:
+            block = self._next_block()
+            if not block:
+                break
+            chunks.append(block)
+            available += len(block)
+
+        data = ''.join(chunks)
+        if size < 0 or len(data) <= size:
+            self.buffer = ''
+            self.position = 0
+            return data
+
+        self.buffer = data
+        self.position = size
+        return data[:size]
+
+    def readline(self):
+        end = self.buffer.find('\n', self.position)
+        if end >= 0:
+            line = self.buffer[self.position:end + 1]
+            self.position = end + 1
+            return line
+
+        # the line continues into the next block(s)
+        chunks = [self.buffer[self.position:]]
+        while True:
+            block = self._next_block()
+            if not block:
+                self.buffer = ''
+                self.position = 0
+                return ''.join(chunks)
+
+            end = block.find('\n')
+            if end >= 0:
+                chunks.append(block[:end + 1])
+                self.buffer = block
+                self.position = end + 1
+                return ''.join(chunks)
+
+            chunks.append(block)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def _close_pool(self):
+        if self.pool is not None:
+            # terminating the pool while a worker is still sending back
+            # a block can deadlock it, so let the blocks in flight finish
+            for start, end, result in self.pending:
+                result.wait(CLOSE_TIMEOUT)
+            self.pending.clear()
+
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def close(self):
+        self._close_pool()
+        if self.sequential is not None:
+            self.sequential.close()
+            self.sequential = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type=None, exc_val=None, exc_tb=None):
+        self.close()
+
+def _test():
+    global _block_boundaries, _find_magic
+
+    import nose.tools as nt
+    import os
+    import random
+    import tempfile
+
+    # a few hundred kB of somewhat repetitive lines
+    rand = random.Random(7)
+    lines = ['<http://dbpedia.org/resource/Article_%d> <http://purl.org/dc/terms/subject> '
+             '<http://dbpedia.org/resource/Category:Category_%d> .\n' % (rand.randint(0, 10 ** 6), rand.randint(0, 1000))
+             for i in range(6000)]
+    text = ''.join(lines)
+
+    fd, filename = tempfile.mkstemp(suffix='.bz2')
+    try:
+        # small blocks, and two streams stuck together
+        half = len(text) // 2
+        with os.fdopen(fd, 'wb') as f:
+            f.write(bz2.compress(text[:half], 1))
+            f.write(bz2.compress(text[half:], 1))
+
+        boundaries = list(_block_boundaries(filename))
+        nt.ok_(len(boundaries) > 4)
+
+        # the end of the file is found, unless it was cut off
+        nt.ok_(has_stream_end(filename))
+        with open(filename, 'rb') as f:
+            compressed = f.read()
+        for size in [len(compressed) - 1, len(compressed) - 5, len(compressed) // 2]:
+            with open(filename + '.cut', 'wb') as f:
+                f.write(compressed[:size])
+            nt.ok_(not has_stream_end(filename + '.cut'))
+        os.remove(filename + '.cut')
+
+        with ParallelBZ2File(filename, processes=2) as f:
+            nt.eq_(text, f.read())
+
+        with ParallelBZ2File(filename, processes=2) as f:
+            nt.eq_(lines[0], f.readline())
+            nt.eq_(text[len(lines[0]):len(lines[0]) + 10], f.read(10))
+            nt.eq_(lines[1][10:], f.readline())
+            nt.eq_(lines[2:], list(f))
+
+        # pretend the magic number turned up inside a block
+        original = _block_boundaries
+        def bogus_boundaries(filename):
+            for start, end in original(filename):
+                middle = (start + end) // 2
+                yield start, middle
+                yield middle, end
+
+        _block_boundaries = bogus_boundaries
+        try:
+            with ParallelBZ2File(filename, processes=2) as f:
+                nt.eq_(text, f.read())
+        finally:
+            _block_boundaries = original
+
+        # or the end of stream marker did, in the middle of the second block
+        chance_eos = (boundaries[1][0] + boundaries[1][1]) // 2
+        original_find = _find_magic
+        def find_chance_eos(data, magic, patterns):
+            found = original_find(data, magic, patterns)
+            if magic == EOS_MAGIC and len(data) * 8 > chance_eos:
+                found.append(chance_eos)
+            return found
+
+        _find_magic = find_chance_eos
+        try:
+            nt.eq_(boundaries, list(_block_boundaries(filename)))
+            with ParallelBZ2File(filename, processes=2) as f:
+                nt.eq_(text, f.read())
+        finally:
+            _find_magic = original_find
+
+        # blocks that can't be decompressed are read sequentially instead
+        def broken_boundaries(filename):
+            for i, (start, end) in enumerate(original(filename)):
+                if i == 3:
+                    yield start + 8, end
+                else:
+                    yield start, end
+
+        _block_boundaries = broken_boundaries
+        try:
+            with ParallelBZ2File(filename, processes=2) as f:
+                nt.eq_(lines[0], f.readline())
+                nt.eq_(text[len(lines[0]):], f.read())
+                nt.ok_(f.sequential is not None)
+        finally:
+            _block_boundaries = original
+    finally:
+        os.remove(filename)
+
+if __name__ == "__main__":
+    import logging
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        _test()
+        logging.info("Tests Passed")
+    except AssertionError as e:
+        logging.error("ERROR: TESTS FAILED")
+        logging.error(e)
@@ -3,28 +3,167 @@ This file is responsible for cleaning garbage we don't care about off the
 triples provided by DBpedia. For example, url bases.
 """
 
-__all__ = ['get_collection', 'DEFAULT_VERSION', 'DEFAULT_LANGUAGE']
+__all__ = ['get_collection', 'url_base', 'DEFAULT_VERSION', 'DEFAULT_LANGUAGE']
 
+import re
+import time
 import urllib
-from resource import DBpediaResource
-from ntparser import NTripleParser
+from string import Template
+from resource import DBpediaResource, version_names
+from ntparser import NTripleParser, CHUNK_LINES
+from parallel import parallel_batches
+from errors import ErrorSink
+import recordcache
 
 DEFAULT_VERSION = '3.9'
 DEFAULT_LANGUAGE = 'en'
 DEFAULT_URL_BASE = "http://dbpedia.org/resource/"
+# the resource prefix used by the other language editions, from LOCALIZED_SINCE on
+language_url_base_template = Template("http://${language}.dbpedia.org/resource/")
+LOCALIZED_SINCE = '3.7'
+# any dbpedia resource prefix, for files that don't use the one we expected
+_any_url_base = re.compile(r'http://([a-z-]+\.)?dbpedia\.org/resource/')
+# the number of decoded urls kept by a UrlDecoder
+DECODER_CACHE_LIMIT = 200000
+
+def url_base(language=DEFAULT_LANGUAGE, version=DEFAULT_VERSION):
+    """
+    Gets the prefix of the resource urls in the files
+    for a language edition of a dbpedia version.
+    :param language:
+    :param version:
+    :return:
+    """
+    localized = version_names[:version_names.index(LOCALIZED_SINCE) + 1]
+    if language == 'en' or version not in localized:
+        return DEFAULT_URL_BASE
+
+    return language_url_base_template.substitute(language=language)
 
 def decode_url(url, version=DEFAULT_VERSION):
     return urllib.unquote(url)
 
+def _strip_other_base(url):
+    match = _any_url_base.match(url)
+    if match is None:
+        raise Exception("Unexpected URL %s" % url)
+    return url[match.end():]
+
 def url_last_part(url, url_base=DEFAULT_URL_BASE):
+    if url_base is None:
+        url_base = DEFAULT_URL_BASE
+
     if not url.startswith(url_base):
-        raise Exception("Unexpected URL %s" % url)
+        return decode_url(_strip_other_base(url))
 
     return decode_url(url[len(url_base):])
 
+def url_last_parts(urls, url_base=DEFAULT_URL_BASE):
+    """The same as url_last_part, for a list of urls"""
+    if url_base is None:
+        url_base = DEFAULT_URL_BASE
+
+    start = len(url_base)
+    names = []
+    for url in urls:
+        if url.startswith(url_base):
+            names.append(urllib.unquote(url[start:]))
+        else:
+            names.append(urllib.unquote(_strip_other_base(url)))
+    return names
+
+class UrlDecoder(object):
+    """
+    A memoizing version of url_last_part, for urls that
+    repeat a lot (like the categories in article_categories).
+
+    Keeps up to limit decoded names in two generations: when the
+    current one fills up, it becomes the previous one, and the names
+    only in the old previous one are forgotten. Names found in the
+    previous generation move to the current one, so names that keep
+    coming up stay cached.
+
+    Names are cached by their whole url, so urls with different bases
+    (from different language editions) can share a decoder.
+    """
+
+    def __init__(self, limit=DECODER_CACHE_LIMIT, url_base=DEFAULT_URL_BASE):
+        self.limit = limit
+        self.url_base = url_base
+
+        # names used since the last turnover, and the ones from before it
+        self.cache = {}
+        self.previous = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.cache) + len(self.previous)
+
+    def _turn_over(self):
+        self.evictions += len(self.previous)
+        self.previous = self.cache
+        self.cache = {}
+
+    def decode(self, url, url_base=None):
+        name = self.cache.get(url)
+        if name is not None:
+            self.hits += 1
+            return name
+
+        return self.decode_batch([url], url_base)[0]
+
+    def decode_batch(self, urls, url_base=None):
+        """Decodes a list of urls, returning a list of names"""
+        if url_base is None:
+            url_base = self.url_base
+
+        generation_limit = max(1, self.limit // 2)
+        cache = self.cache
+        previous = self.previous
+        names = []
+        misses = 0
+
+        for url in urls:
+            name = cache.get(url)
+            if name is None:
+                name = previous.pop(url, None)
+                if name is None:
+                    name = url_last_part(url, url_base)
+                    misses += 1
+
+                if len(cache) >= generation_limit:
+                    self._turn_over()
+                    cache = self.cache
+                    previous = self.previous
+                cache[url] = name
+
+            names.append(name)
+
+        self.hits += len(urls) - misses
+        self.misses += misses
+        return names
+
+    def describe(self):
+        total = self.hits + self.misses
+        percent = 100.0 * self.hits / total if total else 0.0
+        return "%d hits, %d misses (%.1f%% hits), %d evicted" % (self.hits, self.misses, percent, self.evictions)
+
+# shared by the iterators that see the same categories over and over
+category_decoder = UrlDecoder()
+
 class ArticleCategoriesIterator(object):
-    def __init__(self, records):
+    # the keys of each record, in order
+    fields = ('article', 'category')
+    # every line is expected to be a "subject" relation, so none are skipped by the parser
+    predicates = None
+    # for the categories
+    decoder = category_decoder
+
+    def __init__(self, records, url_base=DEFAULT_URL_BASE):
         self.records = records
+        self.url_base = url_base
 
     def __iter__(self):
         return self
@@ -36,17 +175,43 @@ class ArticleCategoriesIterator(object):
         # we expect the predicate to be "subject" in some form or other
         assert predicate.endswith("subject")
 
-        article = url_last_part(subject)
-        category = url_last_part(object)
+        article = url_last_part(subject, self.url_base)
+        category = self.decoder.decode(object, self.url_base)
 
         return {
             "article": article,
             "category": category
         }
 
+    @classmethod
+    def convert_batch(cls, triples, compact=False, url_base=DEFAULT_URL_BASE):
+        """
+        Converts a list of triples into a list of records.
+        If compact is True, the records are tuples in fields order.
+        """
+        for subject, predicate, object in triples:
+            assert predicate.endswith("subject")
+
+        articles = url_last_parts([triple[0] for triple in triples], url_base)
+        categories = cls.decoder.decode_batch([triple[2] for triple in triples], url_base)
+
+        if compact:
+            return zip(articles, categories)
+
+        return [{"article": article, "category": category}
+                for article, category in zip(articles, categories)]
+
 class CategoryLabelIterator(object):
-    def __init__(self, records):
+    # the keys of each record, in order
+    fields = ('category', 'label')
+    # every line is expected to be a "label", so none are skipped by the parser
+    predicates = None
+    # each category appears once, so memoizing would not help
+    decoder = None
+
+    def __init__(self, records, url_base=DEFAULT_URL_BASE):
         self.records = records
+        self.url_base = url_base
 
     def __iter__(self):
         return self
@@ -58,7 +223,7 @@ class CategoryLabelIterator(object):
         # we expect the predicate to be "label" in some form or other
         assert predicate.endswith("label")
 
-        category = url_last_part(subject)
+        category = url_last_part(subject, self.url_base)
         label = object
 
         return {
@@ -66,9 +231,35 @@ class CategoryLabelIterator(object):
             "label": label
         }
 
+    @classmethod
+    def convert_batch(cls, triples, compact=False, url_base=DEFAULT_URL_BASE):
+        """
+        Converts a list of triples into a list of records.
+        If compact is True, the records are tuples in fields order.
+        """
+        for subject, predicate, object in triples:
+            assert predicate.endswith("label")
+
+        categories = url_last_parts([triple[0] for triple in triples], url_base)
+        labels = [triple[2] for triple in triples]
+
+        if compact:
+            return zip(categories, labels)
+
+        return [{"category": category, "label": label}
+                for category, label in zip(categories, labels)]
+
 class CategoryCategoryIterator(object):
-    def __init__(self, records):
+    # the keys of each record, in order
+    fields = ('narrower', 'broader')
+    # the parser can skip lines without these predicates
+    predicates = ('broader',)
+    # for both narrower and broader categories
+    decoder = category_decoder
+
+    def __init__(self, records, url_base=DEFAULT_URL_BASE):
         self.records = records
+        self.url_base = url_base
 
     def __iter__(self):
         return self
@@ -84,31 +275,164 @@ class CategoryCategoryIterator(object):
             if predicate.endswith("broader"):
                 found_broader = True
 
-        narrower = url_last_part(subject)
-        broader = url_last_part(object)
+        narrower = self.decoder.decode(subject, self.url_base)
+        broader = self.decoder.decode(object, self.url_base)
 
         return {
             "narrower": narrower,
             "broader": broader
         }
 
+    @classmethod
+    def convert_batch(cls, triples, compact=False, url_base=DEFAULT_URL_BASE):
+        """
+        Converts a list of triples into a list of records, keeping only 'broader' relations.
+        If compact is True, the records are tuples in fields order.
+        """
+        triples = [triple for triple in triples if triple[1].endswith("broader")]
+
+        decode_batch = cls.decoder.decode_batch
+        pairs = zip(decode_batch([triple[0] for triple in triples], url_base),
+                    decode_batch([triple[2] for triple in triples], url_base))
+
+        if compact:
+            return pairs
+
+        return [{"narrower": narrower, "broader": broader} for narrower, broader in pairs]
+
+class BatchIterator(object):
+    """
+    Turns an iterator over lists of triples into an iterator
+    over lists of records, using the convert_batch() function
+    of one of the record iterators above.
+    """
+
+    def __init__(self, batches, iteratorClass, stats=None, compact=False, url_base=DEFAULT_URL_BASE):
+        self.batches = batches
+        self.convert_batch = iteratorClass.convert_batch
+        self.stats = stats
+        self.compact = compact
+        self.url_base = url_base
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        records = []
+        # skip over batches where nothing was kept
+        while not records:
+            # this will throw StopIteration for us if we are out of batches
+            triples = self.batches.next()
+
+            before = time.time()
+            records = self.convert_batch(triples, self.compact, self.url_base)
+            if self.stats is not None:
+                self.stats.add('decode', time.time() - before, len(triples))
+
+        return records
+
 class TripleCollection(object):
 
-    def __init__(self, resource, iteratorClass):
+    def __init__(self, resource, iteratorClass, processes=None, ordered=True,
+                 decompress_processes=None, mmap=False, record_cache=False, errors=None,
+                 stats=None, compact=False, stream=False):
+        """
+        If processes is more than 1, batches() will parse
+        the file on that many worker processes. Batches will then
+        come back in file order only if ordered is True.
+
+        If decompress_processes is more than 1, the file will
+        be decompressed on that many worker processes.
+
+        If mmap is True, decompressed files from the cache are memory-mapped.
+
+        If stream is True, files that aren't cached yet are parsed while they download.
+
+        Resource urls are expected to start with the url_base() of the resource's language and version.
+
+        If record_cache is True, records are loaded from the binary record
+        cache when possible, and saved there after a complete pass through batches().
+
+        Parse errors are reported to errors, an ErrorSink, if given.
+
+        The time spent in each stage is added to stats, a PipelineStats, if given.
+
+        If compact is True, batches() gives records as tuples in the
+        order of the fields attribute, rather than as dictionaries.
+        """
         self.resource = resource
         self.iteratorClass = iteratorClass
+        self.url_base = url_base(resource.language, resource.version)
+        self.fields = iteratorClass.fields
+        self.compact = compact
+        self.processes = processes
+        self.ordered = ordered
+        self.decompress_processes = decompress_processes
+        self.mmap = mmap
+        self.stream = stream
+        self.record_cache = record_cache
+
+        if errors is None:
+            errors = ErrorSink()
+        self.errors = errors
+        self.stats = stats
 
     def __enter__(self):
-        self.resource_file = self.resource.get_file()
-        self.resource_file.__enter__()
+        self.resource_file = None
+        self.record_table = None
+
+        self.errors.source = "%s_%s_%s" % (self.resource.dataset, self.resource.language, self.resource.version)
+
+        before = time.time()
+
+        if self.record_cache and recordcache.exists(self.resource):
+            self.record_table = recordcache.load(self.resource)
+        else:
+            self.resource_file = self.resource.get_file(processes=self.decompress_processes, mmap=self.mmap,
+                                                       stream=self.stream)
+            self.resource_file.__enter__()
+
+        # downloading, or loading cached records
+        if self.stats is not None:
+            self.stats.add('retrieve', time.time() - before)
+
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.resource_file.__exit__()
+        if self.resource_file is not None:
+            self.resource_file.__exit__()
 
     def __iter__(self):
-        parser = NTripleParser(self.resource_file)
-        return self.iteratorClass(parser.__iter__())
+        if self.record_table is not None:
+            return self.record_table.records()
+
+        parser = NTripleParser(self.resource_file, predicates=self.iteratorClass.predicates,
+                               errors=self.errors)
+        return self.iteratorClass(parser.__iter__(), self.url_base)
+
+    def batches(self, size=CHUNK_LINES):
+        """
+        Iterate over lists of records, parsed from
+        chunks of up to size lines at a time.
+        """
+        if self.record_table is not None:
+            return self.record_table.batches(size, compact=self.compact)
+
+        if self.processes is not None and self.processes > 1:
+            batches = parallel_batches(self.resource_file, self.iteratorClass,
+                                       processes=self.processes, ordered=self.ordered, lines=size,
+                                       errors=self.errors, stats=self.stats, compact=self.compact,
+                                       url_base=self.url_base)
+        else:
+            parser = NTripleParser(self.resource_file, predicates=self.iteratorClass.predicates,
+                                   errors=self.errors, stats=self.stats)
+            batches = BatchIterator(parser.iter_batches(size), self.iteratorClass,
+                                    stats=self.stats, compact=self.compact, url_base=self.url_base)
+
+        if self.record_cache:
+            return recordcache.Recorder(self.resource, batches, self.iteratorClass.fields)
+
+        return batches
 
 iterator_mapping = {
     'article_categories': ArticleCategoriesIterator,
@@ -116,7 +440,9 @@ iterator_mapping = {
     'category_labels': CategoryLabelIterator
 }
 
-def get_collection(resource=None, dataset=None, version=DEFAULT_VERSION, language=DEFAULT_LANGUAGE):
+def get_collection(resource=None, dataset=None, version=DEFAULT_VERSION, language=DEFAULT_LANGUAGE,
+                   processes=None, ordered=True, decompress_processes=None, mmap=False,
+                   record_cache=False, errors=None, stats=None, compact=False, stream=False):
     if resource is None:
         if dataset not in iterator_mapping:
             raise Exception("No iterator for %s" % dataset)
@@ -125,38 +451,14 @@ def get_collection(resource=None, dataset=None, version=DEFAULT_VERSION, languag
     else:
         iterator = iterator_mapping[resource.dataset]
 
-    return TripleCollection(resource, iterator)
+    return TripleCollection(resource, iterator, processes=processes, ordered=ordered,
+                            decompress_processes=decompress_processes, mmap=mmap,
+                            record_cache=record_cache, errors=errors, stats=stats,
+                            compact=compact, stream=stream)
 
 def _test():
     import nose.tools as nt
-
-    expectation = [
-        {'category': u'Category:Futurama', 'label': u'Futurama'},
-        {'category': u'Category:World_War_II', 'label': u'World War II'},
-        {'category': u'Category:Programming_languages', 'label': u'Programming languages'},
-        {'category': u'Category:Professional_wrestling', 'label': u'Professional wrestling'},
-        {'category': u'Category:Algebra', 'label': u'Algebra'},
-        {'category': u'Category:Anime', 'label': u'Anime'},
-        {'category': u'Category:Abstract_algebra', 'label': u'Abstract algebra'},
-        {'category': u'Category:Mathematics', 'label': u'Mathematics'},
-        {'category': u'Category:Linear_algebra', 'label': u'Linear algebra'},
-        {'category': u'Category:Calculus', 'label': u'Calculus'},
-        {'category': u'Category:Monarchs', 'label': u'Monarchs'},
-        {'category': u'Category:British_monarchs', 'label': u'British monarchs'},
-    ]
-
-    pairs = 0
-    with get_collection('category_labels') as data:
-
-        for idx, record in enumerate(data):
-            nt.eq_(record, expectation[idx])
-
-            pairs += 1
-
-            if idx == len(expectation) - 1:
-                break
-
-    nt.eq_(len(expectation), pairs)
+    from instrument import PipelineStats
 
     # Test some urls with slashes in them
     tripleTest = [
@@ -187,6 +489,108 @@ def _test():
 
     nt.eq_(pairs, len(expectation))
 
+    # the batch version should produce the same records
+    stats = PipelineStats()
+    batches = BatchIterator([tripleTest[:4], tripleTest[4:]].__iter__(), CategoryLabelIterator, stats=stats)
+    nt.eq_(expectation, [record for batch in batches for record in batch])
+    nt.eq_(len(tripleTest), stats.stage('decode').items)
+
+    # repeated urls are only decoded once
+    decoder = UrlDecoder(limit=4)
+    url = lambda name: 'http://dbpedia.org/resource/Category:%s' % name
+    urls = [url('Caf%C3%A9s'), url('A'), url('Caf%C3%A9s')]
+    nt.eq_(url_last_parts(urls), decoder.decode_batch(urls))
+    nt.eq_('Category:Caf\xc3\xa9s', decoder.decode(urls[0]))
+    nt.eq_((2, 2, 0), (decoder.hits, decoder.misses, decoder.evictions))
+
+    # but the cache does not grow past its limit, and keeps the names still in use
+    nt.eq_(['Category:B', 'Category:A'], decoder.decode_batch([url('B'), url('A')]))
+    nt.eq_(['Category:C', 'Category:A'], decoder.decode_batch([url('C'), url('A')]))
+    nt.eq_((4, 4, 1), (decoder.hits, decoder.misses, decoder.evictions))
+    nt.eq_(3, len(decoder))
+    nt.eq_('Category:Caf\xc3\xa9s', decoder.decode(urls[0]))
+    nt.eq_(5, decoder.misses)
+    nt.assert_raises(Exception, decoder.decode, 'http://example.com/Category:C')
+
+    # the iterators use the decoder of their class
+    ArticleCategoriesIterator.decoder = decoder
+    try:
+        nt.eq_([('Category:Caf\xc3\xa9s', 'Category:D')], ArticleCategoriesIterator.convert_batch(
+            [(url('Caf%C3%A9s'), 'http://purl.org/dc/terms/subject', url('D'))], compact=True))
+        nt.eq_(6, decoder.misses)
+    finally:
+        ArticleCategoriesIterator.decoder = category_decoder
+
+    # the batch converters give the same records as the iterators
+    triples = [
+        ('http://dbpedia.org/resource/Albedo', 'http://purl.org/dc/terms/subject', 'http://dbpedia.org/resource/Category:Climate_forcing'),
+        ('http://dbpedia.org/resource/Caf%C3%A9', 'http://purl.org/dc/terms/subject', 'http://dbpedia.org/resource/Category:Climate_forcing'),
+    ]
+    nt.eq_(list(ArticleCategoriesIterator(triples.__iter__())), ArticleCategoriesIterator.convert_batch(triples))
+
+    # or as tuples, in fields order
+    examples = [
+        (ArticleCategoriesIterator, triples),
+        (CategoryLabelIterator, tripleTest[:1]),
+        (CategoryCategoryIterator, tripleTest),
+    ]
+    for iteratorClass, triples in examples:
+        records = iteratorClass.convert_batch(triples)
+        nt.eq_([tuple(record[f] for f in iteratorClass.fields) for record in records],
+               iteratorClass.convert_batch(triples, compact=True))
+
+    # other language editions have their own url base
+    nt.eq_(DEFAULT_URL_BASE, url_base('en', '3.9'))
+    nt.eq_('http://de.dbpedia.org/resource/', url_base('de', '3.9'))
+    nt.eq_(DEFAULT_URL_BASE, url_base('de', '3.6'))
+    triples = [
+        ('http://de.dbpedia.org/resource/Caf%C3%A9', 'http://purl.org/dc/terms/subject', 'http://de.dbpedia.org/resource/Kategorie:Kaffeehaus'),
+        ('http://dbpedia.org/resource/Tee', 'http://purl.org/dc/terms/subject', 'http://de.dbpedia.org/resource/Kategorie:Tee'),
+    ]
+    expected = [('Caf\xc3\xa9', 'Kategorie:Kaffeehaus'), ('Tee', 'Kategorie:Tee')]
+    nt.eq_(expected, ArticleCategoriesIterator.convert_batch(triples, compact=True, url_base=url_base('de')))
+    nt.eq_(expected, [(r['article'], r['category']) for r in
+                      ArticleCategoriesIterator(triples.__iter__(), url_base('de'))])
+    batches = BatchIterator([triples].__iter__(), ArticleCategoriesIterator, compact=True, url_base=url_base('de'))
+    nt.eq_([expected], list(batches))
+
+    # batches with nothing left in them are skipped
+    tripleTest = [
+        ('http://dbpedia.org/resource/Category:Futurama', 'http://www.w3.org/2000/01/rdf-schema#label', 'Futurama'),
+        ('http://dbpedia.org/resource/Category:Futurama', 'http://www.w3.org/2004/02/skos/core#broader', 'http://dbpedia.org/resource/Category:Animated_television_series'),
+    ]
+    batches = BatchIterator([tripleTest[:1], tripleTest[1:]].__iter__(), CategoryCategoryIterator)
+    nt.eq_([[{'narrower': 'Category:Futurama', 'broader': 'Category:Animated_television_series'}]], list(batches))
+
+    # the first few records of the real dataset (downloading it if needed)
+    expectation = [
+        {'category': u'Category:Futurama', 'label': u'Futurama'},
+        {'category': u'Category:World_War_II', 'label': u'World War II'},
+        {'category': u'Category:Programming_languages', 'label': u'Programming languages'},
+        {'category': u'Category:Professional_wrestling', 'label': u'Professional wrestling'},
+        {'category': u'Category:Algebra', 'label': u'Algebra'},
+        {'category': u'Category:Anime', 'label': u'Anime'},
+        {'category': u'Category:Abstract_algebra', 'label': u'Abstract algebra'},
+        {'category': u'Category:Mathematics', 'label': u'Mathematics'},
+        {'category': u'Category:Linear_algebra', 'label': u'Linear algebra'},
+        {'category': u'Category:Calculus', 'label': u'Calculus'},
+        {'category': u'Category:Monarchs', 'label': u'Monarchs'},
+        {'category': u'Category:British_monarchs', 'label': u'British monarchs'},
+    ]
+
+    pairs = 0
+    with get_collection(dataset='category_labels') as data:
+
+        for idx, record in enumerate(data):
+            nt.eq_(record, expectation[idx])
+
+            pairs += 1
+
+            if idx == len(expectation) - 1:
+                break
+
+    nt.eq_(len(expectation), pairs)
+
 if __name__ == "__main__":
     import logging
     logging.basicConfig(level=logging.INFO)
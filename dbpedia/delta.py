@@ -0,0 +1,283 @@
+"""
+This file computes the changes in a pair dataset (category_categories
+or article_categories) between two dbpedia versions.
+
+The pairs of each version are sorted with an external merge sort:
+they are cut into runs of limited size, each run is sorted in memory
+and written to a temporary file, and the runs are merged back
+together with heapq.merge. Walking the two sorted streams side by
+side gives the added and removed pairs, which are written to delta
+files, so memory use is bounded by the run size.
+
+Delta files have one pair per line, utf-8 encoded and tab separated,
+with backslashes, tabs and newlines escaped. read_delta() reads them back.
+"""
+
+__all__ = ['compute_delta', 'write_delta', 'read_delta', 'delta_filenames', 'PAIR_DATASETS']
+
+import os
+import re
+import heapq
+import shutil
+import tempfile
+import itertools
+from string import Template
+
+from datasets import get_collection
+
+import logging
+log = logging.getLogger('dbpedia.delta')
+
+# the datasets made of pairs of names
+PAIR_DATASETS = ['category_categories', 'article_categories']
+# the most pairs sorted in memory at once
+RUN_SIZE = 1000000
+# template for the names of delta files, inside the output directory
+delta_file_template = Template('${dataset}_${language}_${old}_${new}.${change}.tsv')
+
+_escapes = {'\\': '\\\\', '\t': '\\t', '\n': '\\n'}
+_unescapes = dict((escaped[1], character) for character, escaped in _escapes.items())
+
+def _escape(name):
+    # hardly any names need it
+    if '\\' in name or '\t' in name or '\n' in name:
+        return re.sub(r'[\\\t\n]', lambda m: _escapes[m.group()], name)
+    return name
+
+def _unescape(name):
+    if '\\' in name:
+        return re.sub(r'\\(.)', lambda m: _unescapes[m.group(1)], name)
+    return name
+
+def _encode(pair):
+    """Turns a pair of names into a line of bytes, which sort the same way in every run"""
+    return ('\t'.join(_escape(name) for name in pair) + '\n').encode('utf-8')
+
+def _decode(line):
+    return tuple(_unescape(name) for name in line.rstrip('\n').decode('utf-8').split('\t'))
+
+def _write_run(lines, tempdir):
+    """Sorts some lines, writing them (without duplicates) to a temporary file"""
+    lines.sort()
+    f = tempfile.NamedTemporaryFile(mode='wb', dir=tempdir, suffix='.run', delete=False)
+    with f:
+        f.writelines(line for line, group in itertools.groupby(lines))
+    return f.name
+
+def _sorted_runs(pairs, run_size, tempdir):
+    """Writes the pairs to sorted run files, returning their names"""
+    runs = []
+    lines = []
+    for pair in pairs:
+        lines.append(_encode(pair))
+        if len(lines) >= run_size:
+            runs.append(_write_run(lines, tempdir))
+            lines = []
+
+    if lines or not runs:
+        runs.append(_write_run(lines, tempdir))
+
+    return runs
+
+def _merge_runs(runs):
+    """Generates the lines of the sorted runs, in order, without duplicates"""
+    files = [open(run, 'rb') for run in runs]
+    try:
+        previous = None
+        for line in heapq.merge(*files):
+            if line != previous:
+                yield line
+                previous = line
+    finally:
+        for f in files:
+            f.close()
+
+def _diff(old, new):
+    """
+    Walks two sorted streams of unique lines, generating
+    (change, line) tuples where change is 'added', 'removed' or 'unchanged'.
+    """
+    old_line = next(old, None)
+    new_line = next(new, None)
+    while old_line is not None or new_line is not None:
+        if new_line is None or (old_line is not None and old_line < new_line):
+            yield 'removed', old_line
+            old_line = next(old, None)
+        elif old_line is None or new_line < old_line:
+            yield 'added', new_line
+            new_line = next(new, None)
+        else:
+            yield 'unchanged', old_line
+            old_line = next(old, None)
+            new_line = next(new, None)
+
+def write_delta(old_pairs, new_pairs, added_filename, removed_filename, run_size=RUN_SIZE, tempdir=None):
+    """
+    Writes the pairs in new_pairs but not old_pairs to added_filename,
+    and the pairs in old_pairs but not new_pairs to removed_filename.
+    Pairs are tuples of unicode names; each is read only once.
+
+    :param old_pairs:
+    :param new_pairs:
+    :param added_filename:
+    :param removed_filename:
+    :param run_size: the most pairs held in memory at once
+    :param tempdir: where to keep the sorted runs
+    :return: a dictionary of the number of pairs added, removed, and unchanged
+    """
+    workdir = tempfile.mkdtemp(prefix='delta-', dir=tempdir)
+    counts = {'added': 0, 'removed': 0, 'unchanged': 0}
+    try:
+        old_runs = _sorted_runs(old_pairs, run_size, workdir)
+        new_runs = _sorted_runs(new_pairs, run_size, workdir)
+        log.info("Sorted pairs into %d + %d runs", len(old_runs), len(new_runs))
+
+        with open(added_filename, 'wb') as added, open(removed_filename, 'wb') as removed:
+            outputs = {'added': added, 'removed': removed}
+            for change, line in _diff(_merge_runs(old_runs), _merge_runs(new_runs)):
+                counts[change] += 1
+                if change in outputs:
+                    outputs[change].write(line)
+    finally:
+        shutil.rmtree(workdir)
+
+    return counts
+
+def read_delta(filename):
+    """
+    Generates the pairs in a delta file, as tuples of unicode names, in sorted order.
+
+    :param filename:
+    :return:
+    """
+    with open(filename, 'rb') as f:
+        for line in f:
+            yield _decode(line)
+
+def delta_filenames(directory, dataset, language, old_version, new_version):
+    """
+    Gets the names of the added and removed files for a delta.
+
+    :return: an (added, removed) tuple
+    """
+    return tuple(os.path.join(directory, delta_file_template.substitute(dataset=dataset, language=language,
+                                                                        old=old_version, new=new_version,
+                                                                        change=change))
+                 for change in ('added', 'removed'))
+
+def _pairs(collection):
+    with collection as data:
+        for batch in data.batches():
+            for pair in batch:
+                yield pair
+
+def compute_delta(dataset, old_version, new_version, language, directory,
+                  run_size=RUN_SIZE, tempdir=None, **collection_args):
+    """
+    Computes the pairs added and removed in a dataset from one version to the next,
+    writing them to delta files in the directory (see delta_filenames).
+    Other arguments are passed on to datasets.get_collection.
+
+    :return: a dictionary of the number of pairs added, removed, and unchanged
+    """
+    if dataset not in PAIR_DATASETS:
+        raise Exception("Can't compute deltas of %s" % dataset)
+
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    old = get_collection(dataset=dataset, version=old_version, language=language,
+                         compact=True, **collection_args)
+    new = get_collection(dataset=dataset, version=new_version, language=language,
+                         compact=True, **collection_args)
+
+    added_filename, removed_filename = delta_filenames(directory, dataset, language, old_version, new_version)
+    return write_delta(_pairs(old), _pairs(new), added_filename, removed_filename,
+                       run_size=run_size, tempdir=tempdir)
+
+def _test():
+    import nose.tools as nt
+    import random
+    import synthetic
+    from ntparser import NTripleParser
+    from datasets import iterator_mapping
+
+    # escaping survives the round trip
+    pairs = [(u'a\tb', u'c\\d'), (u'e\nf', u'\u6771\u4eac'), (u'a', u'b'), (u'g\\n', u'\\\\t')]
+    nt.eq_(pairs, [_decode(_encode(pair)) for pair in pairs])
+    nt.eq_(1, _encode(pairs[0]).count('\t'))
+
+    workdir = tempfile.mkdtemp()
+    try:
+        rnd = random.Random(0)
+        old = [(u'article%d' % rnd.randint(0, 2000), u'Category:%d' % rnd.randint(0, 50)) for i in range(3000)]
+        new = old[500:] + [(u'article%d' % rnd.randint(0, 2000), u'Category:%d' % rnd.randint(0, 50)) for i in range(700)]
+        added, removed = os.path.join(workdir, 'added'), os.path.join(workdir, 'removed')
+
+        # with runs much smaller than the data
+        counts = write_delta(iter(old), iter(new), added, removed, run_size=100, tempdir=workdir)
+        nt.eq_(sorted(set(new) - set(old)), list(read_delta(added)))
+        nt.eq_(sorted(set(old) - set(new)), list(read_delta(removed)))
+        nt.eq_({'added': len(set(new) - set(old)), 'removed': len(set(old) - set(new)),
+                'unchanged': len(set(old) & set(new))}, counts)
+
+        # the runs are cleaned up
+        nt.eq_(['added', 'removed'], sorted(os.listdir(workdir)))
+
+        # nothing changed, or everything
+        nt.eq_(0, write_delta(iter(old), iter(old), added, removed, run_size=100)['added'])
+        nt.eq_([], list(read_delta(added)))
+        nt.eq_(len(set(old)), write_delta(iter([]), iter(old), added, removed)['added'])
+        nt.eq_([], list(read_delta(removed)))
+
+        # pairs from a synthetic dump that grows
+        iteratorClass = iterator_mapping['category_categories']
+        versions = []
+        for lines in (3000, 4000):
+            triples = list(NTripleParser(synthetic.generate('category_categories', lines=lines)))
+            versions.append(iteratorClass.convert_batch(triples, compact=True))
+        counts = write_delta(iter(versions[0]), iter(versions[1]), added, removed, run_size=500)
+        nt.eq_(sorted(set(versions[1]) - set(versions[0])), list(read_delta(added)))
+        nt.eq_(0, counts['removed'])
+        nt.eq_(len(set(versions[0])), counts['unchanged'])
+
+        # from the dumps of two versions
+        import bz2, download, urls
+        from resource import DBpediaResource
+        from testserver import TestServer
+        cache_dir = download.CACHE_DIR
+        download.CACHE_DIR = os.path.join(workdir, 'cache')
+        try:
+            with TestServer(os.path.join(workdir, 'server')) as server:
+                urls.set_download_base(server.url)
+                for version, lines in (('3.8', 3000), ('3.9', 4000)):
+                    r = DBpediaResource(dataset='category_categories', version=version, language='en')
+                    server.add_file(urls.build(r)[len(server.url):],
+                                    bz2.compress(''.join(synthetic.generate('category_categories', lines=lines))))
+
+                counts = compute_delta('category_categories', '3.8', '3.9', 'en', os.path.join(workdir, 'out'),
+                                       run_size=500, stream=True)
+                nt.eq_(len(set(versions[1]) - set(versions[0])), counts['added'])
+                added, removed = delta_filenames(os.path.join(workdir, 'out'), 'category_categories', 'en', '3.8', '3.9')
+                nt.eq_(sorted(set(versions[1]) - set(versions[0])), list(read_delta(added)))
+                nt.eq_([], list(read_delta(removed)))
+        finally:
+            urls.set_download_base("http://downloads.dbpedia.org")
+            download.CACHE_DIR = cache_dir
+
+        nt.eq_((os.path.join(workdir, 'article_categories_en_3.8_3.9.added.tsv'),
+                os.path.join(workdir, 'article_categories_en_3.8_3.9.removed.tsv')),
+               delta_filenames(workdir, 'article_categories', 'en', '3.8', '3.9'))
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    import logging
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        _test()
+        logging.info("Tests Passed")
+    except AssertionError as e:
+        logging.error("ERROR: TESTS FAILED")
+        logging.error(e)
@@ -2,16 +2,36 @@
 This file is responsible for downloading dataset files from dbpedia.
 They will be locally cached in a temporary directory.
 If already present, they will not be re-downloaded.
+
+Downloads go to a .part file first, and interrupted downloads
+are resumed where they left off, as long as the remote file hasn't
+changed since the .part file was started. The size and checksum of each
+complete download are recorded in the cache manifest, and cached
+files are checked against it before they are used.
+
+The manifest also records when each file was last used. If a
+DOWNLOAD_CACHE_LIMIT is set, the least recently used downloads
+are evicted to stay within it. Files that are open (or about to be)
+are pinned in the manifest by the process using them, so no process
+sharing the cache evicts them until they are unpinned. Decompressed
+copies are tracked, pinned and evicted the same way, within
+DECOMPRESSED_CACHE_LIMIT.
 """
 
-__all__ = ['retrieve', 'clean', 'clean_all']
+__all__ = ['retrieve', 'has_cached', 'cached_sha1', 'verify', 'clean', 'clean_all', 'IncompleteDownload', 'DownloadCancelled',
+           'limit_download_cache', 'evict_downloads', 'warm', 'unpin',
+           'use_decompressed_cache', 'has_decompressed', 'retrieve_decompressed', 'evict_decompressed']
 
-import os, time, sys
+import os, time, sys, errno
+import hashlib
 from string import Template
 import logging
 log = logging.getLogger("dbpedia.download")
 
+import bz2file
 import requests, urls
+from manifest import Manifest, file_sha1
+from bz2blocks import has_stream_end
 
 # directory for cached files
 CACHE_DIR = '.dbpedia_cache'
@@ -19,6 +39,29 @@ CACHE_DIR = '.dbpedia_cache'
 CHUNK_SIZE = 50 * 1024
 # template for paths to cached resources
 cache_file_template = Template('${version}/${language}/${format}/${dataset}.bz2')
+# suffix for files that are still being downloaded
+PART_SUFFIX = '.part'
+# the number of times to try (and resume) a download
+DOWNLOAD_ATTEMPTS = 3
+# seconds to wait for the server to connect or send more data before giving up on a try
+DOWNLOAD_TIMEOUT = 60
+# if true, cached files are checksummed before every use (not just size-checked)
+VERIFY_CHECKSUMS = False
+# the most bytes of downloaded (compressed) files to keep, None for no limit
+DOWNLOAD_CACHE_LIMIT = None
+
+# directory (inside the cache dir) for decompressed copies of cached resources
+DECOMPRESSED_DIR = 'decompressed'
+# template for paths to decompressed copies
+decompressed_file_template = Template('${version}/${language}/${format}/${dataset}.${format}')
+# if true, retrieve_decompressed() is used to open resources
+DECOMPRESSED_CACHE = False
+# the most bytes of decompressed copies to keep, None for no limit
+DECOMPRESSED_CACHE_LIMIT = 40 * 1024 ** 3
+# the size of chunks used when decompressing
+DECOMPRESS_CHUNK_SIZE = 1024 * 1024
+# suffix for decompressed copies that are still being written
+TEMP_SUFFIX = '.tmp'
 
 def _sizeof_fmt(num):
     """
@@ -55,86 +98,614 @@ def _resource_filename(resource):
 
     return os.path.abspath(resource)
 
-def _download(remote_name, local_name, chunk_size=CHUNK_SIZE):
+def _decompressed_filename(resource):
+    """
+    Gets the cache location for the decompressed copy
+    of the dbpedia resource.
+
+    :param resource:
+    :return:
+    """
+    resource = decompressed_file_template.substitute(dataset=resource.dataset,
+                                                     language=resource.language,
+                                                     version=resource.version,
+                                                     format=resource.format)
+    resource = os.path.join(CACHE_DIR, DECOMPRESSED_DIR, resource)
+
+    # make sure the directory exists
+    dir = os.path.dirname(resource)
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+
+    return os.path.abspath(resource)
+
+class IncompleteDownload(IOError):
+    """A download ended before the whole file arrived (it can be resumed)"""
+    pass
+
+class DownloadCancelled(Exception):
+    """Raised by a consume function to stop a download"""
+    pass
+
+def _read_part(part_name, sha1, consume, chunk_size=CHUNK_SIZE):
+    """Adds what has been downloaded so far to sha1, passing it to consume too"""
+    if consume is None:
+        file_sha1(part_name, sha1)
+        return
+
+    with open(part_name, 'rb') as f:
+        offset = 0
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            sha1.update(chunk)
+            consume(offset, chunk)
+            offset += len(chunk)
+
+def _download(remote_name, local_name, chunk_size=CHUNK_SIZE, progress=True, consume=None):
     """
     Download a remote file to a local file.
     A chunk size can be provided to set the size of download chunks.
+    If progress is False, nothing is printed while downloading.
+
+    The data goes to local_name + PART_SUFFIX, which is left for the
+    caller to rename to local_name once it is complete. If the part file
+    is already there, the download picks up where it left off, unless
+    the remote file has changed since the part file was started (going
+    by the ETag or Last-Modified date saved in the manifest back then).
+
+    If consume is given, it is called with the offset and contents of
+    every chunk of the file as it arrives (starting with any part already
+    downloaded). If the download restarts, offsets go back to 0.
 
     :param remote_name:
     :param local_name:
     :param chunk_size:
-    :return:
+    :param progress:
+    :param consume:
+    :return: the size and sha1 checksum of the file
     """
 
-    print "Downloading from %s" % remote_name
+    manifest = Manifest(CACHE_DIR)
+    part_name = local_name + PART_SUFFIX
+    start = 0
+    if os.path.exists(part_name):
+        validator = (manifest.get(local_name) or {}).get('part_validator')
+        if validator is None:
+            # there's no telling if the rest of the remote file still goes with it
+            log.warn("Can't tell what %s was downloaded from, starting again", part_name)
+            os.remove(part_name)
+        else:
+            start = os.path.getsize(part_name)
+
+    headers = {}
+    if start:
+        headers['Range'] = 'bytes=%d-' % start
+        headers['If-Range'] = validator
+
+    log.info("Downloading from %s (starting at byte %d)", remote_name, start)
+    if progress:
+        print "Downloading from %s" % remote_name
 
     before = time.time()
 
     # http://stackoverflow.com/questions/16694907/how-to-download-large-file-in-python-with-requests-py
-    req = requests.get(remote_name, stream = True) # here we need to set stream = True parameter
+    # (with stream = True, this version of requests only sets the timeout when connecting,
+    # but the socket keeps it, so reads that stall time out too)
+    req = requests.get(remote_name, stream = True, headers=headers, timeout=DOWNLOAD_TIMEOUT) # here we need to set stream = True parameter
+
+    if req.status_code == 416:
+        # the part file is no good for resuming, so start again
+        log.warn("Could not resume %s, starting again", part_name)
+        os.remove(part_name)
+        return _download(remote_name, local_name, chunk_size=chunk_size, progress=progress, consume=consume)
+
+    req.raise_for_status()
 
-    with open(local_name, 'wb') as out_file:
+    sha1 = hashlib.sha1()
+    if req.status_code == 206:
+        # the rest of the file is coming, after what we have
+        _read_part(part_name, sha1, consume, chunk_size)
+        mode = 'ab'
+        expected = int(req.headers['Content-Range'].rsplit('/', 1)[1])
+    else:
+        # the whole file is coming (if it was resumed, it has changed)
+        start = 0
+        mode = 'wb'
+        expected = req.headers.get('Content-Length')
+        if expected is not None:
+            expected = int(expected)
+        manifest.update(local_name, part_validator=_validator(req.headers))
+
+    with open(part_name, mode) as out_file:
         chunk_counter = 0
-        for chunk in req.iter_content(chunk_size=chunk_size):
+        offset = start
+        chunks = req.iter_content(chunk_size=chunk_size)
+        while True:
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                break
+            except Exception as e:
+                # whatever we got so far is kept for resuming
+                raise IncompleteDownload("Download of %s interrupted after %d bytes: %s" % (remote_name, offset, e))
 
             if chunk: # filter out keep-alive new chunks
 
                 out_file.write(chunk)
-                out_file.flush()
+                sha1.update(chunk)
                 chunk_counter += 1
 
-                sys.stdout.write(".")
-                sys.stdout.flush()
-                if chunk_counter % 60 == 0:
-                    print
+                if consume is not None:
+                    consume(offset, chunk)
+                offset += len(chunk)
+
+                if progress:
+                    sys.stdout.write(".")
+                    sys.stdout.flush()
+                    if chunk_counter % 60 == 0:
+                        print
 
-        print
+        if progress:
+            print
 
     after = time.time()
 
-    bytes = os.path.getsize(local_name)
-    size = _sizeof_fmt(bytes)
-    duration = after - before
-    rate = _sizeof_fmt(bytes / duration)
+    bytes = os.path.getsize(part_name)
+    if expected is not None and bytes != expected:
+        raise IncompleteDownload("Downloaded %d of %d bytes of %s" % (bytes, expected, remote_name))
 
-    print "Downloaded %s in %fs (%s/s)" %(size, duration, rate)
+    size = _sizeof_fmt(bytes - start)
+    duration = max(after - before, 1e-6)
+    rate = _sizeof_fmt((bytes - start) / duration)
 
-    return local_name
+    log.info("Downloaded %s in %fs (%s/s)", size, duration, rate)
+    if progress:
+        print "Downloaded %s in %fs (%s/s)" %(size, duration, rate)
+
+    return bytes, sha1.hexdigest()
+
+def _validator(headers):
+    """
+    Gets what identifies this version of a remote file from its headers,
+    for If-Range: a strong ETag, or else the Last-Modified date (or None).
+    """
+    etag = headers.get('ETag')
+    if etag is not None and not etag.startswith('W/'):
+        return etag
+    return headers.get('Last-Modified')
 
+def _check_cached(local_name, remote_name, manifest, checksum=False):
+    """
+    Checks a cached file against its manifest entry.
+    Returns True if it can be used.
 
-def retrieve(resource):
+    Files from before the manifest are compared to the size of
+    the remote file. If the server can't be reached, they are only
+    used if they end like a complete bz2 file.
+    """
+    entry = manifest.get(local_name)
+
+    # pins and use times alone don't say what the file should be
+    if entry is None or 'size' not in entry:
+        try:
+            response = requests.head(remote_name, timeout=DOWNLOAD_TIMEOUT)
+            response.raise_for_status()
+            expected = int(response.headers['Content-Length'])
+        except Exception as e:
+            if not has_stream_end(local_name):
+                log.warn("Could not check the size of %s (%s), and it is cut off", local_name, e)
+                return False
+            # not recorded in the manifest, so it is checked again next time
+            log.warn("Could not check the size of %s (%s), using it since it ends like a complete file",
+                     local_name, e)
+            return True
+
+        if os.path.getsize(local_name) != expected:
+            return False
+
+        manifest.update(local_name, size=expected, sha1=file_sha1(local_name), url=remote_name)
+        return True
+
+    if os.path.getsize(local_name) != entry['size']:
+        return False
+
+    if checksum and file_sha1(local_name) != entry['sha1']:
+        return False
+
+    return True
+
+
+def retrieve(resource, progress=True, checksum=None, consume=None, pin=False):
     """
     Returns a path to a dbpedia file, stored locally.
     The file will be available for reading.
     This function may block for some time while downloading the file,
     or return quickly if the file was cached.
 
-    If, when reading the file, there is an IOError, it may
-    mean that the file download was incomplete. In that case,
-    the clean() function should be used to delete the cached file.
+    Cached files are checked against the size (and, if checksum is True,
+    the sha1) recorded in the manifest when they were downloaded, and
+    downloaded again if they don't match. Checksum defaults to VERIFY_CHECKSUMS.
+
+    If progress is False, nothing is printed while downloading.
+    Consume is passed on to _download, if the file has to be downloaded.
+    If pin is True, the file is pinned for this process, and isn't
+    evicted until it is passed to unpin().
     :param resource:
+    :param progress:
+    :param checksum:
+    :param consume:
+    :param pin:
     :return:
     """
 
+    if checksum is None:
+        checksum = VERIFY_CHECKSUMS
+
     # Generate the local filename for this resource (creating directories as needed)
     local_name = _resource_filename(resource)
+    remote_name = urls.build(resource)
+    manifest = Manifest(CACHE_DIR)
 
     # see if it exists
     log.info("Checking cache for %s", local_name)
-    if not os.path.exists(local_name):
+    if os.path.exists(local_name):
+        if _check_cached(local_name, remote_name, manifest, checksum):
+            # another process may have evicted it since
+            if _use(manifest, local_name, pin):
+                log.info("Using cached file %s", local_name)
+                return local_name
 
-        # if not, go ahead and download it
-        remote_name = urls.build(resource)
+        elif os.path.exists(local_name):
+            log.warn("Cached file %s does not match the manifest, downloading it again", local_name)
+            os.remove(local_name)
+        manifest.remove(local_name)
 
-        _download(remote_name, local_name)
-    else:
-        log.info("Using cached file %s", local_name)
+    # if not, go ahead and download it, resuming if it gets cut off
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        try:
+            size, sha1 = _download(remote_name, local_name, progress=progress, consume=consume)
+            break
+        except (IncompleteDownload, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt == DOWNLOAD_ATTEMPTS:
+                raise
+            log.warn("%s; trying again (attempt %d of %d)", e, attempt + 1, DOWNLOAD_ATTEMPTS)
+
+    # so no other process evicts it before it is in the manifest (and pinned)
+    with manifest.lock():
+        os.rename(local_name + PART_SUFFIX, local_name)
+        _use(manifest, local_name, pin, size=size, sha1=sha1, url=remote_name, downloaded=time.time(),
+             part_validator=None)
+
+    evict_downloads(keep=[local_name])
+
+    return local_name
+
+def _use(manifest, path, pin, **fields):
+    """
+    Marks a cached file as just used, setting any other fields
+    of its manifest entry, and pins it if pin is True.
+    Returns False if the file isn't there any more.
+    """
+    with manifest.lock():
+        if not os.path.exists(path):
+            return False
+
+        if pin:
+            fields['pins'] = _live_pins(manifest.get(path)) + [os.getpid()]
+        manifest.update(path, used=time.time(), **fields)
+        return True
+
+def _alive(pid):
+    """Check if a process is still running"""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+def _live_pins(entry):
+    """The pins in a manifest entry that belong to processes still running"""
+    if entry is None:
+        return []
+    return [pid for pid in entry.get('pins', []) if _alive(pid)]
+
+def unpin(path):
+    """
+    Drops a pin this process holds on a cached file (see retrieve),
+    so it can be evicted again.
+
+    :param path:
+    :return:
+    """
+    manifest = Manifest(CACHE_DIR)
+    with manifest.lock():
+        entry = manifest.get(path)
+        if entry is None:
+            return
+
+        pins = _live_pins(entry)
+        if os.getpid() in pins:
+            pins.remove(os.getpid())
+        manifest.update(path, pins=pins)
+
+def has_cached(resource):
+    """
+    Check if a resource has been downloaded to the cache.
+
+    :param resource:
+    :return:
+    """
+    return os.path.exists(_resource_filename(resource))
+
+def cached_sha1(resource):
+    """
+    Gets the checksum recorded in the manifest when a resource
+    was downloaded, or None if there isn't one.
+
+    :param resource:
+    :return:
+    """
+    entry = Manifest(CACHE_DIR).get(_resource_filename(resource))
+    if entry is None:
+        return None
+    return entry.get('sha1')
+
+def verify(resource):
+    """
+    Check a cached resource against the checksum recorded when it was downloaded.
+
+    :param resource:
+    :return: True if it matches, False if it doesn't or isn't in the cache
+    """
+    local_name = _resource_filename(resource)
+    entry = Manifest(CACHE_DIR).get(local_name)
+    if entry is None or not os.path.exists(local_name):
+        return False
+
+    return os.path.getsize(local_name) == entry['size'] and file_sha1(local_name) == entry['sha1']
+
+def limit_download_cache(limit):
+    """
+    Set the most bytes of downloaded files to keep in the cache
+    (not counting decompressed copies), or None for no limit.
+    Older downloads are evicted right away if needed.
+
+    :param limit:
+    :return:
+    """
+    global DOWNLOAD_CACHE_LIMIT
+    DOWNLOAD_CACHE_LIMIT = limit
+    evict_downloads()
+
+def _cached_downloads(manifest):
+    """
+    Lists the complete downloads in the cache, as (last used, size, path) tuples.
+    Files missing from the manifest count as last used when they were modified.
+    """
+    entries = manifest.load()
+    decompressed_dir = os.path.abspath(os.path.join(CACHE_DIR, DECOMPRESSED_DIR))
+
+    files = []
+    for dirpath, dirnames, filenames in os.walk(CACHE_DIR):
+        if os.path.abspath(dirpath) == decompressed_dir:
+            del dirnames[:]
+            continue
+
+        for filename in filenames:
+            if not filename.endswith('.bz2'):
+                continue
+            path = os.path.abspath(os.path.join(dirpath, filename))
+            stat = os.stat(path)
+            entry = entries.get(manifest.key(path), {})
+            files.append((entry.get('used', stat.st_mtime), stat.st_size, path))
+
+    return files
+
+def evict_downloads(limit=None, keep=()):
+    """
+    Remove the least recently used downloads until the rest
+    fit in the limit, which defaults to DOWNLOAD_CACHE_LIMIT.
+    Files named in keep, and files pinned by a running process, are never removed.
+
+    :param limit:
+    :param keep:
+    :return: the number of bytes removed
+    """
+
+    if limit is None:
+        limit = DOWNLOAD_CACHE_LIMIT
+    if limit is None:
+        return 0
+
+    manifest = Manifest(CACHE_DIR)
+    with manifest.lock():
+        files = _cached_downloads(manifest)
+        entries = manifest.load()
+
+        total = sum(size for used, size, path in files)
+        removed = 0
+
+        # oldest first
+        files.sort()
+        for used, size, path in files:
+            if total <= limit:
+                break
+            if path in keep or _live_pins(entries.get(manifest.key(path))):
+                continue
+
+            os.remove(path)
+            manifest.remove(path)
+            total -= size
+            removed += size
+            log.info("Evicted downloaded file %s", path)
+
+    if total > limit:
+        log.warn("Download cache holds %s, over its limit of %s",
+                 _sizeof_fmt(total), _sizeof_fmt(limit))
+
+    return removed
+
+def warm(resources, progress=True):
+    """
+    Download whatever a batch of resources needs ahead of time,
+    marking them all as recently used. While warming, no resource
+    in the batch is evicted to make room for another.
+
+    :param resources:
+    :param progress:
+    :return: the local paths of the resources
+    """
+    paths = []
+    try:
+        for resource in resources:
+            paths.append(retrieve(resource, progress=progress, pin=True))
+    finally:
+        for path in paths:
+            unpin(path)
+
+    total = sum(os.path.getsize(path) for path in paths)
+    log.info("Warmed %d resources (%s)", len(paths), _sizeof_fmt(total))
+
+    return paths
+
+def use_decompressed_cache(enabled, limit=None):
+    """
+    Turn the decompressed cache on or off.
+    The limit is the most bytes of decompressed files to keep.
+
+    :param enabled:
+    :param limit:
+    :return:
+    """
+    global DECOMPRESSED_CACHE, DECOMPRESSED_CACHE_LIMIT
+    DECOMPRESSED_CACHE = enabled
+    if limit is not None:
+        DECOMPRESSED_CACHE_LIMIT = limit
+
+def has_decompressed(resource):
+    """
+    Check if there is a decompressed copy of a resource in the cache.
+
+    :param resource:
+    :return:
+    """
+    return os.path.exists(_decompressed_filename(resource))
+
+def retrieve_decompressed(resource, pin=False):
+    """
+    Returns a path to a decompressed copy of a dbpedia file, stored locally.
+    The compressed file is retrieved and decompressed if needed,
+    after which older decompressed copies may be evicted to stay
+    within DECOMPRESSED_CACHE_LIMIT.
+
+    If pin is True, the copy is pinned for this process, and isn't
+    evicted until it is passed to unpin().
+
+    :param resource:
+    :param pin:
+    :return:
+    """
+
+    local_name = _decompressed_filename(resource)
+    manifest = Manifest(CACHE_DIR)
+
+    # another process may evict it before it is marked as used
+    if os.path.exists(local_name) and _use(manifest, local_name, pin):
+        log.info("Using decompressed file %s", local_name)
+        return local_name
+
+    # decompress next to the final location, so a partial file is never used
+    # (each process writing its own, in case several decompress it at once)
+    temp_name = '%s.%d%s' % (local_name, os.getpid(), TEMP_SUFFIX)
+
+    # so the download isn't evicted while it is being decompressed
+    archive_name = retrieve(resource, pin=True)
+    try:
+        log.info("Decompressing %s", archive_name)
+        before = time.time()
+
+        with bz2file.open(archive_name, mode='rb') as archive:
+            with open(temp_name, 'wb') as out_file:
+                while True:
+                    chunk = archive.read(DECOMPRESS_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    out_file.write(chunk)
+    except Exception:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+    finally:
+        unpin(archive_name)
+
+    # so no other process evicts it before it is in the manifest (and pinned)
+    with manifest.lock():
+        os.rename(temp_name, local_name)
+        _use(manifest, local_name, pin, size=os.path.getsize(local_name))
+
+    size = _sizeof_fmt(os.path.getsize(local_name))
+    log.info("Decompressed to %s in %fs", size, time.time() - before)
+
+    evict_decompressed(keep=local_name)
 
     return local_name
 
+def evict_decompressed(limit=None, keep=None):
+    """
+    Remove the least recently used decompressed copies until
+    the rest fit in the limit, which defaults to DECOMPRESSED_CACHE_LIMIT.
+    The file named by keep, files pinned by a running process,
+    and copies still being written are never removed.
+
+    :param limit:
+    :param keep:
+    :return: the number of bytes removed
+    """
+
+    if limit is None:
+        limit = DECOMPRESSED_CACHE_LIMIT
+    if limit is None:
+        return 0
+
+    manifest = Manifest(CACHE_DIR)
+    with manifest.lock():
+        entries = manifest.load()
+
+        files = []
+        for dirpath, dirnames, filenames in os.walk(os.path.join(CACHE_DIR, DECOMPRESSED_DIR)):
+            for filename in filenames:
+                if filename.endswith(TEMP_SUFFIX):
+                    continue
+                path = os.path.abspath(os.path.join(dirpath, filename))
+                stat = os.stat(path)
+                entry = entries.get(manifest.key(path), {})
+                files.append((entry.get('used', stat.st_mtime), stat.st_size, path))
+
+        total = sum(size for used, size, path in files)
+        removed = 0
+
+        # oldest first
+        files.sort()
+        for used, size, path in files:
+            if total <= limit:
+                break
+            if path == keep or _live_pins(entries.get(manifest.key(path))):
+                continue
+
+            os.remove(path)
+            manifest.remove(path)
+            total -= size
+            removed += size
+            log.info("Evicted decompressed file %s", path)
+
+    return removed
+
 def clean(resource):
     """
-    Remove the cached version of a particular resource
+    Remove the cached version of a particular resource,
+    including any decompressed copy.
 
     :param resource:
     :return:
@@ -143,13 +714,23 @@ def clean(resource):
     # Generate the local filename for this resource
     local_name = _resource_filename(resource)
 
-    os.remove(local_name)
+    if os.path.exists(local_name):
+        os.remove(local_name)
+    if os.path.exists(local_name + PART_SUFFIX):
+        os.remove(local_name + PART_SUFFIX)
+    Manifest(CACHE_DIR).remove(local_name)
+
+    decompressed_name = _decompressed_filename(resource)
+    if os.path.exists(decompressed_name):
+        os.remove(decompressed_name)
+    Manifest(CACHE_DIR).remove(decompressed_name)
 
     log.info("Cleaned cache for %s", local_name)
 
 def clean_all():
     """
-    Remove all cached files
+    Remove all cached files.
+    To make room without losing everything, see evict_downloads().
     :return:
     """
 
@@ -159,44 +740,317 @@ def clean_all():
 
 
 def _test():
+    global CACHE_DIR, DOWNLOAD_ATTEMPTS, DOWNLOAD_CACHE_LIMIT, DOWNLOAD_TIMEOUT
     import nose.tools as nt
     import time
     from resource import DBpediaResource
 
-    # delete the cache
-    clean_all()
+    # work in an empty cache, leaving the real one alone
+    import shutil, tempfile
+    real_cache_dir = CACHE_DIR
+    CACHE_DIR = tempfile.mkdtemp()
+    try:
+        # Make decompressed copies of some fake cached files
+        import bz2
+        fake = [DBpediaResource(dataset="category_labels", version=version, language='en', format='nt')
+                for version in ['3.7', '3.8']]
+        for r in fake:
+            with open(_resource_filename(r), 'wb') as f:
+                f.write(bz2.compress('<a:b> <c:d> "%s" .\n' % r.version * 1000))
 
-    # Try a small resource
-    r = DBpediaResource(dataset="category_labels",
-                        version='3.9',
-                        language='en',
-                        format='nt')
+        older = retrieve_decompressed(fake[0])
+        with open(older) as f:
+            nt.eq_('<a:b> <c:d> "3.7" .\n' * 1000, f.read())
+        nt.ok_(has_decompressed(fake[0]))
+        nt.ok_(not has_decompressed(fake[1]))
 
-    # get it
-    before = time.time()
-    local_name = retrieve(r)
-    after = time.time()
+        # there is only room for one of them
+        use_decompressed_cache(False, limit=os.path.getsize(older) + 10)
+        Manifest(CACHE_DIR).update(older, used=time.time() - 100)
+        newer = retrieve_decompressed(fake[1])
+        nt.ok_(os.path.exists(newer))
+        nt.ok_(not os.path.exists(older))
+        nt.eq_(None, Manifest(CACHE_DIR).get(older))
 
-    # that should have taken some time
-    nt.ok_(after - before > 1) # more than 1 second
+        # unless the older one is pinned, or still being written
+        older = retrieve_decompressed(fake[0], pin=True)
+        nt.ok_(not os.path.exists(newer))
+        newer = retrieve_decompressed(fake[1])
+        nt.ok_(os.path.exists(older))
+        with open(newer + '.123' + TEMP_SUFFIX, 'wb') as f:
+            f.write('x' * 1000)
+        nt.eq_(0, evict_decompressed(limit=0, keep=newer))
+        nt.ok_(os.path.exists(older))
+        nt.ok_(os.path.exists(newer + '.123' + TEMP_SUFFIX))
+        unpin(older)
+        nt.eq_(os.path.getsize(older), evict_decompressed(limit=0, keep=newer))
+        nt.ok_(not os.path.exists(older))
+        os.remove(newer + '.123' + TEMP_SUFFIX)
 
-    # Just a sanity check
-    nt.assert_equal(local_name, _resource_filename(r))
+        clean(fake[1])
+        nt.ok_(not os.path.exists(newer))
 
-    # we already know how big this one file is supposed to be
-    nt.ok_(os.path.getsize(local_name) > 11200000)
+        # Resuming and verifying downloads, from a local server
+        from testserver import TestServer
+        root = tempfile.mkdtemp()
+        cache_dir = CACHE_DIR
+        CACHE_DIR = os.path.join(root, 'cache')
+        try:
+            with TestServer(os.path.join(root, 'server')) as server:
+                urls.set_download_base(server.url)
+                r = DBpediaResource(dataset="category_labels", version='3.9', language='en', format='nt')
+                data = bz2.compress(''.join('<a:b%d> <c:d> "e" .\n' % i for i in range(50000)))
+                server.add_file(urls.build(r)[len(server.url):], data)
 
-    # try it again
-    before = time.time()
-    local_name = retrieve(r)
-    after = time.time()
+                # the first try is cut off, and the second picks up where it stopped
+                server.cut_next(len(data) // 2)
+                local_name = retrieve(r, progress=False)
+                with open(local_name, 'rb') as f:
+                    nt.eq_(data, f.read())
+                nt.eq_([None, 'bytes=%d-' % (len(data) // 2)], server.ranges_requested)
+                nt.ok_(not os.path.exists(local_name + PART_SUFFIX))
+
+                entry = Manifest(CACHE_DIR).get(local_name)
+                nt.eq_(len(data), entry['size'])
+                nt.eq_(hashlib.sha1(data).hexdigest(), entry['sha1'])
+                nt.ok_(verify(r))
+
+                # cached files are used as long as they match
+                retrieve(r, progress=False)
+                nt.eq_(2, len(server.requests))
+
+                # a damaged file is caught by the checksum
+                with open(local_name, 'r+b') as f:
+                    f.write('x')
+                nt.ok_(not verify(r))
+                retrieve(r, progress=False, checksum=True)
+                nt.ok_(verify(r))
+                nt.eq_(3, len(server.requests))
+
+                # and a truncated one by its size
+                with open(local_name, 'r+b') as f:
+                    f.truncate(100)
+                retrieve(r, progress=False)
+                nt.ok_(verify(r))
+                nt.eq_(4, len(server.requests))
+
+                # a cached file from before the manifest is checked against the server
+                Manifest(CACHE_DIR).remove(local_name)
+                retrieve(r, progress=False)
+                nt.eq_(4, len(server.requests))
+                nt.ok_(verify(r))
+
+                # and if the server can't be reached, only used if it isn't cut off
+                import socket
+                sock = socket.socket()
+                sock.bind(('127.0.0.1', 0))
+                urls.set_download_base('http://127.0.0.1:%d' % sock.getsockname()[1])
+                sock.close()
+                attempts = DOWNLOAD_ATTEMPTS
+                try:
+                    DOWNLOAD_ATTEMPTS = 1
+                    Manifest(CACHE_DIR).remove(local_name)
+                    nt.eq_(local_name, retrieve(r, progress=False))
+                    nt.ok_('size' not in Manifest(CACHE_DIR).get(local_name))
 
-    # this time it should be near instant
-    nt.ok_(after - before < 0.1)
+                    with open(local_name, 'r+b') as f:
+                        f.truncate(len(data) - 1)
+                    nt.assert_raises(requests.exceptions.ConnectionError, retrieve, r, progress=False)
+                    nt.ok_(not os.path.exists(local_name))
+                finally:
+                    DOWNLOAD_ATTEMPTS = attempts
+                    urls.set_download_base(server.url)
+                retrieve(r, progress=False)
+                nt.ok_(verify(r))
 
-    # now delete it
-    clean(r)
-    nt.ok_(not os.path.exists(local_name))
+                # if the server ignores ranges, the download starts over
+                clean(r)
+                server.server.ranges = False
+                server.cut_next(1000)
+                retrieve(r, progress=False)
+                nt.ok_(verify(r))
+
+                # giving up after too many tries leaves the part file for later
+                clean(r)
+                attempts = DOWNLOAD_ATTEMPTS
+                try:
+                    DOWNLOAD_ATTEMPTS = 1
+                    server.cut_next(1000)
+                    nt.assert_raises(IncompleteDownload, retrieve, r, progress=False)
+                    nt.eq_(1000, os.path.getsize(local_name + PART_SUFFIX))
+                    nt.ok_(not os.path.exists(local_name))
+                finally:
+                    DOWNLOAD_ATTEMPTS = attempts
+
+                # it isn't resumed if the file on the server has changed since
+                changed = bz2.compress(''.join('<a:b%d> <c:d> "f" .\n' % i for i in range(50000)))
+                server.add_file(urls.build(r)[len(server.url):], changed)
+                server.server.ranges = True
+                local_name = retrieve(r, progress=False)
+                nt.eq_('bytes=1000-', server.ranges_requested[-1])
+                with open(local_name, 'rb') as f:
+                    nt.eq_(changed, f.read())
+                nt.eq_(hashlib.sha1(changed).hexdigest(), cached_sha1(r))
+                nt.ok_('part_validator' not in Manifest(CACHE_DIR).get(local_name))
+
+                # nor is a part file when there's nothing saved to tell
+                clean(r)
+                server.add_file(urls.build(r)[len(server.url):], data)
+                with open(local_name + PART_SUFFIX, 'wb') as f:
+                    f.write(changed[:1000])
+                retrieve(r, progress=False)
+                nt.eq_(None, server.ranges_requested[-1])
+                nt.ok_(verify(r))
+                nt.eq_(hashlib.sha1(data).hexdigest(), cached_sha1(r))
+                clean(r)
+                nt.ok_(not os.path.exists(local_name + PART_SUFFIX))
+
+                # without a Content-Length, a cut off download is still caught
+                server.server.ranges = True
+                server.server.chunked = True
+                try:
+                    DOWNLOAD_ATTEMPTS = 1
+                    server.cut_next(1000)
+                    nt.assert_raises(IncompleteDownload, retrieve, r, progress=False)
+                    nt.ok_(not os.path.exists(local_name))
+                    nt.eq_(None, cached_sha1(r))
+                    nt.ok_(os.path.getsize(local_name + PART_SUFFIX) <= 1000)
+                finally:
+                    DOWNLOAD_ATTEMPTS = attempts
+                    server.server.chunked = False
+                retrieve(r, progress=False)
+                nt.ok_(verify(r))
+
+                # a stalled download times out (and is kept for resuming)
+                clean(r)
+                timeout = DOWNLOAD_TIMEOUT
+                try:
+                    DOWNLOAD_ATTEMPTS = 1
+                    DOWNLOAD_TIMEOUT = 0.5
+                    server.server.delay = 2
+                    before = time.time()
+                    nt.assert_raises(IncompleteDownload, retrieve, r, progress=False)
+                    nt.ok_(time.time() - before < 2)
+                    nt.ok_(os.path.exists(local_name + PART_SUFFIX))
+                finally:
+                    DOWNLOAD_ATTEMPTS = attempts
+                    DOWNLOAD_TIMEOUT = timeout
+                    server.server.delay = 0
+                retrieve(r, progress=False)
+                nt.ok_(verify(r))
+
+                # errors from consume aren't swallowed
+                clean(r)
+                def broken(offset, chunk):
+                    raise ValueError("can't use %d bytes" % len(chunk))
+                nt.assert_raises(ValueError, retrieve, r, progress=False, consume=broken)
+                nt.ok_(not os.path.exists(local_name))
+                nt.ok_(os.path.exists(local_name + PART_SUFFIX))
+                clean(r)
+
+                # least recently used downloads are evicted to stay under the limit
+                resources = [DBpediaResource(dataset=dataset, version='3.9', language='en', format='nt')
+                             for dataset in ['category_labels', 'category_categories', 'article_categories']]
+                for i, resource in enumerate(resources):
+                    server.add_file(urls.build(resource)[len(server.url):], bz2.compress('%d' % i) * 100)
+                size = len(bz2.compress('0')) * 100
+
+                paths = warm(resources[:2], progress=False)
+                nt.eq_([_resource_filename(resource) for resource in resources[:2]], paths)
+                nt.eq_(size * 2, sum(size for used, size, path in _cached_downloads(Manifest(CACHE_DIR))))
+
+                limit = DOWNLOAD_CACHE_LIMIT
+                try:
+                    limit_download_cache(size * 2)
+                    # using the first makes the second the oldest
+                    retrieve(resources[0], progress=False)
+                    retrieve(resources[2], progress=False)
+                    nt.ok_(has_cached(resources[0]))
+                    nt.ok_(not has_cached(resources[1]))
+                    nt.ok_(has_cached(resources[2]))
+                    nt.eq_(None, Manifest(CACHE_DIR).get(paths[1]))
+
+                    # a batch that doesn't fit still gets downloaded completely
+                    limit_download_cache(size)
+                    nt.eq_(3, len(warm(resources, progress=False)))
+                    for resource in resources:
+                        nt.ok_(has_cached(resource))
+
+                    # but the extra files go when something else is downloaded
+                    clean(resources[2])
+                    retrieve(resources[2], progress=False)
+                    nt.eq_([resources[2]], [resource for resource in resources if has_cached(resource)])
+
+                    # decompressed copies and part files don't count
+                    retrieve_decompressed(resources[2])
+                    with open(_resource_filename(resources[0]) + PART_SUFFIX, 'wb') as f:
+                        f.write('x' * size * 10)
+                    nt.eq_(0, evict_downloads())
+
+                    # pinned files are kept until they are unpinned
+                    os.remove(_resource_filename(resources[0]) + PART_SUFFIX)
+                    path = retrieve(resources[0], progress=False, pin=True)
+                    retrieve(resources[1], progress=False)
+                    nt.ok_(has_cached(resources[0]))
+                    nt.ok_(not has_cached(resources[2]))
+                    nt.eq_(size, evict_downloads(limit=0))
+                    nt.eq_([resources[0]], [resource for resource in resources if has_cached(resource)])
+                    unpin(path)
+                    nt.eq_(size, evict_downloads(limit=0))
+                    nt.ok_(not has_cached(resources[0]))
+
+                    # even by other processes, as long as they are running
+                    import subprocess
+                    child = subprocess.Popen(['sleep', '10'])
+                    try:
+                        path = retrieve(resources[0], progress=False)
+                        Manifest(CACHE_DIR).update(path, pins=[child.pid])
+                        nt.eq_(0, evict_downloads(limit=0))
+                    finally:
+                        child.kill()
+                        child.wait()
+                    nt.eq_(size, evict_downloads(limit=0))
+                finally:
+                    DOWNLOAD_CACHE_LIMIT = limit
+        finally:
+            urls.set_download_base("http://downloads.dbpedia.org")
+            CACHE_DIR = cache_dir
+            shutil.rmtree(root)
+
+        # Try a small resource
+        r = DBpediaResource(dataset="category_labels",
+                            version='3.9',
+                            language='en',
+                            format='nt')
+
+        # get it
+        before = time.time()
+        local_name = retrieve(r)
+        after = time.time()
+
+        # that should have taken some time
+        nt.ok_(after - before > 1) # more than 1 second
+
+        # Just a sanity check
+        nt.assert_equal(local_name, _resource_filename(r))
+
+        # we already know how big this one file is supposed to be
+        nt.ok_(os.path.getsize(local_name) > 11200000)
+
+        # try it again
+        before = time.time()
+        local_name = retrieve(r)
+        after = time.time()
+
+        # this time it should be near instant
+        nt.ok_(after - before < 0.1)
+
+        # now delete it
+        clean(r)
+        nt.ok_(not os.path.exists(local_name))
+    finally:
+        shutil.rmtree(CACHE_DIR)
+        CACHE_DIR = real_cache_dir
 
 if __name__ == "__main__":
     import logging
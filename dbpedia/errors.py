@@ -0,0 +1,131 @@
+"""
+This file collects the errors found while parsing DBpedia files.
+
+Rather than logging every bad line, errors are counted by
+category and the offending lines can be written to a
+quarantine file for later inspection. A summary of the
+counts is logged every so often.
+"""
+
+__all__ = ['ErrorSink']
+
+import time
+
+import logging
+log = logging.getLogger('dbpedia.errors')
+
+# minimum seconds between logged summaries
+SUMMARY_INTERVAL = 30
+# buffer size for the quarantine file
+QUARANTINE_BUFFER_SIZE = 1024 * 1024
+
+class ErrorSink(object):
+    """
+    Counts parse errors by category, and optionally writes the
+    offending lines to a quarantine file, as tab-separated
+    source, line number, category, and line.
+
+    If collect is True, the errors are also kept in the entries list
+    (so they can be passed back from worker processes).
+    """
+
+    def __init__(self, quarantine=None, collect=False, summary_interval=SUMMARY_INTERVAL):
+        self.counts = {}
+        self.total = 0
+
+        # a label for the file currently being parsed
+        self.source = None
+
+        self.entries = [] if collect else None
+
+        self.quarantine = None
+        if quarantine is not None:
+            self.quarantine = open(quarantine, 'a', QUARANTINE_BUFFER_SIZE)
+
+        self.summary_interval = summary_interval
+        self.last_summary = time.time()
+
+    def add(self, lineno, category, line):
+        """Records an error on the given line"""
+        self.counts[category] = self.counts.get(category, 0) + 1
+        self.total += 1
+
+        log.debug("Parse error (%s) on line %d: %s", category, lineno, line)
+
+        if self.entries is not None:
+            self.entries.append((lineno, category, line))
+
+        if self.quarantine is not None:
+            if isinstance(line, unicode):
+                line = line.encode('utf-8')
+            self.quarantine.write('%s\t%d\t%s\t%s\n' % (self.source, lineno, category, line))
+
+        now = time.time()
+        if now - self.last_summary >= self.summary_interval:
+            self.log_summary()
+            self.last_summary = now
+
+    def extend(self, entries):
+        """Records a list of (line number, category, line) errors"""
+        for lineno, category, line in entries:
+            self.add(lineno, category, line)
+
+    def summary(self):
+        """Gets a list of (category, count) pairs, most common first"""
+        return sorted(self.counts.items(), key=lambda pair: (-pair[1], pair[0]))
+
+    def log_summary(self):
+        if not self.total:
+            return
+
+        log.warn("%d parse errors so far: %s", self.total,
+                 ", ".join("%s: %d" % pair for pair in self.summary()))
+
+    def close(self):
+        if self.quarantine is not None:
+            self.quarantine.close()
+            self.quarantine = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+def _test():
+    import nose.tools as nt
+    import os
+    import tempfile
+
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        with ErrorSink(quarantine=filename, collect=True, summary_interval=0) as sink:
+            sink.source = 'test'
+            sink.add(3, 'bad uri', '<foo> <bar> .')
+            sink.add(7, 'trailing garbage', '<a:b> <c:d> <e:f> . x')
+            sink.extend([(9, 'bad uri', u'<caf\xe9> <bar> .')])
+
+            nt.eq_(3, sink.total)
+            nt.eq_([('bad uri', 2), ('trailing garbage', 1)], sink.summary())
+            nt.eq_(3, len(sink.entries))
+
+        with open(filename) as f:
+            lines = f.read().splitlines()
+
+        nt.eq_(3, len(lines))
+        nt.eq_('test\t3\tbad uri\t<foo> <bar> .', lines[0])
+        nt.eq_('test\t9\tbad uri\t<caf\xc3\xa9> <bar> .', lines[2])
+    finally:
+        os.remove(filename)
+
+if __name__ == "__main__":
+    import logging
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        _test()
+        logging.info("Tests Passed")
+    except AssertionError as e:
+        logging.error("ERROR: TESTS FAILED")
+        logging.error(e)
@@ -0,0 +1,159 @@
+"""
+This file keeps track of where the time goes in the import pipeline.
+
+Each stage of the pipeline (decompression, parsing, decoding,
+database lookups, inserts...) adds up the time it spent, the
+number of items it handled, and optionally the number of bytes.
+A report is logged every so often, and a summary can be saved as JSON.
+"""
+
+__all__ = ['PipelineStats', 'save_summaries']
+
+import json
+import time
+
+import logging
+log = logging.getLogger('dbpedia.instrument')
+
+# minimum seconds between logged reports
+REPORT_INTERVAL = 60
+
+def _rate(amount, seconds):
+    if seconds > 0:
+        return amount / seconds
+    return 0.0
+
+class Stage(object):
+    """Cumulative counters for one stage of the pipeline"""
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.items = 0
+        self.bytes = 0
+
+    def add(self, seconds, items=0, bytes=0):
+        self.seconds += seconds
+        self.items += items
+        self.bytes += bytes
+
+    def summary(self):
+        return {
+            'seconds': self.seconds,
+            'items': self.items,
+            'bytes': self.bytes,
+            'items_per_second': _rate(self.items, self.seconds),
+            'bytes_per_second': _rate(self.bytes, self.seconds),
+        }
+
+    def describe(self):
+        text = "%s: %.2fs, %d items (%.0f/s)" % (self.name, self.seconds, self.items,
+                                                  _rate(self.items, self.seconds))
+        if self.bytes:
+            text += ", %.1f MB (%.1f MB/s)" % (self.bytes / 1024.0 ** 2,
+                                                _rate(self.bytes, self.seconds) / 1024.0 ** 2)
+        return text
+
+class PipelineStats(object):
+    """
+    Counters for all the stages of one import.
+    Stages are created as they are first used.
+    """
+
+    def __init__(self, label=None, report_interval=REPORT_INTERVAL):
+        self.label = label
+        self.stages = []
+        self.stages_by_name = {}
+
+        self.started = time.time()
+        self.finished = None
+        self.report_interval = report_interval
+        self.last_report = self.started
+
+    def stage(self, name):
+        stage = self.stages_by_name.get(name)
+        if stage is None:
+            stage = Stage(name)
+            self.stages.append(stage)
+            self.stages_by_name[name] = stage
+        return stage
+
+    def add(self, name, seconds, items=0, bytes=0):
+        """Adds some work done by a stage, and logs a report if it's time"""
+        self.stage(name).add(seconds, items, bytes)
+
+        now = time.time()
+        if now - self.last_report >= self.report_interval:
+            self.log_report()
+            self.last_report = now
+
+    def log_report(self):
+        log.info("%s after %.1fs:", self.label or "Import", time.time() - self.started)
+        for stage in self.stages:
+            log.info("    %s", stage.describe())
+
+    def finish(self):
+        """Marks the end of the import, so later summaries have the right wall time"""
+        self.finished = time.time()
+
+    def summary(self):
+        """Gets a json-friendly dictionary of all the counters"""
+        return {
+            'label': self.label,
+            'wall_seconds': (self.finished or time.time()) - self.started,
+            'stages': [dict(stage.summary(), name=stage.name) for stage in self.stages],
+        }
+
+def save_summaries(filename, stats):
+    """
+    Save the summaries of a list of PipelineStats as JSON.
+
+    :param filename:
+    :param stats:
+    :return:
+    """
+    with open(filename, 'w') as f:
+        json.dump([s.summary() for s in stats], f, indent=2)
+
+def _test():
+    import nose.tools as nt
+    import os
+    import tempfile
+
+    stats = PipelineStats(label='test', report_interval=0)
+    stats.add('parse', 2.0, items=100, bytes=1000)
+    stats.add('decode', 1.0, items=50)
+    stats.add('parse', 2.0, items=100, bytes=1000)
+
+    stats.finish()
+    summary = stats.summary()
+    nt.eq_(summary['wall_seconds'], stats.summary()['wall_seconds'])
+    nt.eq_(['parse', 'decode'], [s['name'] for s in summary['stages']])
+
+    parse = summary['stages'][0]
+    nt.eq_(4.0, parse['seconds'])
+    nt.eq_(200, parse['items'])
+    nt.eq_(50.0, parse['items_per_second'])
+    nt.eq_(500.0, parse['bytes_per_second'])
+
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        save_summaries(filename, [stats])
+        with open(filename) as f:
+            saved = json.load(f)
+        nt.eq_('test', saved[0]['label'])
+        nt.eq_(summary['stages'], saved[0]['stages'])
+    finally:
+        os.remove(filename)
+
+if __name__ == "__main__":
+    import logging
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        _test()
+        logging.info("Tests Passed")
+    except AssertionError as e:
+        logging.error("ERROR: TESTS FAILED")
+        logging.error(e)
@@ -0,0 +1,199 @@
+"""
+This file keeps a JSON manifest of the files in the download cache,
+recording the size and checksum of each complete download.
+
+The manifest is shared by threads and processes using the same
+cache, so every change is made while holding a lock on it.
+"""
+
+__all__ = ['Manifest', 'file_sha1']
+
+import os
+import json
+import fcntl
+import hashlib
+import threading
+
+import logging
+log = logging.getLogger('dbpedia.manifest')
+
+# the manifest file, inside the cache dir
+MANIFEST_FILE = 'manifest.json'
+# the file locked while using the manifest
+LOCK_FILE = 'manifest.lock'
+# bytes read at a time when computing checksums
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# held by the thread using a manifest; the lock file keeps out other processes
+_thread_lock = threading.RLock()
+_lock_depth = [0]
+_lock_files = []
+
+def file_sha1(filename, sha1=None):
+    """
+    Gets the hex sha1 checksum of a file.
+    If sha1 (a hashlib object) is given, the file is added to it.
+
+    :param filename:
+    :param sha1:
+    :return:
+    """
+    if sha1 is None:
+        sha1 = hashlib.sha1()
+
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+class _Lock(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __enter__(self):
+        _thread_lock.acquire()
+
+        # only the outermost lock in this process needs the file
+        if _lock_depth[0] == 0:
+            dirname = os.path.dirname(self.filename)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+
+            f = open(self.filename, 'a')
+            fcntl.flock(f, fcntl.LOCK_EX)
+            _lock_files.append(f)
+
+        _lock_depth[0] += 1
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _lock_depth[0] -= 1
+
+        if _lock_depth[0] == 0:
+            f = _lock_files.pop()
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+
+        _thread_lock.release()
+
+class Manifest(object):
+    """
+    The manifest of a cache directory: a dictionary from
+    cache file paths (relative to the cache dir) to entries,
+    which are dictionaries of information about the file.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.filename = os.path.join(cache_dir, MANIFEST_FILE)
+
+    def lock(self):
+        """
+        Use 'with manifest.lock():' to make several changes
+        without another thread or process getting in between.
+        """
+        return _Lock(os.path.join(self.cache_dir, LOCK_FILE))
+
+    def key(self, path):
+        """Gets the manifest key for a file in the cache"""
+        return os.path.relpath(os.path.abspath(path), os.path.abspath(self.cache_dir))
+
+    def load(self):
+        with self.lock():
+            if not os.path.exists(self.filename):
+                return {}
+
+            with open(self.filename) as f:
+                try:
+                    return json.load(f)
+                except ValueError:
+                    log.warn("Ignoring damaged manifest %s", self.filename)
+                    return {}
+
+    def save(self, entries):
+        with self.lock():
+            # write next to the manifest, so a partial manifest is never read
+            temp_filename = self.filename + '.tmp'
+            with open(temp_filename, 'w') as f:
+                json.dump(entries, f, indent=1, sort_keys=True)
+            os.rename(temp_filename, self.filename)
+
+    def get(self, path):
+        """Gets the entry for a file in the cache, or None"""
+        return self.load().get(self.key(path))
+
+    def update(self, path, **fields):
+        """Sets some fields of the entry for a file (removing the ones set to None), returning the entry"""
+        with self.lock():
+            entries = self.load()
+            entry = entries.setdefault(self.key(path), {})
+            for name, value in fields.items():
+                if value is None:
+                    entry.pop(name, None)
+                else:
+                    entry[name] = value
+            self.save(entries)
+            return entry
+
+    def remove(self, path):
+        with self.lock():
+            entries = self.load()
+            if entries.pop(self.key(path), None) is not None:
+                self.save(entries)
+
+def _test():
+    import nose.tools as nt
+    import tempfile
+    import shutil
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        manifest = Manifest(cache_dir)
+        path = os.path.join(cache_dir, '3.9', 'en', 'nt', 'category_labels.bz2')
+        nt.eq_(os.path.join('3.9', 'en', 'nt', 'category_labels.bz2'), manifest.key(path))
+
+        nt.eq_(None, manifest.get(path))
+        manifest.update(path, size=10, sha1='abc')
+        manifest.update(path, used=5)
+        nt.eq_({'size': 10, 'sha1': 'abc', 'used': 5}, Manifest(cache_dir).get(path))
+        manifest.update(path, sha1=None)
+        nt.eq_({'size': 10, 'used': 5}, Manifest(cache_dir).get(path))
+
+        # nested locks are fine
+        with manifest.lock():
+            with manifest.lock():
+                manifest.remove(path)
+        nt.eq_({}, manifest.load())
+
+        # threads don't lose each other's updates
+        def add(i):
+            for j in range(20):
+                manifest.update(os.path.join(cache_dir, 'file%d_%d' % (i, j)), size=j)
+        threads = [threading.Thread(target=add, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        nt.eq_(80, len(manifest.load()))
+
+        # checksums
+        with open(os.path.join(cache_dir, 'hello'), 'wb') as f:
+            f.write('hello')
+        nt.eq_(hashlib.sha1('hello').hexdigest(), file_sha1(os.path.join(cache_dir, 'hello')))
+    finally:
+        shutil.rmtree(cache_dir)
+
+if __name__ == "__main__":
+    import logging
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        _test()
+        logging.info("Tests Passed")
+    except AssertionError as e:
+        logging.error("ERROR: TESTS FAILED")
+        logging.error(e)
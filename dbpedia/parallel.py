@@ -0,0 +1,313 @@
+"""
+This file knows how to parse a DBpedia N-Triples file
+on several processes at once.
+
+The decompressed stream is cut into line-aligned blocks, which
+are handed to a pool of worker processes. Each worker runs
+the N-Triples parser and a dataset iterator over its block
+and sends back a list of records.
+"""
+
+__all__ = ['parallel_batches', 'BLOCK_LINES']
+
+import itertools
+import multiprocessing
+import os
+import time
+import traceback
+import Queue
+from collections import deque
+
+from ntparser import NTripleParser
+from errors import ErrorSink
+
+import logging
+log = logging.getLogger('dbpedia.parallel')
+
+# default number of lines in each block handed to a worker
+BLOCK_LINES = 10000
+
+# the number of blocks per process that may be waiting to be parsed or collected
+BLOCKS_PER_PROCESS = 3
+
+# how often (in seconds) to check on the workers while waiting for a block
+RESULT_POLL_INTERVAL = 1
+# how long (in seconds) to wait for a block before giving up on the workers
+RESULT_TIMEOUT = 600
+
+def _read_blocks(file, lines, stats=None):
+    """
+    Cuts a file into blocks of up to the given number of lines.
+    Generates (line number of first line, block text) tuples.
+    """
+    iterator = file.__iter__()
+    lineno = 0
+
+    while True:
+        before = time.time()
+        block = list(itertools.islice(iterator, lines))
+        if not block:
+            return
+
+        text = ''.join(block)
+        if stats is not None:
+            stats.add('decompress', time.time() - before, len(block), len(text))
+
+        yield lineno, text
+        lineno += len(block)
+
+def _parse_block(lineno, text, iteratorClass, fast, compact, url_base):
+    """
+    Runs in a worker process.
+    Parses a block of lines and converts the triples to records.
+
+    Returns a (success, result) tuple, where the result is either
+    a (records, parse errors, timings, decoded) tuple or the formatted traceback
+    of whatever went wrong. The timings are the number of lines and bytes
+    in the block, and the seconds spent parsing and converting it.
+    Decoded is the (hits, misses) of the iterator's url decoder, if it has one.
+    """
+    try:
+        decoder = iteratorClass.decoder
+        if decoder is not None:
+            hits, misses = decoder.hits, decoder.misses
+
+        before = time.time()
+        # only at newlines, like reading the file a line at a time
+        # (splitlines would also split unicode text at u'\u2028' and the like)
+        lines = text.split('\n')
+        if not lines[-1]:
+            lines.pop()
+
+        errors = ErrorSink(collect=True)
+        parser = NTripleParser(lines, fast=fast, predicates=iteratorClass.predicates, errors=errors)
+        parser.lineno = lineno
+        triples = parser.parse_chunk(len(lines))
+
+        parsed = time.time()
+        records = iteratorClass.convert_batch(triples, compact, url_base)
+
+        timings = (len(lines), len(text), parsed - before, time.time() - parsed)
+
+        decoded = None
+        if decoder is not None:
+            decoded = (decoder.hits - hits, decoder.misses - misses)
+
+        return True, (records, errors.entries, timings, decoded)
+    except Exception:
+        return False, traceback.format_exc()
+
+def _workers(pool):
+    return [worker.pid for worker in pool._pool if worker.exitcode is None]
+
+def _wait(get, pool, workers):
+    """
+    Waits for the next result, calling get with a timeout until it comes.
+    Raises an exception if a worker process died (its block would never
+    come back), or if nothing comes back for RESULT_TIMEOUT seconds.
+    """
+    waited = 0
+    while True:
+        try:
+            return get(RESULT_POLL_INTERVAL)
+        except (Queue.Empty, multiprocessing.TimeoutError):
+            pass
+
+        # the pool replaces workers that die, but their blocks are lost
+        if _workers(pool) != workers:
+            raise Exception("A worker process died while parsing (out of memory?)")
+
+        waited += RESULT_POLL_INTERVAL
+        if waited >= RESULT_TIMEOUT:
+            raise Exception("No parsed block came back from the workers in %ds" % waited)
+
+def parallel_batches(file, iteratorClass, processes=None, ordered=True,
+                     lines=BLOCK_LINES, fast=True, errors=None, stats=None, compact=False,
+                     url_base=None):
+    """
+    Iterate over lists of records from an N-Triples file,
+    parsed by a pool of worker processes.
+
+    If ordered is True, the batches come back in the same order as
+    the lines in the file. Otherwise, each batch is returned as soon
+    as a worker finishes it.
+
+    :param file: an open, decompressed N-Triples file
+    :param iteratorClass: a record iterator class from dbpedia.datasets
+    :param processes: the number of worker processes (defaults to the number of cpus)
+    :param ordered: whether to keep the batches in file order
+    :param lines: the number of lines given to a worker at once
+    :param fast: passed on to the NTripleParser
+    :param errors: an ErrorSink for the parse errors found by the workers
+    :param stats: a PipelineStats to add the time spent in each stage to
+        (parse and decode time is summed over the workers)
+    :param compact: passed on to the convert_batch function of the iterator class
+    :param url_base: passed on to the convert_batch function too (None for the default)
+    :return:
+    """
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    in_flight = processes * BLOCKS_PER_PROCESS
+
+    log.info("Parsing with %d processes (%s)", processes, "ordered" if ordered else "unordered")
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        workers = _workers(pool)
+        blocks = _read_blocks(file, lines, stats)
+
+        # results in submission order, for ordered mode
+        pending = deque()
+        # results as they arrive, for unordered mode
+        finished = Queue.Queue()
+        submitted = 0
+
+        exhausted = False
+        while True:
+
+            # keep the workers busy, without reading too far ahead
+            while not exhausted and submitted < in_flight:
+                try:
+                    lineno, text = blocks.next()
+                except StopIteration:
+                    exhausted = True
+                    break
+
+                args = (lineno, text, iteratorClass, fast, compact, url_base)
+                if ordered:
+                    pending.append(pool.apply_async(_parse_block, args))
+                else:
+                    pool.apply_async(_parse_block, args, callback=finished.put)
+                submitted += 1
+
+            if submitted == 0:
+                break
+
+            if ordered:
+                success, result = _wait(pending[0].get, pool, workers)
+                pending.popleft()
+            else:
+                success, result = _wait(lambda timeout: finished.get(timeout=timeout), pool, workers)
+            submitted -= 1
+
+            if not success:
+                raise Exception("Parsing failed in a worker process:\n%s" % result)
+
+            records, entries, timings, decoded = result
+            if errors is not None:
+                errors.extend(entries)
+
+            # keep the decoder counts in this process up to date
+            if decoded is not None:
+                iteratorClass.decoder.hits += decoded[0]
+                iteratorClass.decoder.misses += decoded[1]
+
+            if stats is not None:
+                count, size, parse_seconds, decode_seconds = timings
+                stats.add('parse', parse_seconds, count, size)
+                stats.add('decode', decode_seconds, count)
+
+            if records:
+                yield records
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+class _DyingIterator(object):
+    """For testing: a record iterator whose worker process dies on the block with line 50"""
+    decoder = None
+    predicates = None
+
+    @staticmethod
+    def convert_batch(triples, compact=False, url_base=None):
+        if any(triple[0].endswith('/Article_50') for triple in triples):
+            os._exit(1)
+        return triples
+
+def _test():
+    global RESULT_POLL_INTERVAL
+    import nose.tools as nt
+    import cStringIO as StringIO
+    from datasets import ArticleCategoriesIterator, CategoryLabelIterator
+    from instrument import PipelineStats
+
+    line = '<http://dbpedia.org/resource/Article_%d> <http://purl.org/dc/terms/subject> <http://dbpedia.org/resource/Category:Category_%d> .\n'
+    text = ''.join(line % (i, i % 7) for i in range(1000))
+
+    expectation = ArticleCategoriesIterator.convert_batch(list(NTripleParser(StringIO.StringIO(text))))
+    nt.eq_(1000, len(expectation))
+
+    # in order, the records should be exactly the same
+    stats = PipelineStats()
+    batches = list(parallel_batches(StringIO.StringIO(text), ArticleCategoriesIterator,
+                                    processes=2, ordered=True, lines=30, stats=stats))
+    nt.eq_(34, len(batches))
+    nt.eq_(expectation, [record for batch in batches for record in batch])
+    nt.eq_(['decompress', 'parse', 'decode'], [stage.name for stage in stats.stages])
+    nt.eq_(1000, stats.stage('parse').items)
+    nt.eq_(len(text), stats.stage('decompress').bytes)
+
+    # the workers' url decoding is counted here too
+    decoder = ArticleCategoriesIterator.decoder
+    before = decoder.hits + decoder.misses
+    list(parallel_batches(StringIO.StringIO(text), ArticleCategoriesIterator, processes=2, lines=30))
+    nt.eq_(1000, decoder.hits + decoder.misses - before)
+
+    # compact records are the same, as tuples
+    batches = list(parallel_batches(StringIO.StringIO(text), ArticleCategoriesIterator,
+                                    processes=2, lines=300, compact=True))
+    nt.eq_([(r['article'], r['category']) for r in expectation], [record for batch in batches for record in batch])
+
+    # out of order, we should get the same set
+    batches = list(parallel_batches(StringIO.StringIO(text), ArticleCategoriesIterator,
+                                    processes=3, ordered=False, lines=30))
+    records = [record for batch in batches for record in batch]
+    nt.eq_(sorted(expectation), sorted(records))
+
+    # stopping early should not leave anything hanging
+    for batch in parallel_batches(StringIO.StringIO(text), ArticleCategoriesIterator, processes=2, lines=10):
+        break
+
+    # parse errors are passed back
+    errors = ErrorSink(collect=True)
+    broken = text.replace('<http://dbpedia.org/resource/Article_500>', '<Article_500>')
+    batches = list(parallel_batches(StringIO.StringIO(broken), ArticleCategoriesIterator,
+                                    processes=2, lines=30, errors=errors))
+    nt.eq_(999, sum(len(batch) for batch in batches))
+    nt.eq_([501], [lineno for lineno, category, line in errors.entries])
+
+    # lines are only split at newlines, as when the file is read a line at a time
+    labels = '<http://dbpedia.org/resource/Category:A> <http://www.w3.org/2000/01/rdf-schema#label> "A\rB" .\n' * 3
+    expectation = CategoryLabelIterator.convert_batch(list(NTripleParser(StringIO.StringIO(labels))))
+    nt.eq_(3, len(expectation))
+    batches = list(parallel_batches(StringIO.StringIO(labels), CategoryLabelIterator, processes=2, lines=2))
+    nt.eq_(expectation, [record for batch in batches for record in batch])
+
+    # a worker that dies doesn't leave us waiting forever
+    interval = RESULT_POLL_INTERVAL
+    RESULT_POLL_INTERVAL = 0.1
+    try:
+        for ordered in [True, False]:
+            nt.assert_raises(Exception, list, parallel_batches(StringIO.StringIO(text), _DyingIterator,
+                                                               processes=2, ordered=ordered, lines=30))
+    finally:
+        RESULT_POLL_INTERVAL = interval
+
+    # errors in the workers come back to us
+    broken = '<http://dbpedia.org/resource/A> <http://www.w3.org/2004/02/skos/core#broader> <http://dbpedia.org/resource/B> .\n'
+    nt.assert_raises(Exception, list, parallel_batches(StringIO.StringIO(broken), ArticleCategoriesIterator, processes=2))
+
+if __name__ == "__main__":
+    import logging
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        _test()
+        logging.info("Tests Passed")
+    except AssertionError as e:
+        logging.error("ERROR: TESTS FAILED")
+        logging.error(e)
@@ -0,0 +1,236 @@
+"""
+This file downloads upcoming dbpedia resources in the background,
+so the network stays busy while earlier resources are being imported.
+
+A Prefetcher is given the resources in the order they will be used.
+Worker threads download a few resources ahead of the one currently
+in use; wait() blocks until a resource is ready.
+
+Downloaded resources stay pinned in the cache (see download.unpin)
+until they are released, or the Prefetcher is closed, so they aren't
+evicted before the importer gets to them.
+"""
+
+__all__ = ['Prefetcher']
+
+import threading
+
+import download
+
+import logging
+log = logging.getLogger('dbpedia.prefetch')
+
+# default number of resources to download ahead
+DEFAULT_AHEAD = 2
+
+def _key(resource):
+    return resource.dataset, resource.version, resource.language, resource.format
+
+class Prefetcher(object):
+    """
+    Downloads resources on up to ahead threads, staying at most
+    ahead resources past the last one passed to wait().
+    """
+
+    def __init__(self, resources, ahead=DEFAULT_AHEAD, retrieve=download.retrieve):
+        self.resources = list(resources)
+        self.ahead = ahead
+        self.retrieve = retrieve
+
+        # the index of each resource, to find them again in wait()
+        self.indexes = dict((_key(r), i) for i, r in enumerate(self.resources))
+
+        # the index of the resource in use, and of the next one to download
+        self.current = 0
+        self.next = 0
+        # finished downloads, mapped to an exception or None
+        self.finished = {}
+        # the local paths of downloads that are still pinned
+        self.pinned = {}
+        self.closed = False
+
+        self.condition = threading.Condition()
+
+        self.threads = []
+        for i in range(min(ahead, len(self.resources))):
+            thread = threading.Thread(target=self._work, name='prefetch-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _take(self):
+        """Waits for a resource to download, returning its index or None if there are no more"""
+        with self.condition:
+            while not self.closed and self.next < len(self.resources) \
+                    and self.next > self.current + self.ahead:
+                self.condition.wait()
+
+            if self.closed or self.next >= len(self.resources):
+                return None
+
+            index = self.next
+            self.next += 1
+            return index
+
+    def _work(self):
+        while True:
+            index = self._take()
+            if index is None:
+                return
+
+            resource = self.resources[index]
+            log.info("Prefetching %s", _key(resource))
+
+            path = None
+            try:
+                path = self.retrieve(resource, progress=False, pin=True)
+                error = None
+            except Exception as e:
+                log.warn("Could not prefetch %s: %s", _key(resource), e)
+                error = e
+
+            with self.condition:
+                self.finished[index] = error
+                if path is not None:
+                    if self.closed:
+                        download.unpin(path)
+                    else:
+                        self.pinned[index] = path
+                self.condition.notify_all()
+
+    def wait(self, resource):
+        """
+        Blocks until the resource has been downloaded, and lets
+        the workers move on to the resources after it.
+        Returns True if it was downloaded, or False if that failed
+        (in which case the caller should retrieve it as usual).
+
+        :param resource:
+        :return:
+        """
+        index = self.indexes.get(_key(resource))
+        if index is None:
+            return False
+
+        with self.condition:
+            self.current = max(self.current, index)
+            self.condition.notify_all()
+
+            while index not in self.finished and not self.closed:
+                self.condition.wait()
+
+            return index in self.finished and self.finished[index] is None
+
+    def release(self, resource):
+        """
+        Unpins a downloaded resource, once the caller is done with it
+        (or has opened it, which pins it again).
+
+        :param resource:
+        :return:
+        """
+        index = self.indexes.get(_key(resource))
+        with self.condition:
+            path = self.pinned.pop(index, None)
+        if path is not None:
+            download.unpin(path)
+
+    def close(self):
+        """
+        Stops handing out downloads (ones in progress are finished),
+        and unpins all the downloads that weren't released.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+            paths = self.pinned.values()
+            self.pinned.clear()
+
+        for path in paths:
+            download.unpin(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+def _test():
+    import nose.tools as nt
+    import bz2
+    import os
+    import shutil
+    import tempfile
+    import time
+    import urls
+    from resource import DBpediaResource
+    from testserver import TestServer
+
+    resources = [DBpediaResource(dataset=dataset, version=version, language='en', format='nt')
+                 for version in ['3.8', '3.9'] for dataset in ['category_labels', 'article_categories']]
+
+    root = tempfile.mkdtemp()
+    cache_dir = download.CACHE_DIR
+    download.CACHE_DIR = os.path.join(root, 'cache')
+    try:
+        with TestServer(os.path.join(root, 'server'), delay=0.01) as server:
+            urls.set_download_base(server.url)
+
+            for r in resources:
+                path = urls.build(r)[len(server.url):]
+                server.add_file(path, bz2.compress('<a:b> <c:d> "%s" .\n' % path * 10000))
+
+            # the first one is fetched right away, and one more ahead
+            with Prefetcher(resources, ahead=2) as prefetcher:
+                nt.ok_(prefetcher.wait(resources[0]))
+                nt.ok_(os.path.exists(download._resource_filename(resources[0])))
+
+                # nothing fetched is evicted until it is released
+                nt.eq_(0, download.evict_downloads(limit=0))
+                nt.ok_(download.has_cached(resources[0]))
+                prefetcher.release(resources[0])
+                nt.ok_(download.evict_downloads(limit=0) > 0)
+                nt.ok_(not download.has_cached(resources[0]))
+
+                time.sleep(0.5)
+                nt.eq_(3, len(server.requests))
+
+                # moving on lets it fetch the rest
+                for r in resources[1:]:
+                    nt.ok_(prefetcher.wait(r))
+                nt.eq_(4, len(server.requests))
+
+                # these are all cached now
+                for r in resources[1:]:
+                    with open(download.retrieve(r)) as f:
+                        nt.eq_(bz2.compress('<a:b> <c:d> "%s" .\n' % urls.build(r)[len(server.url):] * 10000), f.read())
+                nt.eq_(4, len(server.requests))
+
+            # and closing unpins them
+            nt.ok_(download.evict_downloads(limit=0) > 0)
+            for r in resources:
+                nt.ok_(not download.has_cached(r))
+
+            # failed downloads are reported, and leave nothing in the cache
+            missing = DBpediaResource(dataset='category_labels', version='3.7', language='en', format='nt')
+            with Prefetcher([missing], ahead=2) as prefetcher:
+                nt.ok_(not prefetcher.wait(missing))
+            nt.ok_(not os.path.exists(download._resource_filename(missing)))
+
+            # and resources it doesn't know about are left alone
+            nt.ok_(not prefetcher.wait(resources[0]))
+    finally:
+        urls.set_download_base("http://downloads.dbpedia.org")
+        download.CACHE_DIR = cache_dir
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    import logging
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        _test()
+        logging.info("Tests Passed")
+    except AssertionError as e:
+        logging.error("ERROR: TESTS FAILED")
+        logging.error(e)
@@ -0,0 +1,324 @@
+"""
+This file keeps parsed records in a compact binary form,
+next to the downloaded files in the cache.
+
+Once a resource has been parsed, its records can be saved
+as a table of interned names (stored with marshal) plus one
+array of int32 name ids per record field (stored with array).
+Loading them back skips decompression, parsing, and url decoding.
+
+Each table remembers the checksum of the download it was parsed from,
+and is ignored once the cache holds a different download of the resource.
+"""
+
+__all__ = ['RecordTable', 'Recorder', 'exists', 'load', 'save', 'clean']
+
+import os
+import shutil
+import marshal
+import time
+from array import array
+from string import Template
+
+import download
+
+import logging
+log = logging.getLogger('dbpedia.recordcache')
+
+# directory (inside the cache dir) for record tables
+RECORDS_DIR = 'records'
+# template for the directory holding the record table of a resource
+records_dir_template = Template('${version}/${language}/${format}/${dataset}')
+# the file holding the names in a record table
+NAMES_FILE = 'names.marshal'
+# the file holding the sha1 of the download a record table was parsed from
+SOURCE_FILE = 'source'
+# the array type code for name ids (32-bit ints)
+ID_TYPECODE = 'i'
+# the number of records built at once by RecordTable.records()
+BATCH_SIZE = 10000
+
+class RecordTable(object):
+    """
+    The records of one resource, stored as a list of
+    distinct names and one array of name ids for each field.
+    """
+
+    def __init__(self, fields, names=None, columns=None):
+        self.fields = tuple(fields)
+        self.names = names if names is not None else []
+        if columns is None:
+            columns = [array(ID_TYPECODE) for f in self.fields]
+        self.columns = columns
+
+        # only needed while adding records
+        self.name_ids = None
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def _intern(self, name):
+        id = self.name_ids.get(name)
+        if id is None:
+            id = len(self.names)
+            self.name_ids[name] = id
+            self.names.append(name)
+        return id
+
+    def add_batch(self, records):
+        """Adds a list of records (dictionaries, or tuples in fields order) to the table"""
+        if not records:
+            return
+
+        if self.name_ids is None:
+            self.name_ids = dict((name, id) for id, name in enumerate(self.names))
+
+        intern = self._intern
+        if isinstance(records[0], tuple):
+            for values, column in zip(zip(*records), self.columns):
+                column.extend(intern(value) for value in values)
+        else:
+            for field, column in zip(self.fields, self.columns):
+                column.extend(intern(record[field]) for record in records)
+
+    def batches(self, size, compact=False):
+        """
+        Generates lists of up to size records.
+        The records are dictionaries, or tuples in fields order if compact is True.
+        """
+        names = self.names
+        fields = self.fields
+        for start in xrange(0, len(self), size):
+            slices = [[names[id] for id in column[start:start + size]] for column in self.columns]
+            if compact:
+                yield zip(*slices)
+            else:
+                yield [dict(zip(fields, values)) for values in zip(*slices)]
+
+    def records(self):
+        """Generates record dictionaries"""
+        for batch in self.batches(BATCH_SIZE):
+            for record in batch:
+                yield record
+
+class Recorder(object):
+    """
+    Wraps an iterator over lists of records and builds up a RecordTable
+    from them. The table is saved for the resource only once the
+    iterator has been used up, so partial imports are never cached.
+    """
+
+    def __init__(self, resource, batches, fields):
+        self.resource = resource
+        self.batches = batches
+        self.table = RecordTable(fields)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            records = self.batches.next()
+        except StopIteration:
+            save(self.resource, self.table)
+            raise
+
+        self.table.add_batch(records)
+        return records
+
+def _records_dirname(resource):
+    """
+    Gets the cache directory for the record table of a dbpedia resource.
+
+    :param resource:
+    :return:
+    """
+    dirname = records_dir_template.substitute(dataset=resource.dataset,
+                                              language=resource.language,
+                                              version=resource.version,
+                                              format=resource.format)
+    return os.path.abspath(os.path.join(download.CACHE_DIR, RECORDS_DIR, dirname))
+
+def exists(resource):
+    """
+    Check if there is a saved record table for a resource, that was
+    parsed from the download in the cache (if there is one).
+
+    :param resource:
+    :return:
+    """
+    dirname = _records_dirname(resource)
+    if not os.path.exists(os.path.join(dirname, NAMES_FILE)):
+        return False
+
+    # the download may have gone since, but not been replaced
+    sha1 = download.cached_sha1(resource)
+    if sha1 is None:
+        return True
+
+    source_filename = os.path.join(dirname, SOURCE_FILE)
+    if os.path.exists(source_filename):
+        with open(source_filename) as f:
+            if f.read() == sha1:
+                return True
+
+    log.info("Ignoring record cache for %s, which wasn't parsed from the cached download", dirname)
+    return False
+
+def save(resource, table):
+    """
+    Save a record table for a resource.
+
+    :param resource:
+    :param table:
+    :return:
+    """
+    dirname = _records_dirname(resource)
+
+    before = time.time()
+
+    # write to a temporary directory, so a partial table is never used
+    temp_dirname = dirname + '.tmp'
+    if os.path.exists(temp_dirname):
+        shutil.rmtree(temp_dirname)
+    os.makedirs(temp_dirname)
+
+    for field, column in zip(table.fields, table.columns):
+        with open(os.path.join(temp_dirname, field), 'wb') as f:
+            column.tofile(f)
+
+    sha1 = download.cached_sha1(resource)
+    if sha1 is not None:
+        with open(os.path.join(temp_dirname, SOURCE_FILE), 'w') as f:
+            f.write(sha1)
+
+    # the names file goes last, since exists() looks for it
+    with open(os.path.join(temp_dirname, NAMES_FILE), 'wb') as f:
+        marshal.dump((table.fields, table.names), f)
+
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+    os.rename(temp_dirname, dirname)
+
+    log.info("Saved %d records with %d names to %s in %fs",
+             len(table), len(table.names), dirname, time.time() - before)
+
+def load(resource):
+    """
+    Load the saved record table for a resource.
+
+    :param resource:
+    :return:
+    """
+    dirname = _records_dirname(resource)
+
+    before = time.time()
+
+    with open(os.path.join(dirname, NAMES_FILE), 'rb') as f:
+        fields, names = marshal.load(f)
+
+    columns = []
+    for field in fields:
+        path = os.path.join(dirname, field)
+        column = array(ID_TYPECODE)
+        with open(path, 'rb') as f:
+            column.fromfile(f, os.path.getsize(path) // column.itemsize)
+        columns.append(column)
+
+    table = RecordTable(fields, names, columns)
+
+    log.info("Loaded %d records with %d names from %s in %fs",
+             len(table), len(names), dirname, time.time() - before)
+
+    return table
+
+def clean(resource):
+    """
+    Remove the saved record table for a resource, if there is one.
+
+    :param resource:
+    :return:
+    """
+    dirname = _records_dirname(resource)
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+        log.info("Cleaned record cache for %s", dirname)
+
+def _test():
+    import nose.tools as nt
+    import tempfile
+    from resource import DBpediaResource
+
+    # work in an empty cache, leaving the real one alone
+    cache_dir = download.CACHE_DIR
+    download.CACHE_DIR = tempfile.mkdtemp()
+    try:
+        r = DBpediaResource(dataset="category_categories", version='3.8', language='en', format='nt')
+        nt.ok_(not exists(r))
+
+        records = [
+            {'narrower': u'Category:Algebra', 'broader': u'Category:Mathematics'},
+            {'narrower': u'Category:Linear_algebra', 'broader': u'Category:Algebra'},
+            {'narrower': u'Category:Caf\xe9s', 'broader': u'Category:Restaurants'},
+        ]
+
+        # a partially used recorder saves nothing
+        recorder = Recorder(r, [records[:2], records[2:]].__iter__(), ('narrower', 'broader'))
+        recorder.next()
+        nt.ok_(not exists(r))
+
+        # but a finished one does
+        nt.eq_([records[2:]], list(recorder))
+        nt.ok_(exists(r))
+
+        table = load(r)
+        nt.eq_(3, len(table))
+        nt.eq_(5, len(table.names))
+        nt.eq_(records, list(table.records()))
+        nt.eq_([records[:2], records[2:]], list(table.batches(2)))
+
+        tuples = [(record['narrower'], record['broader']) for record in records]
+        nt.eq_([tuples[:2], tuples[2:]], list(table.batches(2, compact=True)))
+
+        # records can be added to a loaded table
+        table.add_batch([{'narrower': u'Category:Algebra', 'broader': u'Category:Abstract_algebra'}])
+        nt.eq_(6, len(table.names))
+        nt.eq_(4, len(table))
+
+        # as tuples too
+        table.add_batch([(u'Category:Abstract_algebra', u'Category:Mathematics')])
+        nt.eq_(6, len(table.names))
+        nt.eq_((u'Category:Abstract_algebra', u'Category:Mathematics'), list(table.batches(1, compact=True))[-1][0])
+
+        clean(r)
+        nt.ok_(not exists(r))
+
+        # tables are kept for the download they were parsed from
+        from manifest import Manifest
+        manifest = Manifest(download.CACHE_DIR)
+        local_name = download._resource_filename(r)
+        manifest.update(local_name, size=10, sha1='abc')
+        save(r, RecordTable(('narrower', 'broader')))
+        nt.ok_(exists(r))
+
+        # and ignored once it is replaced
+        manifest.update(local_name, size=12, sha1='def')
+        nt.ok_(not exists(r))
+
+        # but not just because it was evicted
+        manifest.remove(local_name)
+        nt.ok_(exists(r))
+    finally:
+        shutil.rmtree(download.CACHE_DIR)
+        download.CACHE_DIR = cache_dir
+
+if __name__ == "__main__":
+    import logging
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        _test()
+        logging.info("Tests Passed")
+    except AssertionError as e:
+        logging.error("ERROR: TESTS FAILED")
+        logging.error(e)
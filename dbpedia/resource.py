@@ -4,8 +4,16 @@
 
 __all__ = ['DBpediaResource', 'dataset_names', 'version_names']
 
+import os
+import mmap as mmap_module
 import bz2file as bz2
 import download
+import recordcache
+from bz2blocks import ParallelBZ2File
+from streaming import StreamingBZ2File
+
+import logging
+log = logging.getLogger('dbpedia.resource')
 
 dataset_names = [
     'category_categories',
@@ -52,6 +60,70 @@ version_dates = {
 # The size of the buffer for bz2 decompression
 BZ2_BUFFER_SIZE = 10 * 1024
 
+class MappedFile(object):
+    """
+    A read-only, memory-mapped file that can be
+    read and iterated over like a regular file.
+    """
+
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        self.map = mmap_module.mmap(self.file.fileno(), 0, access=mmap_module.ACCESS_READ)
+
+    def read(self, size=-1):
+        if size < 0:
+            return self.map.read(self.map.size() - self.map.tell())
+        return self.map.read(size)
+
+    def readline(self):
+        return self.map.readline()
+
+    def __iter__(self):
+        return iter(self.map.readline, '')
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type=None, exc_val=None, exc_tb=None):
+        self.close()
+
+class PinnedFile(object):
+    """
+    A file opened from the cache, which keeps the cached file
+    pinned (see download.unpin) until the file is closed.
+    """
+
+    def __init__(self, file, local_filename):
+        self.file = file
+        self.local_filename = local_filename
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def readline(self):
+        return self.file.readline()
+
+    def __iter__(self):
+        return self.file.__iter__()
+
+    def close(self):
+        try:
+            self.file.close()
+        finally:
+            if self.local_filename is not None:
+                download.unpin(self.local_filename)
+                self.local_filename = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type=None, exc_val=None, exc_tb=None):
+        self.close()
+
 class DBpediaResource(object):
     """
     Class for representing a DBpedia resource.
@@ -77,19 +149,65 @@ class DBpediaResource(object):
         self.format = format
         self.date = version_dates.get(self.version) # defaults to None
 
-    def get_file(self):
+    def get_file(self, processes=None, mmap=False, stream=False):
         """
         Downloads the resource if necessary and opens an
         uncompressed stream for reading.
+
+        A decompressed copy from the cache is used if there is one
+        (or if the decompressed cache is turned on), in which case
+        it can be memory-mapped instead of read normally.
+
+        If stream is True and the file isn't in the cache yet, it is
+        decompressed while it downloads.
+
+        Otherwise, if processes is more than 1, the file is decompressed
+        by that many worker processes.
+
+        Whichever way the file is read, lines come out as byte strings.
+        The cached file stays pinned until the file is closed.
         """
-        local_filename = download.retrieve(self)
-        return bz2.open(local_filename, mode='rt')
+        if download.DECOMPRESSED_CACHE or download.has_decompressed(self):
+            local_filename = download.retrieve_decompressed(self, pin=True)
+            try:
+                # empty files can't be mapped
+                if mmap and os.path.getsize(local_filename) > 0:
+                    f = MappedFile(local_filename)
+                else:
+                    f = open(local_filename, 'r')
+            except Exception:
+                download.unpin(local_filename)
+                raise
+
+            return PinnedFile(f, local_filename)
+
+        if stream and not download.has_cached(self):
+            return StreamingBZ2File(self)
+
+        local_filename = download.retrieve(self, pin=True)
+        try:
+            f = None
+            if processes is not None and processes > 1:
+                try:
+                    # (which falls back to sequential decompression itself if a block is bad)
+                    f = ParallelBZ2File(local_filename, processes=processes)
+                except IOError as e:
+                    log.warn("Could not decompress %s in parallel (%s), decompressing it sequentially",
+                             local_filename, e)
+            if f is None:
+                f = bz2.open(local_filename, mode='rb')
+        except Exception:
+            download.unpin(local_filename)
+            raise
+
+        return PinnedFile(f, local_filename)
 
     def clean(self):
         """
         removes any local cached file for this resource
         """
         download.clean(self)
+        recordcache.clean(self)
 
     @staticmethod
     def clean_all():
@@ -101,6 +219,36 @@ class DBpediaResource(object):
 
 def _test():
     import nose.tools as nt
+    import shutil
+    import tempfile
+    import bz2 as bz2_module
+
+    # every way of reading a file gives the same byte strings
+    cache_dir = download.CACHE_DIR
+    download.CACHE_DIR = tempfile.mkdtemp()
+    try:
+        fake = DBpediaResource(dataset="category_labels", version='3.8', language='en', format='nt')
+        text = '<a:b> <c:d> "Caf\xc3\xa9" .\n' * 100
+        with open(download._resource_filename(fake), 'wb') as f:
+            f.write(bz2_module.compress(text))
+
+        for options in [{}, {'processes': 2}]:
+            with fake.get_file(**options) as f:
+                lines = list(f)
+            nt.eq_(text.splitlines(True), lines)
+            nt.eq_(set([str]), set(type(line) for line in lines))
+
+        decompressed = download.retrieve_decompressed(fake)
+        manifest = download.Manifest(download.CACHE_DIR)
+        for options in [{}, {'mmap': True}]:
+            with fake.get_file(**options) as f:
+                nt.eq_(text, f.read())
+                # the copy isn't evicted while it is open
+                nt.eq_([os.getpid()], manifest.get(decompressed)['pins'])
+            nt.eq_([], manifest.get(decompressed)['pins'])
+    finally:
+        shutil.rmtree(download.CACHE_DIR)
+        download.CACHE_DIR = cache_dir
 
     res = DBpediaResource(dataset="category_labels",
                           version='3.9',
@@ -0,0 +1,315 @@
+"""
+This file reads a dbpedia file while it is still downloading.
+
+A background thread downloads the resource into the cache as usual,
+handing each chunk to a queue as it arrives. The reader decompresses
+chunks from the queue, so parsing (and importing) can start right away
+instead of waiting for the whole archive.
+"""
+
+__all__ = ['StreamingBZ2File']
+
+import bz2
+import Queue
+import threading
+
+import download
+
+import logging
+log = logging.getLogger('dbpedia.streaming')
+
+# the most downloaded chunks waiting to be decompressed
+QUEUE_CHUNKS = 64
+# how often (in seconds) a blocked download checks whether it was cancelled
+CANCEL_CHECK_INTERVAL = 0.1
+# how long (in seconds) close waits for the download to stop
+CLOSE_TIMEOUT = 5
+
+# put on the queue after the last chunk
+_END = object()
+
+class StreamingBZ2File(object):
+    """
+    A read-only, file-like stream of the decompressed contents of a
+    resource, available while the resource downloads. The download is
+    cached (and resumed, if it is interrupted) just like download.retrieve.
+
+    Errors downloading the file are raised when reading from it.
+    The download stays pinned in the cache until the stream is closed.
+    """
+
+    def __init__(self, resource, queue_chunks=QUEUE_CHUNKS, progress=False):
+        self.resource = resource
+        self.progress = progress
+        self.queue = Queue.Queue(maxsize=queue_chunks)
+
+        # the compressed bytes passed to the queue so far
+        self.received = 0
+        self.cancelled = False
+        # the pinned download, once there is one
+        self.local_name = None
+        # so the pin is only dropped once, by close or by a download that outlives it
+        self.pin_lock = threading.Lock()
+
+        self.decompressor = bz2.BZ2Decompressor()
+        # decompressed data not yet read, starting at pos
+        self.buffer = ''
+        self.pos = 0
+        self.finished = False
+
+        self.thread = threading.Thread(target=self._download, name='stream-download')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, item):
+        # waits for room in the queue, unless the reader has gone away
+        while True:
+            if self.cancelled:
+                raise download.DownloadCancelled()
+            try:
+                self.queue.put(item, timeout=CANCEL_CHECK_INTERVAL)
+                return
+            except Queue.Full:
+                pass
+
+    def _consume(self, offset, chunk):
+        """Called by download.retrieve with every chunk of the file"""
+        end = offset + len(chunk)
+        if end <= self.received:
+            # the download started over, and we have this already
+            if self.cancelled:
+                raise download.DownloadCancelled()
+            return
+
+        self._put(chunk[self.received - offset:] if offset < self.received else chunk)
+        self.received = end
+
+    def _download(self):
+        try:
+            self.local_name = download.retrieve(self.resource, progress=self.progress,
+                                                consume=self._consume, pin=True)
+
+            # whatever didn't come through consume (if it was cached already)
+            with open(self.local_name, 'rb') as f:
+                f.seek(self.received)
+                while True:
+                    chunk = f.read(download.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    self._put(chunk)
+                    self.received += len(chunk)
+
+            self._put(_END)
+        except download.DownloadCancelled:
+            log.info("Stopped streaming %s", self.resource.dataset)
+        except Exception as e:
+            log.warn("Could not stream %s: %s", self.resource.dataset, e)
+            try:
+                self._put(e)
+            except download.DownloadCancelled:
+                pass
+        finally:
+            if self.cancelled:
+                self._unpin()
+
+    def _unpin(self):
+        with self.pin_lock:
+            if self.local_name is not None:
+                download.unpin(self.local_name)
+                self.local_name = None
+
+    def _fill(self):
+        """
+        Decompresses the next chunk into the buffer.
+        Returns False if there is nothing left.
+        """
+        if self.finished:
+            return False
+
+        item = self.queue.get()
+        if item is _END:
+            self.finished = True
+            return False
+        if isinstance(item, Exception):
+            self.finished = True
+            raise item
+
+        data = item
+        decompressed = []
+        while data:
+            try:
+                decompressed.append(self.decompressor.decompress(data))
+            except EOFError:
+                # the last stream ended right at the end of a chunk
+                self.decompressor = bz2.BZ2Decompressor()
+                continue
+
+            # files can hold several bz2 streams, one after another
+            data = self.decompressor.unused_data
+            if data:
+                self.decompressor = bz2.BZ2Decompressor()
+
+        self.buffer = self.buffer[self.pos:] + ''.join(decompressed)
+        self.pos = 0
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) - self.pos < size:
+            if not self._fill():
+                break
+
+        if size < 0:
+            size = len(self.buffer) - self.pos
+        data = self.buffer[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def readline(self):
+        while True:
+            end = self.buffer.find('\n', self.pos)
+            if end >= 0:
+                line = self.buffer[self.pos:end + 1]
+                self.pos = end + 1
+                return line
+
+            if not self._fill():
+                return self.read()
+
+    def __iter__(self):
+        while True:
+            last = self.buffer.rfind('\n', self.pos)
+            if last >= 0:
+                # hand out all the complete lines in the buffer
+                lines = self.buffer[self.pos:last].split('\n')
+                self.pos = last + 1
+                for line in lines:
+                    yield line + '\n'
+            elif not self._fill():
+                rest = self.read()
+                if rest:
+                    yield rest
+                return
+
+    def close(self):
+        """Stops the download, if it is still going (what was downloaded is kept)"""
+        self.cancelled = True
+        self.thread.join(CLOSE_TIMEOUT)
+
+        if self.thread.is_alive():
+            # stuck waiting on the server; it stops (and unpins) when that times out
+            log.warn("Download of %s is still stopping, leaving it in the background", self.resource.dataset)
+            return
+
+        self._unpin()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type=None, exc_val=None, exc_tb=None):
+        self.close()
+
+def _test():
+    global CLOSE_TIMEOUT
+    import nose.tools as nt
+    import os
+    import time
+    import shutil
+    import tempfile
+    import urls
+    from resource import DBpediaResource
+    from testserver import TestServer
+    from ntparser import NTripleParser
+
+    root = tempfile.mkdtemp()
+    cache_dir = download.CACHE_DIR
+    download.CACHE_DIR = os.path.join(root, 'cache')
+    try:
+        with TestServer(os.path.join(root, 'server'), delay=0.001) as server:
+            urls.set_download_base(server.url)
+
+            r = DBpediaResource(dataset="category_labels", version='3.9', language='en', format='nt')
+            text = ''.join('<a:b%d> <c:d> "e" .\n' % i for i in range(100000))
+            # two bz2 streams in one file
+            half = text.index('\n', len(text) // 2) + 1
+            data = bz2.compress(text[:half]) + bz2.compress(text[half:])
+            server.add_file(urls.build(r)[len(server.url):], data)
+
+            # lines come out while the download is cut off and resumed
+            server.cut_next(len(data) // 3)
+            with StreamingBZ2File(r, queue_chunks=2) as f:
+                nt.eq_(text.splitlines(True), list(f))
+            nt.eq_(2, len(server.requests))
+
+            # and the file is cached, and in the manifest
+            nt.ok_(download.verify(r))
+            with open(download._resource_filename(r), 'rb') as f:
+                nt.eq_(data, f.read())
+
+            # streaming a cached file reads it from the cache
+            with StreamingBZ2File(r) as f:
+                nt.eq_(text[:10], f.read(10))
+                nt.eq_(text[10:text.index('\n') + 1], f.readline())
+                triples = list(NTripleParser(f))
+
+                # an open stream keeps its download from being evicted
+                nt.eq_(0, download.evict_downloads(limit=0))
+            nt.eq_(99999, len(triples))
+            nt.eq_(2, len(server.requests))
+            nt.eq_(len(data), download.evict_downloads(limit=0))
+
+            # if the server ignores ranges, the download starts over without repeating lines
+            download.clean(r)
+            server.server.ranges = False
+            server.cut_next(len(data) // 2)
+            with StreamingBZ2File(r, queue_chunks=2) as f:
+                nt.eq_(text, f.read())
+            nt.ok_(download.verify(r))
+
+            # stopping early leaves the rest of the download for later
+            big = DBpediaResource(dataset="article_categories", version='3.9', language='en', format='nt')
+            data = bz2.compress(text * 20)
+            server.add_file(urls.build(big)[len(server.url):], data)
+            with StreamingBZ2File(big, queue_chunks=1) as f:
+                nt.eq_(text.splitlines(True)[0], f.readline())
+            nt.ok_(not download.has_cached(big))
+            nt.ok_(0 < os.path.getsize(download._resource_filename(big) + download.PART_SUFFIX) < len(data))
+
+            # closing doesn't wait long for a download stuck on the server, which times out later
+            stalled = DBpediaResource(dataset="article_categories", version='3.8', language='en', format='nt')
+            server.add_file(urls.build(stalled)[len(server.url):], data)
+            settings = CLOSE_TIMEOUT, download.DOWNLOAD_TIMEOUT, download.DOWNLOAD_ATTEMPTS
+            try:
+                CLOSE_TIMEOUT = 0.1
+                download.DOWNLOAD_TIMEOUT = 1
+                download.DOWNLOAD_ATTEMPTS = 1
+                server.server.delay = 5
+                f = StreamingBZ2File(stalled)
+                before = time.time()
+                f.close()
+                nt.ok_(time.time() - before < 1)
+                nt.ok_(f.thread.is_alive())
+                f.thread.join(5)
+                nt.ok_(not f.thread.is_alive())
+            finally:
+                CLOSE_TIMEOUT, download.DOWNLOAD_TIMEOUT, download.DOWNLOAD_ATTEMPTS = settings
+                server.server.delay = 0.001
+
+            # download errors come out when reading
+            missing = DBpediaResource(dataset="category_labels", version='3.8', language='en', format='nt')
+            with StreamingBZ2File(missing) as f:
+                nt.assert_raises(IOError, f.read)
+    finally:
+        urls.set_download_base("http://downloads.dbpedia.org")
+        download.CACHE_DIR = cache_dir
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    import logging
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        _test()
+        logging.info("Tests Passed")
+    except AssertionError as e:
+        logging.error("ERROR: TESTS FAILED")
+        logging.error(e)
@@ -0,0 +1,224 @@
+"""
+This file generates synthetic DBpedia N-Triples files,
+for testing and benchmarking without downloading the real dumps.
+
+The generated lines look like the ones in the real datasets,
+with settings for the number of lines, how often names need
+escaping, how many names are non-ASCII, and how many categories
+each article (or category) belongs to.
+"""
+
+__all__ = ['generate', 'write', 'DEFAULT_LINES']
+
+import bz2
+import itertools
+import random
+import urllib
+
+from resource import dataset_names
+
+DEFAULT_LINES = 100000
+# the fraction of names containing characters that must be escaped
+DEFAULT_ESCAPE_DENSITY = 0.02
+# the fraction of names containing non-ASCII characters
+DEFAULT_UNICODE_SHARE = 0.05
+# the average number of categories per article, or broader categories per category
+DEFAULT_FANOUT = 4
+# higher values make a few popular categories much more common
+CATEGORY_SKEW = 3
+
+RESOURCE_BASE = 'http://dbpedia.org/resource/'
+SUBJECT = '<http://purl.org/dc/terms/subject>'
+LABEL = '<http://www.w3.org/2000/01/rdf-schema#label>'
+TYPE = '<http://www.w3.org/1999/02/22-rdf-syntax-ns#type>'
+CONCEPT = '<http://www.w3.org/2004/02/skos/core#Concept>'
+PREF_LABEL = '<http://www.w3.org/2004/02/skos/core#prefLabel>'
+BROADER = '<http://www.w3.org/2004/02/skos/core#broader>'
+
+WORDS = ['History', 'Science', 'Films', 'People', 'Music', 'Sports',
+         'Geography', 'Politics', 'Mathematics', 'Television', 'Novels', 'Rivers']
+UNICODE_WORDS = [u'Caf\xe9s', u'M\xfcnchen', u'S\xe3o_Paulo', u'\u0141\xf3d\u017a',
+                 u'\u6771\u4eac', u'\u041c\u043e\u0441\u043a\u0432\u0430']
+# characters that are percent-escaped in dbpedia resource urls
+ESCAPED_CHARACTERS = ['"', '%', '?', '^', '`']
+# characters that are left alone in dbpedia resource urls
+URL_SAFE = "/:_(),'!*;&=+$@-.~"
+
+def _name(rnd, prefix, number, escape_density, unicode_share):
+    """Makes up a unicode name, like Category:Films_12"""
+    if rnd.random() < unicode_share:
+        word = rnd.choice(UNICODE_WORDS)
+    else:
+        word = rnd.choice(WORDS)
+
+    if rnd.random() < escape_density:
+        return u'%s%s_%s%d' % (prefix, word, rnd.choice(ESCAPED_CHARACTERS), number)
+
+    return u'%s%s_%d' % (prefix, word, number)
+
+def _uri(name):
+    return '<%s%s>' % (RESOURCE_BASE, urllib.quote(name.encode('utf-8'), safe=URL_SAFE))
+
+def _literal(text):
+    """Quotes text as an N-Triples literal, escaping as needed"""
+    text = text.replace('\\', '\\\\').replace('"', '\\"')
+    text = ''.join(c if ord(c) < 128 else '\\u%04X' % ord(c) for c in text)
+    return '"%s"@en' % text.encode('ascii')
+
+def _label(name):
+    return name[len('Category:'):].replace('_', ' ')
+
+def _category_names(rnd, count, escape_density, unicode_share):
+    return [_name(rnd, u'Category:', i, escape_density, unicode_share) for i in xrange(count)]
+
+def _pick(rnd, items, fanout):
+    """
+    Picks around fanout distinct items (always at least one),
+    favoring the ones at the start of the list.
+    """
+    count = len(items)
+    picked = set(items[int(count * rnd.random() ** CATEGORY_SKEW)]
+                 for i in xrange(rnd.randint(1, 2 * fanout - 1)))
+    return sorted(picked)
+
+def _article_categories(rnd, lines, escape_density, unicode_share, fanout):
+    categories = [_uri(name) for name in
+                  _category_names(rnd, max(1, lines // (fanout * 5)), escape_density, unicode_share)]
+
+    article = 0
+    while True:
+        subject = _uri(_name(rnd, u'', article, escape_density, unicode_share))
+        for category in _pick(rnd, categories, fanout):
+            yield '%s %s %s .\n' % (subject, SUBJECT, category)
+        article += 1
+
+def _category_labels(rnd, lines, escape_density, unicode_share, fanout):
+    category = 0
+    while True:
+        name = _name(rnd, u'Category:', category, escape_density, unicode_share)
+        yield '%s %s %s .\n' % (_uri(name), LABEL, _literal(_label(name)))
+        category += 1
+
+def _category_categories(rnd, lines, escape_density, unicode_share, fanout):
+    uris = []
+    while True:
+        name = _name(rnd, u'Category:', len(uris), escape_density, unicode_share)
+        subject = _uri(name)
+
+        # each category has a type, a label, and some broader categories
+        yield '%s %s %s .\n' % (subject, TYPE, CONCEPT)
+        yield '%s %s %s .\n' % (subject, PREF_LABEL, _literal(_label(name)))
+
+        # broader categories come from earlier in the list, so there are no cycles
+        if uris:
+            for broader in _pick(rnd, uris, fanout):
+                yield '%s %s %s .\n' % (subject, BROADER, broader)
+
+        uris.append(subject)
+
+_generators = {
+    'article_categories': _article_categories,
+    'category_labels': _category_labels,
+    'category_categories': _category_categories,
+}
+
+def generate(dataset, lines=DEFAULT_LINES, escape_density=DEFAULT_ESCAPE_DENSITY,
+             unicode_share=DEFAULT_UNICODE_SHARE, fanout=DEFAULT_FANOUT, seed=0):
+    """
+    Generates the lines (with line endings) of a synthetic N-Triples file
+    for one of the dbpedia datasets. The same settings always give the same lines.
+
+    :param dataset: one of the resource.dataset_names
+    :param lines: the number of triples to generate
+    :param escape_density: the fraction of names with escaped characters
+    :param unicode_share: the fraction of names with non-ASCII characters
+    :param fanout: the average number of categories per article or category
+    :param seed: for the random number generator
+    :return:
+    """
+    if dataset not in dataset_names:
+        raise Exception("Unknown dataset %s" % dataset)
+
+    rnd = random.Random(seed)
+    # the generators go on forever
+    triples = _generators[dataset](rnd, lines, escape_density, unicode_share, fanout)
+
+    yield '# started synthetic %s\n' % dataset
+    for line in itertools.islice(triples, lines):
+        yield line
+    yield '# completed synthetic %s\n' % dataset
+
+def write(filename, dataset, **settings):
+    """
+    Write a synthetic N-Triples file, bz2-compressed if the filename ends with .bz2.
+    The settings are passed on to generate().
+
+    :param filename:
+    :param dataset:
+    :return: the number of (uncompressed) bytes written
+    """
+    if filename.endswith('.bz2'):
+        f = bz2.BZ2File(filename, 'w')
+    else:
+        f = open(filename, 'wb')
+
+    size = 0
+    with f:
+        for line in generate(dataset, **settings):
+            f.write(line)
+            size += len(line)
+
+    return size
+
+def _test():
+    import nose.tools as nt
+    from ntparser import NTripleParser
+    from errors import ErrorSink
+    from datasets import iterator_mapping
+
+    for dataset in dataset_names:
+        lines = list(generate(dataset, lines=500, escape_density=0.2, unicode_share=0.2))
+        nt.eq_(502, len(lines))
+
+        # the lines should all be parseable, by both parsers
+        for fast in (True, False):
+            parser = NTripleParser(lines, fast=fast, errors=ErrorSink(collect=True))
+            triples = list(parser)
+            nt.eq_(500, len(triples))
+            nt.eq_([], parser.errors.entries)
+
+        # and turn into records
+        iteratorClass = iterator_mapping[dataset]
+        records = iteratorClass.convert_batch(triples)
+        nt.ok_(len(records) > 0)
+
+        names = [name for record in records for name in record.values()]
+        nt.ok_(any(ord(c) > 127 for name in names for c in name))
+        nt.ok_(any(c in name for name in names for c in ESCAPED_CHARACTERS))
+
+        # the same settings give the same file
+        nt.eq_(lines, list(generate(dataset, lines=500, escape_density=0.2, unicode_share=0.2)))
+
+    # plain names only
+    lines = list(generate('article_categories', lines=200, escape_density=0, unicode_share=0))
+    nt.ok_(all('%' not in line for line in lines))
+
+    # more categories per article
+    for fanout in (1, 10):
+        triples = list(NTripleParser(generate('article_categories', lines=2000, fanout=fanout)))
+        articles = len(set(subject for subject, predicate, object in triples))
+        nt.ok_(fanout / 3.0 < len(triples) / float(articles) < fanout * 2)
+
+    # without repeating an article's categories
+    nt.eq_(len(triples), len(set(triples)))
+
+if __name__ == "__main__":
+    import logging
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        _test()
+        logging.info("Tests Passed")
+    except AssertionError as e:
+        logging.error("ERROR: TESTS FAILED")
+        logging.error(e)
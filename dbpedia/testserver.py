@@ -0,0 +1,260 @@
+"""
+This file runs a small HTTP server in a background thread,
+standing in for downloads.dbpedia.org in tests.
+"""
+
+__all__ = ['TestServer']
+
+import os
+import re
+import time
+import shutil
+import hashlib
+import threading
+import BaseHTTPServer
+import SimpleHTTPServer
+
+# bytes sent at a time, so downloads can be slowed down
+SEND_CHUNK_SIZE = 16 * 1024
+
+class _Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+
+    def translate_path(self, path):
+        # serve from the server's root rather than the current directory
+        path = SimpleHTTPServer.SimpleHTTPRequestHandler.translate_path(self, path)
+        return os.path.join(self.server.root, os.path.relpath(path, os.getcwd()))
+
+    def _send_head(self):
+        """
+        Sends the headers for a file, honoring simple Range headers
+        (and If-Range, with the file's ETag or Last-Modified date).
+        Returns the open file, positioned at the first byte to send, or None.
+        """
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404, "File not found")
+            return None
+
+        size = os.path.getsize(path)
+        start = 0
+
+        with open(path, 'rb') as f:
+            etag = '"%s"' % hashlib.sha1(f.read()).hexdigest()
+        last_modified = self.date_time_string(int(os.path.getmtime(path)))
+
+        # a range of a file that has changed is no use, so the whole file is sent instead
+        if_range = self.headers.get('If-Range')
+        unchanged = if_range is None or if_range in (etag, last_modified)
+
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if match and self.server.ranges and unchanged:
+            start = int(match.group(1))
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.end_headers()
+                return None
+
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, size - 1, size))
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        if self.server.chunked and self.command == 'GET':
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Content-Length', str(size - start))
+        self.end_headers()
+
+        f = open(path, 'rb')
+        f.seek(start)
+        return f
+
+    def do_HEAD(self):
+        f = self._send_head()
+        if f is not None:
+            f.close()
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.server.ranges_requested.append(self.headers.get('Range'))
+
+        chunked = self.server.chunked
+        if chunked:
+            # chunked responses need HTTP/1.1
+            self.protocol_version = 'HTTP/1.1'
+            self.close_connection = 1
+
+        f = self._send_head()
+        if f is None:
+            return
+
+        # stop early if we've been told to break the next download
+        limit = self.server.cut
+        self.server.cut = None
+
+        with f:
+            sent = 0
+            while limit is None or sent < limit:
+                chunk = f.read(SEND_CHUNK_SIZE if limit is None else min(SEND_CHUNK_SIZE, limit - sent))
+                if not chunk:
+                    break
+                if not chunked:
+                    self.wfile.write(chunk)
+                elif limit is not None and sent + len(chunk) >= limit:
+                    # promise one more byte than is sent, so the cut can be told from the end
+                    self.wfile.write('%x\r\n%s' % (len(chunk) + 1, chunk))
+                else:
+                    self.wfile.write('%x\r\n%s\r\n' % (len(chunk), chunk))
+                sent += len(chunk)
+                if self.server.delay:
+                    time.sleep(self.server.delay)
+
+            if chunked and limit is None:
+                self.wfile.write('0\r\n\r\n')
+
+        if limit is not None:
+            self.close_connection = 1
+
+    def log_message(self, format, *args):
+        pass
+
+class _Server(BaseHTTPServer.HTTPServer):
+    # so requests don't queue up behind a slow download
+    def process_request(self, request, client_address):
+        thread = threading.Thread(target=self._handle, args=(request, client_address))
+        thread.daemon = True
+        thread.start()
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+class TestServer(object):
+    """
+    Serves the files in a directory on a free local port.
+    The paths requested so far are kept in the requests list,
+    and their Range headers in the ranges_requested list.
+
+    If delay is given, the server sleeps that many seconds
+    after sending each chunk of a file.
+
+    If ranges is False, Range headers are ignored.
+
+    If chunked is True, files are sent with chunked transfer encoding,
+    without a Content-Length.
+    """
+
+    def __init__(self, root, delay=0, ranges=True, chunked=False):
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.root = os.path.abspath(root)
+        self.server.delay = delay
+        self.server.ranges = ranges
+        self.server.chunked = chunked
+        self.server.requests = []
+        self.server.ranges_requested = []
+        self.server.cut = None
+
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.thread = None
+
+    @property
+    def requests(self):
+        return self.server.requests
+
+    @property
+    def ranges_requested(self):
+        return self.server.ranges_requested
+
+    def cut_next(self, bytes):
+        """Drops the connection after sending this many bytes of the next file"""
+        self.server.cut = bytes
+
+    def add_file(self, path, data):
+        """Puts a file on the server, at the given url path"""
+        filename = os.path.join(self.server.root, path.lstrip('/'))
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'wb') as f:
+            f.write(data)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+def _test():
+    import nose.tools as nt
+    import tempfile
+    import requests
+
+    root = tempfile.mkdtemp()
+    try:
+        with TestServer(root) as server:
+            server.add_file('/3.9/en/test.nt.bz2', 'hello' * 10000)
+
+            response = requests.get(server.url + '/3.9/en/test.nt.bz2')
+            nt.eq_(200, response.status_code)
+            nt.eq_('hello' * 10000, response.content)
+
+            response = requests.get(server.url + '/missing')
+            nt.eq_(404, response.status_code)
+
+            nt.eq_(['/3.9/en/test.nt.bz2', '/missing'], server.requests)
+
+            # part of a file
+            response = requests.get(server.url + '/3.9/en/test.nt.bz2', headers={'Range': 'bytes=49990-'})
+            nt.eq_(206, response.status_code)
+            nt.eq_('bytes 49990-49999/50000', response.headers['Content-Range'])
+            nt.eq_('hello' * 2, response.content)
+            nt.eq_('bytes=49990-', server.ranges_requested[-1])
+
+            response = requests.head(server.url + '/3.9/en/test.nt.bz2')
+            nt.eq_('50000', response.headers['Content-Length'])
+
+            # ranges are only sent while the file is the one If-Range names
+            etag = response.headers['ETag']
+            last_modified = response.headers['Last-Modified']
+            for validator in [etag, last_modified]:
+                response = requests.get(server.url + '/3.9/en/test.nt.bz2',
+                                        headers={'Range': 'bytes=49990-', 'If-Range': validator})
+                nt.eq_(206, response.status_code)
+
+            server.add_file('/3.9/en/test.nt.bz2', 'goodbye' * 10000)
+            response = requests.get(server.url + '/3.9/en/test.nt.bz2',
+                                    headers={'Range': 'bytes=49990-', 'If-Range': etag})
+            nt.eq_(200, response.status_code)
+            nt.eq_('goodbye' * 10000, response.content)
+            nt.ok_(etag != response.headers['ETag'])
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    import logging
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        _test()
+        logging.info("Tests Passed")
+    except AssertionError as e:
+        logging.error("ERROR: TESTS FAILED")
+        logging.error(e)
@@ -3,10 +3,13 @@
 # is in charge of generating urls to DBPedia files.
 # Files are specified by data set, version, language, and format.
 #
-__all__ = ['build']
+__all__ = ['build', 'set_download_base']
 
 from string import Template
 
+# where the DBpedia files are downloaded from
+DOWNLOAD_BASE = "http://downloads.dbpedia.org"
+
 # For reference, the dataset names that should be used as input
 dbpedia_mapping = {
     'article_categories': 'article_categories',
@@ -19,7 +22,7 @@ class VersionHandler(object):
     A base version handler that works for the modern dataset (3.9 at time of writing).
     """
 
-    url_template = Template("http://downloads.dbpedia.org/${version}/${language}/${dataset}_${language}.${format}.bz2")
+    url_template = Template("${base}/${version}/${language}/${dataset}_${language}.${format}.bz2")
     dataset_map = {}
 
     def __init__(self, version='3.9'):
@@ -30,10 +33,11 @@ class VersionHandler(object):
         if dataset in self.dataset_map:
             dataset = self.dataset_map[dataset]
 
-        return self.url_template.substitute(dataset=dataset,
-                                       version=self.version,
-                                       language=language,
-                                       format=format)
+        return self.url_template.substitute(base=DOWNLOAD_BASE,
+                                            dataset=dataset,
+                                            version=self.version,
+                                            language=language,
+                                            format=format)
 
 class VersionHandler_2_0(VersionHandler):
     """
@@ -41,7 +45,7 @@ class VersionHandler_2_0(VersionHandler):
     different dataset names and are stored in a different place.
     """
 
-    url_template = Template("http://downloads.dbpedia.org/${version}/${dataset}.${format}.bz2")
+    url_template = Template("${base}/${version}/${dataset}.${format}.bz2")
 
     dataset_map = {
         'article_categories': 'articles_category',
@@ -79,6 +83,17 @@ version_map = {
     '2.0': VersionHandler_2_0(),
 }
 
+def set_download_base(base):
+    """
+    Download files from somewhere other than downloads.dbpedia.org
+    (a mirror, or a local server for testing).
+
+    :param base: a url without a trailing slash, like http://localhost:8000
+    :return:
+    """
+    global DOWNLOAD_BASE
+    DOWNLOAD_BASE = base
+
 def build(resource):
     """
     Generate the DBpedia url for the given resource.
@@ -144,6 +159,14 @@ def _test():
     nt.assert_equal(build(res("category_labels", '3.0', 'en', 'nt')),
                     'http://downloads.dbpedia.org/3.0/en/categories_label_en.nt.bz2')
 
+    # from a mirror
+    set_download_base("http://localhost:8000")
+    try:
+        nt.assert_equal(build(res("category_labels", '3.9', 'en', 'nt')),
+                        'http://localhost:8000/3.9/en/category_labels_en.nt.bz2')
+    finally:
+        set_download_base("http://downloads.dbpedia.org")
+
 if __name__ == "__main__":
     import logging
     logging.basicConfig(level=logging.INFO)
@@ -6,35 +6,242 @@ and database connection information for where
 to store the imported data.
 """
 
-from dbpedia.resource import DBpediaResource
+from dbpedia.resource import DBpediaResource, dataset_names
 from catdb import models, insert
 import catdb.mysql as mysql
 from catdb.mysql import DEFAULT_PASSWORD
 
-from dbpedia import datasets
+from dbpedia import datasets, download, urls, recordcache
+from dbpedia.errors import ErrorSink
+from dbpedia.prefetch import Prefetcher
+from dbpedia.instrument import PipelineStats, save_summaries
 import common
 
 import logging
 import time
+import traceback
+import multiprocessing
+import Queue
+import resource as rlimits
 
+# seconds between checks for worker processes that died
+WORKER_POLL_INTERVAL = 5
 
-def import_dataset(dataset, version, language, limit=None):
 
-    models.create_tables(drop_if_exists=False, set_engine='InnoDB')
+def import_dataset(dataset, version, language, limit=None, processes=None, ordered=True,
+                   decompress_processes=None, mmap=False, record_cache=False, errors=None,
+                   compact=True, prefetcher=None, stream=False, preload=(), load_data=False,
+                   pipeline=False, writers=1, bulk=False, replace='delete'):
+    """
+    Import one dataset, returning the PipelineStats for the import.
+    Records are passed around as tuples unless compact is False.
+    If a Prefetcher is given, the download is left to it (and released once the file is open,
+    or when the Prefetcher is closed).
+    If stream is True, a dataset that isn't cached yet is imported while it downloads.
+    The names of the tables in preload are read into memory before importing (see catdb.insert).
+    With load_data, rows are sent with LOAD DATA LOCAL INFILE instead of INSERT statements.
+    With pipeline, rows are inserted on a second connection while the next ones are parsed.
+    With more than one writer, rows are split between that many connections.
+    With bulk, new tables are made without indexes (see build_indexes) and
+    rows are inserted with the bulk session settings.
+    Rows already imported for the version are replaced as in catdb.insert.REPLACE_STRATEGIES.
+    """
+
+    models.create_tables(drop_if_exists=False, set_engine='InnoDB',
+                         defer_indexes=deferred_models(preload) if bulk else ())
 
     resource = DBpediaResource(dataset=dataset, version=version, language=language)
-    incoming = datasets.get_collection(resource=resource)
+    if prefetcher is not None:
+        prefetcher.wait(resource)
+
+    stats = PipelineStats(label="%s_%s_%s" % (dataset, language, version))
+    incoming = datasets.get_collection(resource=resource, processes=processes, ordered=ordered,
+                                       decompress_processes=decompress_processes, mmap=mmap,
+                                       record_cache=record_cache, errors=errors, stats=stats,
+                                       compact=compact, stream=stream)
 
     versionInstance = models.dataset_version(version=resource.version, language=resource.language, date=resource.date)
 
     with incoming as data:
+        # the open file keeps the download pinned from here on
+        if prefetcher is not None:
+            prefetcher.release(resource)
 
         before = time.time()
-        imported = insert.insert_dataset(data=data, dataset=dataset, version_instance=versionInstance, limit=limit)
+        imported = insert.insert_dataset(data=data, dataset=dataset, version_instance=versionInstance,
+                                         limit=limit, stats=stats, preload=preload,
+                                         load_data=load_data, pipeline=pipeline, writers=writers,
+                                         bulk=bulk, replace=replace)
         after = time.time()
 
         if imported:
             print "Imported %d %s in %f seconds" % (imported, dataset, after - before)
+            for stage in stats.stages:
+                print "    %s" % stage.describe()
+
+            if data.iteratorClass.decoder is not None:
+                print "    url decoder (all imports so far): %s" % data.iteratorClass.decoder.describe()
+
+    stats.finish()
+    return stats
+
+def deferred_models(preload):
+    """
+    The models whose indexes are left until after a bulk import.
+    Names are looked up by their indexes, so those are only left
+    for the tables in preload.
+    """
+    deferred = list(models.model_mapping.values())
+    if 'categories' in preload:
+        deferred.append(models.Category)
+    if 'articles' in preload:
+        deferred.append(models.Article)
+    return deferred
+
+def build_indexes(deferred):
+    """Adds the indexes of the deferred models left out by a bulk import, printing how long it took"""
+    before = time.time()
+    times = models.build_indexes(deferred)
+    for table, seconds in sorted(times.items()):
+        print "    %s: %f seconds" % (table, seconds)
+    print "Built indexes in %f seconds" % (time.time() - before)
+
+def connect(args, password):
+    """Opens a connection to the database given on the command line, or returns False"""
+    return mysql.connect(database=args.database,
+                         user=args.user, host=args.hostname,
+                         port=args.port, password=password,
+                         local_infile=bool(args.load_data))
+
+def import_jobs(jobs, args, errors):
+    """
+    Import a list of (language, version, dataset) jobs, one after another,
+    using the options on the command line.
+    Returns the PipelineStats of each import.
+    """
+    prefetcher = None
+    if args.prefetch > 0:
+        resources = [DBpediaResource(dataset=dataset, version=version, language=language)
+                     for language, version, dataset in jobs]
+        # no need to download the ones we already have records for
+        if args.record_cache:
+            resources = [r for r in resources if not recordcache.exists(r)]
+        prefetcher = Prefetcher(resources, ahead=args.prefetch)
+
+    all_stats = []
+    try:
+        for language, version, dataset in jobs:
+            print "Importing %s v%s in %s" %(dataset, version, language)
+            stats = import_dataset(dataset=dataset, version=version, language=language, limit=args.limit,
+                                   processes=args.processes, ordered=not args.unordered,
+                                   decompress_processes=args.decompress_processes, mmap=args.mmap,
+                                   record_cache=args.record_cache, errors=errors,
+                                   prefetcher=prefetcher, stream=args.stream, preload=args.preload,
+                                   load_data=dataset in args.load_data, pipeline=args.pipeline,
+                                   writers=args.writers if dataset in args.parallel_datasets else 1,
+                                   bulk=args.bulk, replace=args.replace)
+            all_stats.append(stats)
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+
+    return all_stats
+
+def import_language(language, jobs, args, password, results):
+    """
+    Runs in a worker process.
+    Imports the jobs for one language over a connection of its own,
+    then puts a (language, stats, error counts, failure) tuple on the results queue,
+    where failure is None or the formatted traceback of what went wrong.
+    """
+    all_stats = []
+    error_counts = {}
+    try:
+        if args.worker_memory is not None:
+            limit = int(args.worker_memory * 1024 ** 3)
+            rlimits.setrlimit(rlimits.RLIMIT_AS, (limit, limit))
+
+        db = connect(args, password)
+        if not db:
+            raise Exception("Could not connect to the database")
+        models.database_proxy.initialize(db)
+
+        # other workers are creating names too
+        insert.use_name_locks(True)
+
+        # each worker gets its own quarantine file
+        quarantine = None
+        if args.quarantine:
+            quarantine = "%s.%s" % (args.quarantine, language)
+
+        with ErrorSink(quarantine=quarantine) as errors:
+            all_stats = import_jobs(jobs, args, errors)
+            error_counts = errors.counts
+
+        db.close()
+        results.put((language, all_stats, error_counts, None))
+    except Exception:
+        results.put((language, all_stats, error_counts, traceback.format_exc()))
+
+def import_in_parallel(jobs, args, password, workers):
+    """
+    Import the jobs for each language in a separate worker process,
+    with up to the given number of workers running at once.
+    Returns the PipelineStats of each import, a dictionary of parse error
+    counts, and a dictionary of failed languages (with the reason).
+    """
+    languages = []
+    for language, version, dataset in jobs:
+        if language not in languages:
+            languages.append(language)
+
+    print "Importing %d languages on %d worker processes" % (len(languages), workers)
+
+    results = multiprocessing.Queue()
+    running = {}
+    all_stats = []
+    error_counts = {}
+    failed = {}
+
+    while languages or running:
+        while languages and len(running) < workers:
+            language = languages.pop(0)
+            language_jobs = [job for job in jobs if job[0] == language]
+            process = multiprocessing.Process(target=import_language, name='import-%s' % language,
+                                              args=(language, language_jobs, args, password, results))
+            process.start()
+            running[language] = process
+
+        try:
+            result = results.get(timeout=WORKER_POLL_INTERVAL)
+        except Queue.Empty:
+            result = None
+
+        # workers that were killed (by the OOM killer, say) never report back
+        for language, process in running.items():
+            if not process.is_alive() and process.exitcode != 0:
+                print "Worker for %s died (exit code %s)" % (language, process.exitcode)
+                failed[language] = "exit code %s" % process.exitcode
+                del running[language]
+
+        if result is None:
+            continue
+
+        language, stats, counts, failure = result
+        process = running.pop(language, None)
+        if process is not None:
+            process.join()
+        all_stats.extend(stats)
+        for category, count in counts.items():
+            error_counts[category] = error_counts.get(category, 0) + count
+
+        if failure is None:
+            print "Finished importing %s" % language
+        else:
+            print "Import of %s failed:\n%s" % (language, failure)
+            failed[language] = failure
+
+    return all_stats, error_counts, failed
 
 
 if __name__ == "__main__":
@@ -51,8 +258,164 @@ if __name__ == "__main__":
                         type=int,
                         help="number of rows to insert, for debugging")
 
+    parser.add_argument("--processes",
+                        required=False,
+                        default=None,
+                        type=int,
+                        help="number of processes for parsing the dumps")
+
+    parser.add_argument("--unordered",
+                        required=False,
+                        default=False,
+                        action="store_true",
+                        help="with --processes, insert batches in whatever order they are parsed")
+
+    parser.add_argument("--decompress-processes",
+                        required=False,
+                        default=None,
+                        type=int,
+                        help="number of processes for decompressing the dumps")
+
+    parser.add_argument("--decompressed-cache",
+                        required=False,
+                        default=None,
+                        type=float,
+                        metavar="GIGABYTES",
+                        help="keep up to this much decompressed data in the download cache")
+
+    parser.add_argument("--cache-limit",
+                        required=False,
+                        default=None,
+                        type=float,
+                        metavar="GIGABYTES",
+                        help="keep up to this much downloaded data in the download cache, evicting the least recently used")
+
+    parser.add_argument("--warm",
+                        required=False,
+                        default=False,
+                        action="store_true",
+                        help="download everything the import needs before starting")
+
+    parser.add_argument("--mmap",
+                        required=False,
+                        default=False,
+                        action="store_true",
+                        help="memory-map decompressed files from the cache")
+
+    parser.add_argument("--record-cache",
+                        required=False,
+                        default=False,
+                        action="store_true",
+                        help="load parsed records from the binary record cache, saving them there on first use")
+
+    parser.add_argument("--quarantine",
+                        required=False,
+                        default=None,
+                        metavar="FILE",
+                        help="append lines that could not be parsed to this file")
+
+    parser.add_argument("--stats-json",
+                        required=False,
+                        default=None,
+                        metavar="FILE",
+                        help="save the time spent in each stage of each import to this file, as JSON")
+
+    parser.add_argument("--prefetch",
+                        required=False,
+                        default=0,
+                        type=int,
+                        metavar="N",
+                        help="download up to N upcoming datasets in the background while importing")
+
+    parser.add_argument("--stream",
+                        required=False,
+                        default=False,
+                        action="store_true",
+                        help="import datasets while they download, instead of downloading them first")
+
+    parser.add_argument("--preload",
+                        required=False,
+                        nargs='+',
+                        default=[],
+                        choices=['categories', 'articles'],
+                        help="read all the names in these tables into memory before each import, instead of looking them up batch by batch")
+
+    parser.add_argument("--load-data",
+                        required=False,
+                        nargs='+',
+                        default=[],
+                        metavar='DBPEDIA_DATASET',
+                        choices=dataset_names,
+                        help="insert these datasets with LOAD DATA LOCAL INFILE instead of INSERT statements")
+
+    parser.add_argument("--pipeline",
+                        required=False,
+                        default=False,
+                        action="store_true",
+                        help="insert each batch on a second connection while the next one is parsed")
+
+    parser.add_argument("--writers",
+                        required=False,
+                        default=1,
+                        type=int,
+                        metavar="N",
+                        help="insert each batch over N connections, split by related id")
+
+    parser.add_argument("--parallel-datasets",
+                        required=False,
+                        nargs='+',
+                        default=['article_categories'],
+                        metavar='DBPEDIA_DATASET',
+                        choices=dataset_names,
+                        help="the datasets to insert with --writers (default article_categories)")
+
+    parser.add_argument("--bulk",
+                        required=False,
+                        default=False,
+                        action="store_true",
+                        help="create new tables without indexes, build them after the import, and turn off unique checks")
+
+    parser.add_argument("--replace",
+                        required=False,
+                        default='delete',
+                        choices=insert.REPLACE_STRATEGIES,
+                        help="how to replace versions imported before: delete their rows first, "
+                             "or load into a staging table and swap it in (partitioning the tables by version, "
+                             "which drops their foreign keys)")
+
+    parser.add_argument("--language-processes",
+                        required=False,
+                        default=None,
+                        type=int,
+                        metavar="N",
+                        help="import up to N languages at once, each in its own process with its own connection")
+
+    parser.add_argument("--max-connections",
+                        required=False,
+                        default=None,
+                        type=int,
+                        metavar="N",
+                        help="with --language-processes, open at most N database connections")
+
+    parser.add_argument("--worker-memory",
+                        required=False,
+                        default=None,
+                        type=float,
+                        metavar="GIGABYTES",
+                        help="with --language-processes, limit the address space of each worker process")
+
+    parser.add_argument("--download-base",
+                        required=False,
+                        default=None,
+                        metavar="URL",
+                        help="download from this mirror instead of %s" % urls.DOWNLOAD_BASE)
+
     args = parser.parse_args()
 
+    if args.stream and args.prefetch:
+        # they would both be downloading the same files
+        parser.error("--stream and --prefetch can't be used together")
+
     if args.verbose:
         logging.basicConfig(level=logging.INFO)
     else:
@@ -63,9 +426,7 @@ if __name__ == "__main__":
     else:
         password = DEFAULT_PASSWORD
 
-    db = mysql.connect(database=args.database,
-                       user=args.user, host=args.hostname,
-                       port=args.port, password=password)
+    db = connect(args, password)
 
     #mysql.trap_warnings()
 
@@ -78,11 +439,88 @@ if __name__ == "__main__":
     if args.yes:
         models.use_confirmations(False)
 
-    imported = len(args.langs) * len(args.versions) * len(args.datasets)
-    print "Selected %d datasets for import" % imported
+    if args.decompressed_cache is not None:
+        download.use_decompressed_cache(True, limit=int(args.decompressed_cache * 1024 ** 3))
+
+    if args.cache_limit is not None:
+        download.limit_download_cache(int(args.cache_limit * 1024 ** 3))
+
+    if args.download_base:
+        urls.set_download_base(args.download_base.rstrip('/'))
 
-    for language in args.langs:
-        for version in args.versions:
-            for dataset in args.datasets:
-                print "Importing %s v%s in %s" %(dataset, version, language)
-                import_dataset(dataset=dataset, version=version, language=language, limit=args.limit)
+    jobs = [(language, version, dataset)
+            for language in args.langs
+            for version in args.versions
+            for dataset in args.datasets]
+    print "Selected %d datasets for import" % len(jobs)
+
+    if args.warm:
+        resources = [DBpediaResource(dataset=dataset, version=version, language=language)
+                     for language, version, dataset in jobs]
+        # no need to download the ones we already have records for
+        if args.record_cache:
+            resources = [r for r in resources if not recordcache.exists(r)]
+        download.warm(resources)
+
+    workers = min(args.language_processes or 1, len(args.langs))
+    if args.max_connections is not None:
+        # pipelined imports use a connection for reading names, and more for writing
+        if args.writers > 1:
+            connections = 1 + args.writers
+        elif args.pipeline:
+            connections = 2
+        else:
+            connections = 1
+        workers = min(workers, max(1, args.max_connections // connections))
+
+    # the tables whose indexes --bulk leaves for the end
+    # (parallel workers look up each other's names, so they need the name indexes)
+    deferred = deferred_models(args.preload if workers == 1 else ()) if args.bulk else []
+
+    if workers > 1:
+        # the workers share the tables, so make them first
+        models.create_tables(drop_if_exists=False, set_engine='InnoDB', defer_indexes=deferred)
+        if args.replace == 'swap':
+            # before the workers can race to do it
+            for modelClass in models.model_mapping.values():
+                models.partition_by_version(modelClass)
+        # and they bring their own connections
+        db.close()
+
+        all_stats, error_counts, failed = import_in_parallel(jobs, args, password, workers)
+
+        if error_counts:
+            print "Skipped %d lines with parse errors:" % sum(error_counts.values())
+            for category, count in sorted(error_counts.items()):
+                print "    %s: %d" % (category, count)
+            if args.quarantine:
+                print "Bad lines were written to %s.<language>" % args.quarantine
+
+        if failed:
+            print "Failed to import: %s" % ", ".join(sorted(failed))
+    else:
+        failed = None
+        with ErrorSink(quarantine=args.quarantine) as errors:
+            all_stats = import_jobs(jobs, args, errors)
+
+            if errors.total:
+                print "Skipped %d lines with parse errors:" % errors.total
+                for category, count in errors.summary():
+                    print "    %s: %d" % (category, count)
+                if args.quarantine:
+                    print "Bad lines were written to %s" % args.quarantine
+
+    if args.bulk:
+        if workers > 1:
+            db = connect(args, password)
+            if not db:
+                exit(1)
+            models.database_proxy.initialize(db)
+        build_indexes(deferred)
+
+    if args.stats_json:
+        save_summaries(args.stats_json, all_stats)
+        print "Saved import stats to %s" % args.stats_json
+
+    if failed:
+        exit(1)
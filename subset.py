@@ -90,7 +90,11 @@ class Batcher(object):
         self.init_batch()
         self.submissions += 1
 
-def copy_subset(root_name, depth, db_from, db_to):
+# the tables copied into a subset
+SUBSET_MODELS = [models.DataSetVersion, models.Category, models.Article,
+                 models.CategoryLabel, models.ArticleCategory, models.CategoryCategory]
+
+def copy_subset(root_name, depth, db_from, db_to, bulk=False):
 
     print "Copying all data under root '%s' up to depth %s from '%s' to '%s'" %(root_name, depth, db_from.database, db_to.database)
 
@@ -103,7 +107,10 @@ def copy_subset(root_name, depth, db_from, db_to):
 
     # first initialize the target database
     models.database_proxy.initialize(db_to)
-    models.create_tables(drop_if_exists=True, set_engine="InnoDB")
+    models.create_tables(drop_if_exists=True, set_engine="InnoDB",
+                         defer_indexes=SUBSET_MODELS if bulk else ())
+    if bulk:
+        models.bulk_session(db_to)
 
     # point all the models at the source database
     models.database_proxy.initialize(db_from)
@@ -168,6 +175,14 @@ def copy_subset(root_name, depth, db_from, db_to):
           % (batch.num_versions, batch.num_categories, batch.num_category_labels, batch.num_articles, batch.num_article_categories, batch.num_category_categories)
     print "Time taken: %fs. Maximum depth %d. %d batches." %(last_time - before, max_depth, batch.submissions)
 
+    if bulk:
+        models.database_proxy.initialize(db_to)
+        models.bulk_session(db_to, False)
+
+        times = models.build_indexes(SUBSET_MODELS)
+        print "Built indexes in %fs (%s)" % (sum(times.values()),
+                                            ", ".join("%s: %.1fs" % item for item in sorted(times.items())))
+
 if __name__ == "__main__":
     import argparse
 
@@ -188,6 +203,12 @@ if __name__ == "__main__":
                         required=True,
                         help="The database to write into")
 
+    parser.add_argument("--bulk",
+                        default=False,
+                        action="store_true",
+                        required=False,
+                        help="Build the indexes after copying, and turn off unique checks while copying")
+
     args = parser.parse_args()
 
     if args.verbose:
@@ -221,4 +242,4 @@ if __name__ == "__main__":
     if args.yes:
         models.use_confirmations(False)
 
-    copy_subset(root_name=args.root_category, depth=args.depth, db_from=db, db_to=target)
+    copy_subset(root_name=args.root_category, depth=args.depth, db_from=db, db_to=target, bulk=args.bulk)
@@ -0,0 +1,116 @@
+"""
+This script is meant to be executable.
+
+It computes the category edges added and removed between
+two DBpedia versions, writing them to delta files.
+No database is needed.
+"""
+
+from dbpedia import delta
+from dbpedia.resource import version_names
+from dbpedia.errors import ErrorSink
+from dbpedia.instrument import PipelineStats
+import common
+
+import logging
+import time
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compute the changes in dbpedia category data between versions.")
+    common.add_io_args(parser)
+
+    parser.add_argument("old_version",
+                        metavar="OLD_VERSION",
+                        choices=version_names,
+                        help="the version to compare against")
+
+    parser.add_argument("new_version",
+                        metavar="NEW_VERSION",
+                        choices=version_names,
+                        help="the version to find changes in")
+
+    parser.add_argument("--datasets",
+                        required=False,
+                        nargs='+',
+                        metavar='DBPEDIA_DATASET',
+                        choices=delta.PAIR_DATASETS,
+                        default=delta.PAIR_DATASETS,
+                        help="which dataset(s) to compare")
+
+    parser.add_argument("--langs",
+                        required=False,
+                        nargs='+',
+                        metavar="LANGUAGE_CODE",
+                        default=['en'],
+                        help="which language(s) to compare")
+
+    parser.add_argument("--output",
+                        required=False,
+                        default="deltas",
+                        metavar="DIR",
+                        help="directory for the delta files")
+
+    parser.add_argument("--run-size",
+                        required=False,
+                        default=delta.RUN_SIZE,
+                        type=int,
+                        help="most pairs to sort in memory at once")
+
+    parser.add_argument("--tempdir",
+                        required=False,
+                        default=None,
+                        metavar="DIR",
+                        help="directory for temporary sorted runs")
+
+    parser.add_argument("--processes",
+                        required=False,
+                        default=None,
+                        type=int,
+                        help="number of processes for parsing the dumps")
+
+    parser.add_argument("--record-cache",
+                        required=False,
+                        default=False,
+                        action="store_true",
+                        help="load parsed records from the binary record cache, saving them there on first use")
+
+    parser.add_argument("--stream",
+                        required=False,
+                        default=False,
+                        action="store_true",
+                        help="compare dumps while they download")
+
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO)
+    else:
+        logging.basicConfig(level=logging.WARN)
+
+    with ErrorSink() as errors:
+        for language in args.langs:
+            for dataset in args.datasets:
+                print "Comparing %s in %s: v%s to v%s" % (dataset, language, args.old_version, args.new_version)
+                stats = PipelineStats(label="%s_%s delta" % (dataset, language))
+
+                before = time.time()
+                counts = delta.compute_delta(dataset, args.old_version, args.new_version, language,
+                                             args.output, run_size=args.run_size, tempdir=args.tempdir,
+                                             processes=args.processes, record_cache=args.record_cache,
+                                             stream=args.stream, errors=errors, stats=stats)
+                after = time.time()
+
+                print "%d added, %d removed, %d unchanged in %f seconds" % (
+                    counts['added'], counts['removed'], counts['unchanged'], after - before)
+                for stage in stats.stages:
+                    print "    %s" % stage.describe()
+
+                added, removed = delta.delta_filenames(args.output, dataset, language,
+                                                       args.old_version, args.new_version)
+                print "Wrote %s and %s" % (added, removed)
+
+        if errors.total:
+            print "Skipped %d lines with parse errors" % errors.total